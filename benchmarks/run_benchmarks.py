@@ -0,0 +1,367 @@
+"""
+Benchmarks of the data and sequence hot paths on deterministic synthetic replay databases,
+simulated by utils.generate_synthetic_replays in the schema of the TLoL replay databases.
+
+Every benchmark runs in its own subprocess, so the peak RSS of one benchmark does not include the others.
+The results are compared against a stored baseline:
+
+    python -m benchmarks.run_benchmarks --sizes small medium
+    python -m benchmarks.run_benchmarks --sizes small medium --save-baseline
+
+Run from the root of the repository, the normalization config is read from the working directory.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from sklearn.linear_model import LinearRegression
+
+from constants import DB_columns, DEFAULT_DATA_FEATURES
+from utils.generate_synthetic_replays import generate_synthetic_replays
+from utils.get_or_create_combined_database import get_or_create_combined_database
+from utils.clean_and_normalize_table import clean_and_normalize_table
+from utils.get_data import clear_cache, get_count_arrays, get_counts, fetch_data_batches
+from utils.create_sequences_in_batches import create_sequences_from_database_rows
+from utils.compare_models import compare_models
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA_FOLDER = os.path.join(BENCHMARK_FOLDER, "data")
+DEFAULT_BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, "baseline.json")
+
+# Matches of 10 players and ticks per player of every database size
+SIZES = {
+    "small": {"matches": 8, "ticks": 1000},
+    "medium": {"matches": 32, "ticks": 2000},
+    "large": {"matches": 100, "ticks": 4000},
+}
+SEED = 0
+TABLE_NAME = "champs_cleaned"
+SOURCE_TABLE_NAME = "champs"
+MATCH_FOLDER_NAME = "matches"
+CLEANED_DATABASE_NAME = "cleaned.db"
+
+# Relative slowdown or memory growth over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def get_size_folder(data_folder, size):
+    parameters = SIZES[size]
+    return os.path.join(data_folder, f"{size}_{parameters['matches']}x{parameters['ticks']}_seed{SEED}")
+
+
+def write_source_database(match_folder, database_file):
+    """
+    Copy the champs tables of all per-match databases, with all of their columns, into one database.
+    The combined database only keeps COMBINED_COLUMNS, so the cleaning benchmark reads this table instead,
+    which is normalized like a single TLoL replay database.
+    """
+    conn = sqlite3.connect(database_file, isolation_level=None)
+    cursor = conn.cursor()
+    for i, match_file in enumerate(sorted(os.listdir(match_folder))):
+        cursor.execute("ATTACH DATABASE ? AS match", (os.path.join(match_folder, match_file),))
+        if i == 0:
+            cursor.execute(f"CREATE TABLE {SOURCE_TABLE_NAME} AS SELECT * FROM match.{SOURCE_TABLE_NAME}")
+        else:
+            cursor.execute(f"INSERT INTO {SOURCE_TABLE_NAME} SELECT * FROM match.{SOURCE_TABLE_NAME}")
+        cursor.execute("DETACH DATABASE match")
+    conn.close()
+
+
+def prepare_size_data(data_folder, size):
+    """
+    Create the per-match replay databases and the cleaned database of a size, unless they already exist.
+    The databases are deterministic, so they are reused between runs.
+    """
+    size_folder = get_size_folder(data_folder, size)
+    cleaned_database = os.path.join(size_folder, CLEANED_DATABASE_NAME)
+    if os.path.exists(cleaned_database):
+        return size_folder
+
+    print(f"Creating the {size} synthetic databases in {size_folder}")
+    shutil.rmtree(size_folder, ignore_errors=True)
+    match_folder = os.path.join(size_folder, MATCH_FOLDER_NAME)
+    generate_synthetic_replays(match_folder, SIZES[size]["matches"], SIZES[size]["ticks"], seed=SEED)
+    # Cleaned in a temporary file first, so an interrupted preparation is not reused
+    os.makedirs(size_folder, exist_ok=True)
+    write_source_database(match_folder, cleaned_database + ".tmp")
+    clean_and_normalize_table(cleaned_database + ".tmp", TABLE_NAME, SOURCE_TABLE_NAME, bulk=True)
+    os.replace(cleaned_database + ".tmp", cleaned_database)
+    return size_folder
+
+
+def count_rows(database_file, table_name):
+    conn = sqlite3.connect(database_file)
+    row_count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    conn.close()
+    return row_count
+
+
+def get_key_count(database_file):
+    conn = sqlite3.connect(database_file)
+    key_count = conn.execute(f"SELECT COUNT(DISTINCT {DB_columns.COMPOUND_KEY.value}) FROM {TABLE_NAME}").fetchone()[0]
+    conn.close()
+    return key_count
+
+
+def clear_count_cache(database_file):
+    conn = sqlite3.connect(database_file)
+    clear_cache(conn.cursor())
+    conn.commit()
+    conn.close()
+
+
+def warm_count_cache(database_file, limit):
+    conn = sqlite3.connect(database_file)
+    get_count_arrays(conn.cursor(), TABLE_NAME, "1=1", limit=limit, offset=0)
+    conn.commit()
+    conn.close()
+
+
+# Every benchmark has a setup(size_folder, work_folder) -> state, which is not timed,
+# and a run(state) -> rows, whose wall time is measured.
+
+def setup_combined_database(size_folder, work_folder):
+    match_folder = os.path.join(size_folder, MATCH_FOLDER_NAME)
+    database_folder = os.path.join(work_folder, MATCH_FOLDER_NAME)
+    shutil.copytree(match_folder, database_folder)
+    return database_folder
+
+
+def run_combined_database(database_folder):
+    combined_database = get_or_create_combined_database(database_folder)
+    return count_rows(combined_database, SOURCE_TABLE_NAME)
+
+
+def setup_clean_and_normalize_table(size_folder, work_folder):
+    database_file = os.path.join(work_folder, CLEANED_DATABASE_NAME)
+    shutil.copy(os.path.join(size_folder, CLEANED_DATABASE_NAME), database_file)
+    return database_file
+
+
+def run_clean_and_normalize_table(database_file):
+    clean_and_normalize_table(database_file, TABLE_NAME, SOURCE_TABLE_NAME, bulk=True)
+    return count_rows(database_file, SOURCE_TABLE_NAME)
+
+
+def setup_get_counts(size_folder, work_folder):
+    # The counts are computed from the table, not read from the count cache
+    database_file = setup_clean_and_normalize_table(size_folder, work_folder)
+    clear_count_cache(database_file)
+    return database_file
+
+
+def run_get_counts(database_file):
+    conn = sqlite3.connect(database_file)
+    counts = get_counts(conn.cursor(), TABLE_NAME)
+    conn.close()
+    return sum(count for count, _ in counts)
+
+
+def setup_fetch_data_batches(size_folder, work_folder):
+    # Only the fetching is timed, the counts are already cached
+    database_file = setup_clean_and_normalize_table(size_folder, work_folder)
+    key_count = get_key_count(database_file)
+    warm_count_cache(database_file, key_count)
+    return database_file, key_count
+
+
+def run_fetch_data_batches(state):
+    database_file, key_count = state
+    conn = sqlite3.connect(database_file)
+    data = fetch_data_batches(conn.cursor(), TABLE_NAME, "1=1", 0, key_count, DEFAULT_DATA_FEATURES)
+    conn.close()
+    return sum(len(rows) for rows in data)
+
+
+def setup_create_sequences(size_folder, work_folder):
+    database_file, key_count = setup_fetch_data_batches(size_folder, work_folder)
+    conn = sqlite3.connect(database_file)
+    data = fetch_data_batches(conn.cursor(), TABLE_NAME, "1=1", 0, key_count, DEFAULT_DATA_FEATURES)
+    conn.close()
+    return data
+
+
+def run_create_sequences(data):
+    rows = 0
+    for H, T in [(5, 1), (20, 10)]:
+        create_sequences_from_database_rows(data, H, T)
+        rows += sum(len(key_rows) for key_rows in data)
+    return rows
+
+
+def setup_compare_models(size_folder, work_folder):
+    return setup_fetch_data_batches(size_folder, work_folder)
+
+
+def run_compare_models(state):
+    database_file, key_count = state
+    model_getters = {"linear_regression": lambda H, T: (LinearRegression(), DEFAULT_DATA_FEATURES, (-1, H * len(DEFAULT_DATA_FEATURES)))}
+    compare_models(database_file, TABLE_NAME, [5, 10], [1, 5], model_getters, total_keys_to_fetch=key_count, batch_size=key_count)
+    return count_rows(database_file, TABLE_NAME)
+
+
+BENCHMARKS = {
+    "get_or_create_combined_database": (setup_combined_database, run_combined_database),
+    "clean_and_normalize_table": (setup_clean_and_normalize_table, run_clean_and_normalize_table),
+    "get_counts": (setup_get_counts, run_get_counts),
+    "fetch_data_batches": (setup_fetch_data_batches, run_fetch_data_batches),
+    "create_sequences_from_database_rows": (setup_create_sequences, run_create_sequences),
+    "compare_models": (setup_compare_models, run_compare_models),
+}
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the current process in bytes.
+    """
+    # On Linux ru_maxrss is inherited from the parent process through fork and exec, VmHWM starts over with exec
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    # resource is not available on Windows, where psutil reports the peak working set
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def run_benchmark(name, size_folder):
+    """
+    Run one benchmark in the current process.
+
+    Returns:
+        dict: wall_time in seconds, peak_rss in bytes (of the whole process, imports and setup included) and rows per second
+    """
+    setup, run = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as work_folder:
+        state = setup(size_folder, work_folder)
+        start_time = time.perf_counter()
+        rows = run(state)
+        wall_time = time.perf_counter() - start_time
+    return {"wall_time": wall_time, "peak_rss": get_peak_rss(), "rows": rows, "rows_per_second": rows / wall_time}
+
+
+def run_benchmark_subprocess(name, size_folder, verbose=False):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_file = f.name
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.run_benchmarks", "--child", name, size_folder, result_file],
+            check=True, stdout=None if verbose else subprocess.DEVNULL, stderr=None if verbose else subprocess.DEVNULL)
+        with open(result_file, "r") as f:
+            return json.load(f)
+    finally:
+        os.remove(result_file)
+
+
+def run_benchmarks(names, sizes, data_folder=DEFAULT_DATA_FOLDER, repeat=3, verbose=False):
+    """
+    Run the benchmarks for every size, repeat times each in a new subprocess.
+    The fastest run is reported, with the highest peak RSS of all runs.
+
+    Returns:
+        dict: "name[size]" to the result of the benchmark
+    """
+    results = {}
+    for size in sizes:
+        size_folder = prepare_size_data(data_folder, size)
+        for name in names:
+            runs = [run_benchmark_subprocess(name, size_folder, verbose) for _ in range(repeat)]
+            result = min(runs, key=lambda run: run["wall_time"])
+            result["peak_rss"] = max(run["peak_rss"] for run in runs)
+            results[f"{name}[{size}]"] = result
+            print(f"{name}[{size}]: {result['wall_time']:.3f}s, {result['peak_rss'] / 2**20:.0f} MiB peak RSS, "
+                  f"{result['rows_per_second']:.0f} rows/s")
+    return results
+
+
+def get_machine():
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version}
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print the change of every result against the baseline.
+
+    Returns:
+        list: The "name[size]" of the results that are slower, or use more memory, than the baseline by more than tolerance
+    """
+    if baseline["machine"] != get_machine():
+        print(f"The baseline was recorded on a different machine: {baseline['machine']}")
+
+    regressions = []
+    print(f"{'benchmark':<50} {'wall time':>12} {'peak RSS':>12} {'rows/s':>12}")
+    for key, result in results.items():
+        if key not in baseline["results"]:
+            print(f"{key:<50} {'no baseline':>12}")
+            continue
+        baseline_result = baseline["results"][key]
+        time_ratio = result["wall_time"] / baseline_result["wall_time"]
+        rss_ratio = result["peak_rss"] / baseline_result["peak_rss"]
+        rows_ratio = result["rows_per_second"] / baseline_result["rows_per_second"]
+        regressed = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(key)
+        print(f"{key:<50} {time_ratio:>11.2f}x {rss_ratio:>11.2f}x {rows_ratio:>11.2f}x{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data and sequence hot paths on synthetic databases")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-folder", default=DEFAULT_DATA_FOLDER)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the benchmarks")
+    parser.add_argument("--child", nargs=3, metavar=("NAME", "SIZE_FOLDER", "RESULT_FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        name, size_folder, result_file = args.child
+        with open(result_file, "w") as f:
+            json.dump(run_benchmark(name, size_folder), f)
+        return 0
+
+    results = run_benchmarks(args.benchmarks, args.sizes, args.data_folder, args.repeat, args.verbose)
+
+    if args.save_baseline:
+        baseline = {"machine": get_machine(), "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline["results"] = json.load(f)["results"]
+        baseline["results"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
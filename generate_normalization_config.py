@@ -4,6 +4,7 @@ import os
 from enum import Enum
 
 from utils.get_or_create_combined_database import get_or_create_combined_database
+from utils.compute_column_statistics import compute_column_statistics, get_expression_normalization_config
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -19,28 +20,28 @@ cursor = conn.cursor()
 cursor.execute("PRAGMA table_info(champs)")
 columns_info = cursor.fetchall()
 
-# Retrieve max values for numeric columns and unique values for string columns
-max_values = {}
-normalization_columns = []
-string_columns = {}
+# Normalization method of numeric columns: "max", "min_max" or "z_score", optionally per column
+default_normalization_method = os.getenv("NORMALIZATION_METHOD", "max")
+normalization_methods = {}
 
 # Add filter to disregard some rows
 value_filter = f"time > 5"
 
+numeric_columns = [column[1] for column in columns_info if column[2] in ["REAL", "INTEGER"]]
+text_columns = [column[1] for column in columns_info if column[2] == "TEXT"]
+
+# Compute the statistics of all columns in a single pass over the table
+column_statistics, string_columns = compute_column_statistics(
+    cursor, "champs", numeric_columns, text_columns, filter=value_filter)
+
+# Keep the values of integer columns as integers
 for column in columns_info:
-    column_name = column[1]
-    column_type = column[2]
-    
-    if column_type in ["REAL", "INTEGER"]:
-        cursor.execute(f"SELECT MAX({column_name}) FROM champs WHERE {value_filter}")
-        max_value = cursor.fetchone()[0]
-        if max_value is not None:
-            max_values[column_name] = max_value
-            normalization_columns.append(column_name)
-    elif column_type == "TEXT":
-        cursor.execute(f"SELECT DISTINCT {column_name} FROM champs WHERE {value_filter}")
-        unique_values = cursor.fetchall()
-        string_columns[column_name] = {value[0]: idx+1 for idx, value in enumerate(unique_values)}
+    if column[2] == "INTEGER" and column_statistics[column[1]]["count"] > 0:
+        column_statistics[column[1]]["min"] = int(column_statistics[column[1]]["min"])
+        column_statistics[column[1]]["max"] = int(column_statistics[column[1]]["max"])
+
+# Numeric columns without values are not normalized
+normalization_columns = [column_name for column_name in numeric_columns if column_statistics[column_name]["count"] > 0]
 
 # Close the connection
 conn.close()
@@ -49,8 +50,8 @@ conn.close()
 print("Columns Info:")
 print(columns_info)
 
-print("\nMax Values:")
-print(max_values)
+print("\nColumn Statistics:")
+print(json.dumps(column_statistics, indent=4))
 
 print("\nNormalization Columns:")
 print(normalization_columns)
@@ -89,13 +90,9 @@ for column in columns_info:
     
     if column_name in normalization_columns:
         if column_type in ["REAL", "INTEGER"]:
-            max_value = max_values.get(column_name, 1)
-            config = {
-                "column_enum": getattr(DB_columns, column_name.upper()),
-                "normalization_type": "expression",
-                "normalization_expression": "({column_name} / {max_value})",
-                "parameters": {"max_value": max_value}
-            }
+            normalization_method = normalization_methods.get(column_name, default_normalization_method)
+            config = get_expression_normalization_config(column_name, column_statistics[column_name], normalization_method)
+            config["column_enum"] = getattr(DB_columns, column_name.upper())
             normalization_config.append(config)
     elif column_name in string_columns:
         # Add case normalization for string columns
@@ -103,7 +100,8 @@ for column in columns_info:
         config = {
             "column_enum": getattr(DB_columns, column_name.upper()),
             "normalization_type": "case",
-            "cases": cases
+            "cases": cases,
+            "statistics": column_statistics[column_name]
         }
         normalization_config.append(config)
 
@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+
+# The utils modules import constants from the repository root
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from utils import get_data  # noqa: E402
+
+from constants import DB_columns  # noqa: E402
+
+# Columns of the raw champs table of a combined database, and of the full TLoL schema
+RAW_COLUMNS = {"game_id": "INTEGER", "time": "REAL", "name": "TEXT", "team": "INTEGER", "hp": "REAL", "pos_x": "REAL", "pos_z": "REAL"}
+FULL_RAW_COLUMNS = {**RAW_COLUMNS, **{
+    column.value: "TEXT" if column.value.endswith("_name") else "REAL" for column in DB_columns
+    if column.value not in RAW_COLUMNS and not column.value.startswith("normalized_") and column != DB_columns.COMPOUND_KEY}}
+CHAMPION_NAMES = ["Ahri", "Ezreal", "Aatrox", "Jinx"]
+
+
+def create_raw_table(database_file, game_ids, ticks=20, seed=0, table_name="champs", full_schema=False):
+    """
+    Create or extend a raw table with four players per game. The first ticks of every game and a few rows
+    outside the game area are removed by the cleaning filter.
+
+    Args:
+        full_schema (bool): Create every column of the TLoL schema instead of the columns of a combined database
+
+    Returns:
+        int: The amount of rows kept by the cleaning filter
+    """
+    rng = np.random.default_rng(seed)
+    columns = FULL_RAW_COLUMNS if full_schema else RAW_COLUMNS
+    conn = sqlite3.connect(database_file)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(f'{column} {column_type}' for column, column_type in columns.items())})")
+    rows = []
+    kept_rows = 0
+    for game_id in game_ids:
+        for player, name in enumerate(CHAMPION_NAMES):
+            for tick in range(ticks):
+                time = 2.0 + tick
+                pos_x = -1.0 if tick == ticks // 2 else float(rng.uniform(100, 14900))
+                row = {"game_id": game_id, "time": time, "name": name, "team": 100 + 100 * (player % 2), "pos_x": pos_x, "pos_z": float(rng.uniform(100, 14900))}
+                # Spell names of the other players are not in the normalization config and get NULL codes
+                rows.append(tuple(row.get(column, f"{column[0].upper()}Spell{player}" if column_type == "TEXT" else float(rng.uniform(0, 500)))
+                                  for column, column_type in columns.items()))
+                kept_rows += time > 5 and pos_x > 0
+    conn.executemany(f"INSERT INTO {table_name} VALUES ({', '.join('?' * len(columns))})", rows)
+    conn.commit()
+    conn.close()
+    return kept_rows
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    # normalization_config.json is read from the working directory, like in the notebooks
+    monkeypatch.chdir(REPOSITORY_ROOT)
+    return REPOSITORY_ROOT
+
+
+@pytest.fixture
+def normalization_config():
+    with open(os.path.join(REPOSITORY_ROOT, "normalization_config.json"), "r") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def raw_database(tmp_path):
+    database_file = str(tmp_path / "combined.db")
+    create_raw_table(database_file, [1001, 1002, 1003])
+    return database_file
+
+
+def read_table(database_file, table_name, order_by="compound_key, time", columns="*"):
+    conn = sqlite3.connect(database_file)
+    rows = conn.execute(f"SELECT {columns} FROM {table_name} ORDER BY {order_by}").fetchall()
+    conn.close()
+    return rows
+
+
+def create_trajectory_table(cursor, table_name, row_counts, seed=0):
+    """
+    Create a small table of trajectories with one compound key per trajectory and random positions.
+
+    Args:
+        row_counts (list): Amount of rows of every trajectory, ten trajectories per game
+
+    Returns:
+        dict: Compound key mapped to the (normalized_pos_x, normalized_pos_z) rows of its trajectory
+    """
+    rng = np.random.default_rng(seed)
+    cursor.execute(f"CREATE TABLE {table_name} (game_id INTEGER, compound_key TEXT, time REAL, normalized_pos_x REAL, normalized_pos_z REAL)")
+    cursor.execute(f"CREATE INDEX {table_name}_compound_key_idx ON {table_name} (compound_key)")
+    trajectories = {}
+    for key_index, row_count in enumerate(row_counts):
+        compound_key = f"{key_index // 10}_{key_index % 10}"
+        positions = rng.random((row_count, 2))
+        cursor.executemany(f"INSERT INTO {table_name} VALUES (?, ?, ?, ?, ?)", [
+            (key_index // 10, compound_key, time, x, z) for time, (x, z) in enumerate(positions.tolist())])
+        trajectories[compound_key] = positions
+    cursor.connection.commit()
+    return trajectories
+
+
+@pytest.fixture
+def cursor():
+    # The in-memory count cache is keyed on the table fingerprint, which can repeat between databases
+    get_data.cache.clear()
+    conn = sqlite3.connect(":memory:")
+    yield conn.cursor()
+    conn.close()
+    get_data.cache.clear()
+
+
+@pytest.fixture
+def trajectory_table(cursor):
+    def create(table_name, row_counts, seed=0):
+        return create_trajectory_table(cursor, table_name, row_counts, seed)
+    return create
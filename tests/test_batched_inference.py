@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.linear_model import LinearRegression
+
+from utils.batched_inference import predict_in_batches
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(50, 4)).astype(np.float32)
+    return X, X @ rng.normal(size=(4, 2))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_chunks_match_one_prediction(data, workers):
+    X, y = data
+    model = LinearRegression().fit(X, y)
+    np.testing.assert_allclose(predict_in_batches(model, X, chunk_size=7, workers=workers), model.predict(X), rtol=1e-6)
+
+
+def test_torch_model_mode_is_restored(data):
+    X, _ = data
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Dropout(0.5), torch.nn.Linear(8, 2))
+    model.train()
+    predictions = predict_in_batches(model, X, chunk_size=16, workers=2)
+    assert model.training
+
+    model.eval()
+    with torch.no_grad():
+        expected = model(torch.from_numpy(X)).numpy()
+    # Predicted without dropout
+    np.testing.assert_allclose(predictions, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_out_is_reused_or_rejected(data):
+    X, y = data
+    model = LinearRegression().fit(X, y)
+    out = np.empty((len(X), 2))
+    assert predict_in_batches(model, X, chunk_size=7, out=out) is out
+    with pytest.raises(ValueError):
+        predict_in_batches(model, X, out=np.empty((len(X), 3)))
+
+
+def test_no_sequences(data):
+    X, y = data
+    model = LinearRegression().fit(X, y)
+    assert predict_in_batches(model, X[:0]).shape == (0,)
+    out = np.empty((0, 2))
+    assert predict_in_batches(model, X[:0], out=out) is out
@@ -0,0 +1,76 @@
+import sqlite3
+
+from conftest import CHAMPION_NAMES, create_raw_table, read_table
+from utils.clean_and_normalize_table import clean_and_normalize_table, rebuild_cleaned_table
+
+
+def test_rebuild_matches_table_built_column_by_column(normalization_config, tmp_path):
+    database_file = str(tmp_path / "combined.db")
+    reference_database = str(tmp_path / "reference.db")
+    create_raw_table(database_file, [1001, 1002, 1003], full_schema=True)
+    create_raw_table(reference_database, [1001, 1002, 1003], full_schema=True)
+    clean_and_normalize_table(reference_database, "champs_cleaned", "champs")
+
+    inserted_rows = rebuild_cleaned_table(database_file, "champs_cleaned", "champs", normalization_config, chunk_size=50)
+
+    rows = read_table(database_file, "champs_cleaned")
+    assert inserted_rows == len(rows) == len(read_table(reference_database, "champs_cleaned"))
+    assert rows == read_table(reference_database, "champs_cleaned")
+
+
+def test_rebuild_keeps_only_filtered_rows_and_creates_indices(tmp_path, normalization_config):
+    database_file = str(tmp_path / "combined.db")
+    kept_rows = create_raw_table(database_file, [1001, 1002])
+
+    assert rebuild_cleaned_table(database_file, "champs_cleaned", "champs", normalization_config, chunk_size=7) == kept_rows
+
+    conn = sqlite3.connect(database_file)
+    indices = [row[1] for row in conn.execute("PRAGMA index_list(champs_cleaned)").fetchall()]
+    min_time, min_pos_x = conn.execute("SELECT MIN(time), MIN(pos_x) FROM champs_cleaned").fetchone()
+    conn.close()
+    assert "champs_cleaned_compound_key_idx" in indices
+    assert min_time > 5 and min_pos_x > 0
+
+
+def test_rebuild_reports_skipped_columns_once(raw_database, normalization_config, capsys):
+    rebuild_cleaned_table(raw_database, "champs_cleaned", "champs", normalization_config, chunk_size=10)
+
+    skipped_lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Skipping normalization")]
+    skipped_columns = [config["column_enum"] for config in normalization_config
+                       if config["column_enum"] not in ["time", "name", "hp", "pos_x", "pos_z"]]
+    assert len(skipped_lines) == len(skipped_columns)
+
+
+def test_categorical_columns_are_looked_up_from_dictionaries(raw_database, normalization_config):
+    cases = next(config["cases"] for config in normalization_config if config["column_enum"] == "name")
+    conn = sqlite3.connect(raw_database)
+    conn.execute("INSERT INTO champs VALUES (1001, 10.0, 'NotAChampion', 100, 1.0, 500.0, 500.0)")
+    conn.commit()
+    conn.close()
+
+    rebuild_cleaned_table(raw_database, "champs_cleaned", "champs", normalization_config)
+
+    conn = sqlite3.connect(raw_database)
+    codes = dict(conn.execute("SELECT DISTINCT name, normalized_name FROM champs_cleaned").fetchall())
+    dictionary = dict(conn.execute("SELECT category, code FROM normalized_name_dictionary").fetchall())
+    conn.close()
+    assert codes == {**{name: cases[name] for name in CHAMPION_NAMES}, "NotAChampion": None}
+    assert dictionary == {str(category): code for category, code in cases.items()}
+
+
+def test_lookup_normalization_reads_existing_table(raw_database, normalization_config):
+    conn = sqlite3.connect(raw_database)
+    conn.execute("CREATE TABLE champion_lookup (champion TEXT PRIMARY KEY, champion_id INTEGER)")
+    conn.executemany("INSERT INTO champion_lookup VALUES (?, ?)", [(name, i + 1) for i, name in enumerate(CHAMPION_NAMES)])
+    conn.commit()
+    conn.close()
+    lookup_config = [config for config in normalization_config if config["column_enum"] != "name"] + [{
+        "column_enum": "name", "normalization_type": "lookup", "lookup_table": "champion_lookup",
+        "key_column": "champion", "value_column": "champion_id"}]
+
+    rebuild_cleaned_table(raw_database, "champs_cleaned", "champs", lookup_config)
+
+    conn = sqlite3.connect(raw_database)
+    codes = dict(conn.execute("SELECT DISTINCT name, normalized_name FROM champs_cleaned").fetchall())
+    conn.close()
+    assert codes == {name: i + 1 for i, name in enumerate(CHAMPION_NAMES)}
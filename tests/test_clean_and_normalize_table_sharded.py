@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+from conftest import create_raw_table, read_table
+from utils.clean_and_normalize_table import rebuild_cleaned_table
+from utils.clean_and_normalize_table_sharded import clean_and_normalize_table_sharded
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_sharded_cleaning_matches_rebuild(tmp_path, normalization_config, shards):
+    database_file = str(tmp_path / "combined.db")
+    reference_database = str(tmp_path / "reference.db")
+    create_raw_table(database_file, [1001, 1002, 1003, 1004])
+    create_raw_table(reference_database, [1001, 1002, 1003, 1004])
+    rebuild_cleaned_table(reference_database, "champs_cleaned", "champs", normalization_config)
+
+    merged_rows = clean_and_normalize_table_sharded(
+        database_file, "champs_cleaned", "champs", shards, normalization_config, shard_folder=str(tmp_path))
+
+    rows = read_table(database_file, "champs_cleaned")
+    assert merged_rows == len(rows)
+    assert rows == read_table(reference_database, "champs_cleaned")
+
+
+def test_sharded_cleaning_replaces_existing_table(raw_database, normalization_config, tmp_path):
+    rebuild_cleaned_table(raw_database, "champs_cleaned", "champs", normalization_config)
+    create_raw_table(raw_database, [1004], seed=1)
+
+    clean_and_normalize_table_sharded(raw_database, "champs_cleaned", "champs", 2, normalization_config, shard_folder=str(tmp_path))
+
+    conn = sqlite3.connect(raw_database)
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+    indices = [row[1] for row in conn.execute("PRAGMA index_list(champs_cleaned)").fetchall()]
+    game_ids = [row[0] for row in conn.execute("SELECT DISTINCT game_id FROM champs_cleaned ORDER BY game_id").fetchall()]
+    conn.close()
+    assert "champs_cleaned_rebuild" not in tables
+    assert "champs_cleaned_compound_key_idx" in indices
+    assert game_ids == [1001, 1002, 1003, 1004]
+    assert list(tmp_path.glob("champs_cleaned_shards_*")) == []
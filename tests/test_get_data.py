@@ -0,0 +1,122 @@
+import gc
+import sqlite3
+
+import numpy as np
+import pytest
+
+from utils import get_data
+from utils.get_data import (COUNT_CACHE_TABLE, create_cache_table, fetch_data_batches, fetch_data_batches_after,
+                            get_count_arrays, get_counts, get_counts_after, get_table_fingerprint)
+
+TABLE_NAME = "champs_cleaned"
+
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 25])
+def test_keyset_pages_match_offset_pages(cursor, trajectory_table, limit):
+    trajectory_table(TABLE_NAME, [5, 8, 3, 6, 9, 4, 7, 5, 6, 3, 8, 4, 5, 6, 7, 2, 9])
+    key_count = len(get_counts(cursor, TABLE_NAME))
+
+    offset = 0
+    continuation_token = None
+    while True:
+        data, continuation_token = fetch_data_batches_after(cursor, TABLE_NAME, "1=1", limit, continuation_token)
+        expected_data = fetch_data_batches(cursor, TABLE_NAME, "1=1", offset, limit) if offset < key_count else []
+        assert len(data) == len(expected_data)
+        for rows, expected_rows in zip(data, expected_data):
+            np.testing.assert_array_equal(rows, expected_rows)
+        offset += len(data)
+        if continuation_token is None:
+            break
+
+    assert offset == key_count
+
+def test_keyset_pages_with_filter(cursor, trajectory_table):
+    trajectories = trajectory_table(TABLE_NAME, [4, 5, 6, 7, 8] * 5)
+    filter = "game_id = 1"
+
+    keys = []
+    continuation_token = None
+    while True:
+        counts, continuation_token = get_counts_after(cursor, TABLE_NAME, filter, 2, continuation_token)
+        keys.extend(key for _, key in counts)
+        if continuation_token is None:
+            break
+    assert keys == sorted(key for key in trajectories if key.startswith("1_"))
+
+
+def test_continuation_token_of_other_filter_is_rejected(cursor, trajectory_table):
+    trajectory_table(TABLE_NAME, [4, 5, 6])
+    _, continuation_token = get_counts_after(cursor, TABLE_NAME, "1=1", 1)
+    with pytest.raises(ValueError):
+        get_counts_after(cursor, TABLE_NAME, "game_id = 0", 1, continuation_token)
+
+
+
+def test_cached_counts_match_counts_and_follow_table_changes(cursor, trajectory_table):
+    trajectory_table(TABLE_NAME, [4, 5, 6])
+    counts, keys = get_count_arrays(cursor, TABLE_NAME)
+
+    # From the database cache
+    get_data.cache.clear()
+    cached_counts, cached_keys = get_count_arrays(cursor, TABLE_NAME)
+    np.testing.assert_array_equal(cached_counts, counts)
+    np.testing.assert_array_equal(cached_keys, keys)
+
+    cursor.execute(f"INSERT INTO {TABLE_NAME} VALUES (0, '0_9', 0, 0.5, 0.5)")
+    cursor.connection.commit()
+    counts, keys = get_count_arrays(cursor, TABLE_NAME)
+    np.testing.assert_array_equal(counts, [4, 5, 6, 1])
+    assert keys[-1] == "0_9"
+
+
+def test_rows_without_compound_key_are_skipped(cursor, trajectory_table):
+    trajectories = trajectory_table(TABLE_NAME, [4, 5, 6])
+    cursor.execute(f"INSERT INTO {TABLE_NAME} VALUES (0, NULL, 0, 0.5, 0.5)")
+    cursor.connection.commit()
+
+    counts, keys = get_count_arrays(cursor, TABLE_NAME)
+    np.testing.assert_array_equal(counts, [4, 5, 6])
+    assert keys.dtype.kind == "U"
+
+    data = fetch_data_batches(cursor, TABLE_NAME, "1=1", 0, 3)
+    keyset_data, _ = fetch_data_batches_after(cursor, TABLE_NAME, "1=1", 3)
+    for rows, keyset_rows, positions in zip(data, keyset_data, trajectories.values()):
+        np.testing.assert_allclose(rows, positions)
+        np.testing.assert_allclose(keyset_rows, positions)
+
+
+def test_fingerprint_memo_does_not_keep_cursors_alive():
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE TABLE {TABLE_NAME} (compound_key TEXT)")
+    get_table_fingerprint(cursor, TABLE_NAME)
+    assert cursor in get_data._fingerprints
+
+    memo_size = len(get_data._fingerprints)
+    del cursor
+    conn.close()
+    gc.collect()
+    assert len(get_data._fingerprints) == memo_size - 1
+
+
+def test_cache_table_migration_adds_row_limit(cursor, trajectory_table):
+    trajectory_table(TABLE_NAME, [4, 5, 6])
+    # Layout of the cache table before entries stored their row limit
+    cursor.execute(f"""
+        CREATE TABLE {COUNT_CACHE_TABLE} (
+            table_name TEXT,
+            query TEXT,
+            fingerprint TEXT,
+            counts BLOB,
+            keys BLOB,
+            PRIMARY KEY (table_name, query)
+        )
+    """)
+
+    create_cache_table(cursor)
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({COUNT_CACHE_TABLE})").fetchall()]
+    assert "row_limit" in columns
+
+    counts, keys = get_count_arrays(cursor, TABLE_NAME, limit=2)
+    np.testing.assert_array_equal(counts, [4, 5])
+    assert cursor.execute(f"SELECT row_limit FROM {COUNT_CACHE_TABLE}").fetchall() == [(2,)]
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+
+from conftest import RAW_COLUMNS, create_raw_table, read_table
+from utils.clean_and_normalize_table import append_new_games, rebuild_cleaned_table
+from utils.get_or_create_combined_database import COMBINED_DATABASE_NAME, MANIFEST_TABLE, get_or_create_combined_database
+
+ORDER_BY = "game_id, name, time"
+COLUMNS = ", ".join(RAW_COLUMNS)
+
+
+def create_source_files(folder, games_per_file):
+    for file_index, game_ids in enumerate(games_per_file):
+        create_raw_table(str(folder / f"source_{file_index}.db"), game_ids, seed=file_index)
+
+
+def test_new_files_are_appended(tmp_path):
+    create_source_files(tmp_path, [[1001], [1002]])
+    combined_db = get_or_create_combined_database(str(tmp_path))
+    assert combined_db == str(tmp_path / COMBINED_DATABASE_NAME)
+
+    create_raw_table(str(tmp_path / "source_2.db"), [1003], seed=2)
+    get_or_create_combined_database(str(tmp_path))
+
+    expected_rows = sorted(row for file_index in range(3) for row in read_table(str(tmp_path / f"source_{file_index}.db"), "champs", ORDER_BY, COLUMNS))
+    assert sorted(read_table(combined_db, "champs", ORDER_BY, COLUMNS)) == expected_rows
+    conn = sqlite3.connect(combined_db)
+    manifest = conn.execute(f"SELECT path, first_rowid, last_rowid, row_count FROM {MANIFEST_TABLE} ORDER BY first_rowid").fetchall()
+    conn.close()
+    assert [row[0] for row in manifest] == ["source_0.db", "source_1.db", "source_2.db"]
+    assert all(last_rowid - first_rowid + 1 == row_count for _, first_rowid, last_rowid, row_count in manifest)
+
+
+def test_changed_files_replace_their_rows_and_cleaned_games(tmp_path, normalization_config):
+    create_source_files(tmp_path, [[1001], [1002, 1003], [1004]])
+    combined_db = get_or_create_combined_database(str(tmp_path))
+    rebuild_cleaned_table(combined_db, "champs_cleaned", "champs", normalization_config)
+
+    # Rewrite a source file with new rows of one of its games
+    os.remove(tmp_path / "source_1.db")
+    create_raw_table(str(tmp_path / "source_1.db"), [1002, 1003], ticks=25, seed=5)
+    get_or_create_combined_database(str(tmp_path))
+    append_new_games(combined_db, "champs_cleaned", "champs", normalization_config)
+
+    reference_folder = tmp_path / "reference"
+    reference_folder.mkdir()
+    for file_index in range(3):
+        os.link(tmp_path / f"source_{file_index}.db", reference_folder / f"source_{file_index}.db")
+    reference_db = get_or_create_combined_database(str(reference_folder))
+    rebuild_cleaned_table(reference_db, "champs_cleaned", "champs", normalization_config)
+
+    assert sorted(read_table(combined_db, "champs", ORDER_BY, COLUMNS)) == sorted(read_table(reference_db, "champs", ORDER_BY, COLUMNS))
+    assert read_table(combined_db, "champs_cleaned", "compound_key, time, pos_x") == read_table(reference_db, "champs_cleaned", "compound_key, time, pos_x")
@@ -0,0 +1,74 @@
+import sqlite3
+
+import numpy as np
+
+from conftest import create_raw_table, read_table
+from utils.clean_and_normalize_table import append_new_games, rebuild_cleaned_table
+from utils.clean_and_normalize_table_sharded import clean_and_normalize_table_sharded
+from utils.get_data import fetch_data_batches, fetch_data_batches_after
+
+
+def read_keys(database_file):
+    # Integer key and the text key it stands for, of every trajectory
+    conn = sqlite3.connect(database_file)
+    keys = conn.execute("""
+        SELECT DISTINCT champs_cleaned.compound_key, trajectory_keys.game_id || '_' || trajectory_keys.team || '_' || trajectory_keys.name
+        FROM champs_cleaned JOIN trajectory_keys ON trajectory_keys.key_id = champs_cleaned.compound_key
+        WHERE trajectory_keys.game_id = champs_cleaned.game_id AND trajectory_keys.team = champs_cleaned.team AND trajectory_keys.name = champs_cleaned.name
+        ORDER BY champs_cleaned.compound_key
+    """).fetchall()
+    conn.close()
+    return dict(keys)
+
+
+def test_integer_keys_stand_for_text_keys(tmp_path, normalization_config):
+    database_file = str(tmp_path / "combined.db")
+    text_database = str(tmp_path / "text.db")
+    create_raw_table(database_file, [1001, 1002])
+    create_raw_table(text_database, [1001, 1002])
+    rebuild_cleaned_table(database_file, "champs_cleaned", "champs", normalization_config, integer_keys=True)
+    rebuild_cleaned_table(text_database, "champs_cleaned", "champs", normalization_config)
+
+    keys = read_keys(database_file)
+    text_keys = [row[0] for row in sqlite3.connect(text_database).execute(
+        "SELECT DISTINCT compound_key FROM champs_cleaned ORDER BY game_id, team, name").fetchall()]
+    # Every row has the key of its own trajectory, numbered in (game_id, team, name) order
+    assert list(keys.values()) == text_keys
+    assert len(read_table(database_file, "champs_cleaned")) == len(read_table(text_database, "champs_cleaned"))
+
+    conn = sqlite3.connect(database_file)
+    cursor = conn.cursor()
+    data = fetch_data_batches(cursor, "champs_cleaned", "1=1", 0, 8)
+    keyset_data, continuation_token = fetch_data_batches_after(cursor, "champs_cleaned", "1=1", 5)
+    keyset_data_after, _ = fetch_data_batches_after(cursor, "champs_cleaned", "1=1", 5, continuation_token)
+    conn.close()
+    assert len(data) == len(keyset_data) + len(keyset_data_after) == 8
+    for rows, keyset_rows in zip(data, list(keyset_data) + list(keyset_data_after)):
+        np.testing.assert_array_equal(rows, keyset_rows)
+
+
+def test_appended_games_keep_existing_keys(raw_database, normalization_config):
+    rebuild_cleaned_table(raw_database, "champs_cleaned", "champs", normalization_config, integer_keys=True)
+    keys = read_keys(raw_database)
+    create_raw_table(raw_database, [1004], seed=1)
+
+    append_new_games(raw_database, "champs_cleaned", "champs", normalization_config)
+
+    appended_keys = read_keys(raw_database)
+    assert {key: appended_keys[key] for key in keys} == keys
+    assert min(set(appended_keys) - set(keys)) > max(keys)
+    assert all(text_key.startswith("1004_") for key, text_key in appended_keys.items() if key not in keys)
+
+
+def test_sharded_integer_keys_match_rebuild(tmp_path, normalization_config):
+    database_file = str(tmp_path / "combined.db")
+    reference_database = str(tmp_path / "reference.db")
+    create_raw_table(database_file, [1001, 1002, 1003])
+    create_raw_table(reference_database, [1001, 1002, 1003])
+    rebuild_cleaned_table(reference_database, "champs_cleaned", "champs", normalization_config, integer_keys=True)
+
+    clean_and_normalize_table_sharded(
+        database_file, "champs_cleaned", "champs", 2, normalization_config, shard_folder=str(tmp_path), integer_keys=True)
+
+    assert read_table(database_file, "champs_cleaned") == read_table(reference_database, "champs_cleaned")
+    assert read_keys(database_file) == read_keys(reference_database)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from utils.model_grid_executor import ModelGridExecutor
+
+
+def scale_rows(context, arrays, task):
+    # Module level, so it can be pickled by reference
+    return task, arrays["X"][task] * context["scale"]
+
+
+def run_tasks(executor, X):
+    return dict(executor.run(scale_rows, {"X": X}, list(range(len(X)))))
+
+
+@pytest.mark.parametrize("start_method", ["fork", "spawn"])
+def test_tasks_run_on_workers(start_method):
+    X = np.arange(12, dtype=np.float32).reshape(4, 3)
+    with ModelGridExecutor({"scale": 2.0}, workers=2, torch_threads=1, start_method=start_method) as executor:
+        assert executor.executor is not None
+        results = run_tasks(executor, X)
+        # The shared arrays are released after every run, a second run shares new ones
+        assert run_tasks(executor, X).keys() == results.keys()
+    for task, row in results.items():
+        np.testing.assert_array_equal(row, X[task] * 2.0)
+
+
+def test_unpicklable_context_runs_in_process():
+    X = np.arange(6, dtype=np.float32).reshape(2, 3)
+    # Lambdas can not be pickled for spawned workers
+    context = {"scale": 3.0, "getter": lambda: None}
+    with ModelGridExecutor(context, workers=1, start_method="spawn") as executor:
+        assert executor.executor is None
+        results = run_tasks(executor, X)
+    np.testing.assert_array_equal(results[1], X[1] * 3.0)
+
+
+def test_unavailable_start_method_runs_in_process():
+    with ModelGridExecutor({"scale": 1.0}, start_method="not_a_start_method") as executor:
+        assert executor.executor is None
+        assert set(run_tasks(executor, np.ones((3, 2)))) == {0, 1, 2}
+
+
+def test_task_exceptions_are_raised():
+    with ModelGridExecutor({"scale": 1.0}, workers=1, start_method="fork") as executor:
+        with pytest.raises(IndexError):
+            list(executor.run(scale_rows, {"X": np.ones((2, 2))}, [0, 5]))
@@ -0,0 +1,116 @@
+import json
+import sqlite3
+
+import numpy as np
+import pytest
+import torch
+from sklearn.linear_model import LinearRegression
+
+from utils.model_registry import REGISTRY_DATABASE_NAME, REGISTRY_TABLE, ModelRegistry, open_model_registry
+from utils.streaming_metrics import ErrorMetrics
+from utils.trajectory_predictor import TrajectoryPredictor
+
+FEATURES = ["normalized_pos_x", "normalized_pos_z"]
+
+
+def get_lstm(H, T):
+    return TrajectoryPredictor((H, len(FEATURES)), len(FEATURES), lstm_units=4), FEATURES, (-1, H, len(FEATURES))
+
+
+MODEL_GETTERS = {"lstm": get_lstm}
+
+
+@pytest.fixture
+def linear_regression():
+    rng = np.random.default_rng(0)
+    X = rng.random((20, 6))
+    return LinearRegression().fit(X, X[:, :2])
+
+
+def test_models_are_saved_and_loaded_lazily(tmp_path, linear_regression):
+    torch.manual_seed(0)
+    lstm = get_lstm(3, 1)[0]
+    registry = ModelRegistry(str(tmp_path))
+    registry.save_model(3, 1, "linear_regression", linear_regression, FEATURES, (-1, 6), [0.5, 0.25], [0.75],
+                        test_error=np.array([1.0, 3.0]), training_size=20)
+    registry.save_model(3, 1, "lstm", lstm, FEATURES, (-1, 3, 2), [0.1], [0.2])
+
+    # A new registry of the folder only reads the index
+    registry = ModelRegistry(str(tmp_path))
+    assert registry.get_keys() == [(3, 1, "linear_regression"), (3, 1, "lstm")]
+    training_errors, validation_errors = registry.get_errors()
+    assert training_errors[(3, 1, "linear_regression")] == [0.5, 0.25]
+    assert validation_errors[(3, 1, "lstm")] == [0.2]
+    assert registry.get_test_error_means() == {(3, 1, "linear_regression"): 2.0}
+    metadata = registry.get_metadata((3, 1, "linear_regression"))
+    assert metadata["input_shape"] == [-1, 6]
+    assert metadata["training_size"] == 20
+
+    models = registry.get_models(MODEL_GETTERS)
+    assert not models.is_loaded((3, 1, "lstm"))
+    loaded_lstm = models[(3, 1, "lstm")]
+    assert models.is_loaded((3, 1, "lstm"))
+    for name, parameter in lstm.state_dict().items():
+        torch.testing.assert_close(loaded_lstm.state_dict()[name], parameter)
+    np.testing.assert_array_equal(models[(3, 1, "linear_regression")].coef_, linear_regression.coef_)
+    np.testing.assert_array_equal(registry.load_test_error((3, 1, "linear_regression")), [1.0, 3.0])
+    assert registry.load_test_error((3, 1, "lstm")) is None
+
+
+def test_saving_a_key_again_replaces_the_model(tmp_path, linear_regression):
+    registry = ModelRegistry(str(tmp_path))
+    registry.save_model(3, 1, "linear_regression", LinearRegression(), FEATURES, (-1, 6), [1.0], [1.0])
+    registry.save_model(3, 1, "linear_regression", linear_regression, FEATURES, (-1, 6), [0.5], [0.5])
+
+    assert registry.get_keys() == [(3, 1, "linear_regression")]
+    assert registry.get_errors()[0] == {(3, 1, "linear_regression"): [0.5]}
+    np.testing.assert_array_equal(registry.get_models({})[(3, 1, "linear_regression")].coef_, linear_regression.coef_)
+
+
+def test_registry_without_test_metrics_column_is_migrated(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / REGISTRY_DATABASE_NAME))
+    conn.execute(f"CREATE TABLE {REGISTRY_TABLE} (H INTEGER, T INTEGER, model_name TEXT, model_class TEXT, "
+                 "artifact_file TEXT, artifact_format TEXT, features TEXT, input_shape TEXT, parameters TEXT, "
+                 "training_error TEXT, validation_error TEXT, test_error_file TEXT, test_error_mean REAL, "
+                 "training_size INTEGER, training_date TEXT, PRIMARY KEY (H, T, model_name))")
+    conn.close()
+
+    registry = ModelRegistry(str(tmp_path))
+    registry.save_model(3, 1, "linear_regression", LinearRegression(), FEATURES, (-1, 6))
+    assert registry.get_metadata((3, 1, "linear_regression"))["test_metrics"] is None
+
+
+def test_legacy_models_are_imported_into_an_empty_registry(tmp_path):
+    torch.manual_seed(0)
+    lstm = get_lstm(3, 1)[0]
+    torch.save(lstm, str(tmp_path / "3_1_lstm.pt"))
+    with open(tmp_path / "3_1_lstm.json", "w") as f:
+        json.dump({"H": 3, "T": 1, "model_type": "lstm", "features": FEATURES, "input_shape": [-1, 3, 2],
+                   "training_error": [0.1], "validation_error": [0.2], "test_error": [0.5, 1.5]}, f)
+
+    registry = open_model_registry(str(tmp_path))
+    assert registry.get_keys() == [(3, 1, "lstm")]
+    assert registry.get_test_error_means() == {(3, 1, "lstm"): 1.0}
+    loaded_lstm = registry.get_models(MODEL_GETTERS)[(3, 1, "lstm")]
+    torch.testing.assert_close(loaded_lstm.fc.weight, lstm.fc.weight)
+    # Opening the registry again does not import the models again
+    assert open_model_registry(str(tmp_path)).get_keys() == [(3, 1, "lstm")]
+
+
+def test_test_metrics_are_stored_in_the_index(tmp_path, linear_regression):
+    rng = np.random.default_rng(1)
+    y_true, y_pred = rng.random((200, 2)), rng.random((200, 2))
+    metrics = ErrorMetrics().update(y_true, y_pred)
+    registry = ModelRegistry(str(tmp_path))
+    registry.save_model(3, 1, "linear_regression", linear_regression, FEATURES, (-1, 6), test_metrics=metrics)
+    # Models saved with per-sequence errors only get metrics computed from the errors
+    registry.save_model(3, 1, "legacy", LinearRegression(), FEATURES, (-1, 6), test_error=np.array([1.0, 3.0]))
+
+    test_metrics = ModelRegistry(str(tmp_path)).get_test_metrics()
+    stored_metrics = test_metrics[(3, 1, "linear_regression")]
+    np.testing.assert_array_equal(stored_metrics.histogram, metrics.histogram)
+    assert stored_metrics.mse == pytest.approx(metrics.mse)
+    assert stored_metrics.quantile(0.9) == pytest.approx(metrics.quantile(0.9))
+    assert registry.get_test_error_means()[(3, 1, "linear_regression")] == pytest.approx(metrics.mean_l2)
+    assert test_metrics[(3, 1, "legacy")].count == 2
+    assert test_metrics[(3, 1, "legacy")].mean_l2 == pytest.approx(2.0)
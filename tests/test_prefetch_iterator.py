@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+from utils.prefetch_iterator import PrefetchIterator
+
+
+def test_items_are_read_in_order():
+    with PrefetchIterator(iter(range(100)), queue_size=3) as items:
+        assert list(items) == list(range(100))
+
+
+def test_source_is_read_on_another_thread():
+    threads = []
+
+    def source():
+        for i in range(3):
+            threads.append(threading.current_thread())
+            yield i
+
+    with PrefetchIterator(source()) as items:
+        list(items)
+    assert all(thread is not threading.current_thread() for thread in threads)
+
+
+def test_source_exceptions_are_raised_from_the_iteration():
+    def source():
+        yield 1
+        raise KeyError("source failed")
+
+    items = PrefetchIterator(source())
+    assert next(items) == 1
+    with pytest.raises(KeyError):
+        next(items)
+    assert not items.thread.is_alive()
+
+
+def test_close_stops_reading_and_closes_the_source():
+    read_items = []
+    closed = threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                read_items.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    items = PrefetchIterator(source(), queue_size=2)
+    assert next(items) == 0
+    items.close()
+
+    assert not items.thread.is_alive()
+    assert closed.is_set()
+    # Only a few items were read ahead
+    assert len(read_items) <= 5
+    with pytest.raises(StopIteration):
+        next(items)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from utils.resample_trajectories import create_lag_tensor, resample_trajectories
+
+
+@pytest.fixture
+def trajectories():
+    # Rows of (time, value, id) of three trajectories with irregular sampling
+    rng = np.random.default_rng(0)
+    lengths = [30, 1, 45]
+    values = []
+    for trajectory_index, length in enumerate(lengths):
+        times = np.sort(rng.uniform(0, 10, length))
+        values.append(np.column_stack((times, np.sin(times) + trajectory_index, np.full(length, trajectory_index + 0.5))))
+    return np.concatenate(values), np.concatenate(([0], np.cumsum(lengths)))
+
+
+def test_resampling_matches_interpolation_per_trajectory(trajectories):
+    values, offsets = trajectories
+    resampled, resampled_offsets = resample_trajectories(values, offsets, 0, 0.25, hold_column_indices=[2])
+
+    assert len(resampled_offsets) == len(offsets)
+    for i in range(len(offsets) - 1):
+        rows = values[offsets[i]:offsets[i + 1]]
+        resampled_rows = resampled[resampled_offsets[i]:resampled_offsets[i + 1]]
+        grid_times = np.arange(np.ceil(rows[0, 0] / 0.25), np.floor(rows[-1, 0] / 0.25) + 1) * 0.25
+        np.testing.assert_allclose(resampled_rows[:, 0], grid_times, rtol=1e-6)
+        np.testing.assert_allclose(resampled_rows[:, 1], np.interp(grid_times, rows[:, 0], rows[:, 1]), rtol=1e-5, atol=1e-5)
+        np.testing.assert_array_equal(resampled_rows[:, 2], np.float32(i + 0.5))
+
+
+def test_unordered_rows_are_rejected(trajectories):
+    values, offsets = trajectories
+    values = values[[0, 1, 2, 3, 5, 4, *range(6, len(values))]]
+    with pytest.raises(ValueError):
+        resample_trajectories(values, offsets, 0, 0.25)
+
+
+@pytest.mark.parametrize("lags,lag_stride,window_step", [(1, 1, 1), (3, 4, 2), (5, 2, 3)])
+def test_lag_windows_are_views_of_the_rows(trajectories, lags, lag_stride, window_step):
+    values, offsets = trajectories
+    windows, starts = create_lag_tensor(values, offsets, lags, lag_stride, window_step)
+
+    assert np.shares_memory(windows, values)
+    expected_starts = [start for i in range(len(offsets) - 1)
+                       for start in range(offsets[i], offsets[i + 1] - (lags - 1) * lag_stride, window_step)]
+    np.testing.assert_array_equal(starts, expected_starts)
+    expected_windows = np.stack([values[start + np.arange(lags) * lag_stride] for start in expected_starts])
+    np.testing.assert_array_equal(windows[starts], expected_windows)
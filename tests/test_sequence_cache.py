@@ -0,0 +1,97 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from conftest import create_trajectory_table
+from utils.create_sequences_in_batches import create_sequences_from_database_rows
+from utils.get_data import fetch_data_batches
+from utils.sequence_cache import SEQUENCE_CACHE_INDEX_NAME, SequenceCache, get_cached_sequences
+
+FEATURES = ["normalized_pos_x", "normalized_pos_z"]
+
+
+def get_arrays(value, rows=10):
+    # 80 bytes per entry
+    return {"X": np.full(rows, value, dtype=np.float64)}
+
+
+def test_entries_are_loaded_memory_mapped(tmp_path):
+    cache = SequenceCache(str(tmp_path / "cache"))
+    cache.put("a", {"X": np.arange(6).reshape(2, 3), "y": np.ones(2)}, {"rows": 2})
+
+    arrays, metadata = cache.get("a")
+    assert isinstance(arrays["X"], np.memmap)
+    assert not arrays["X"].flags.writeable
+    np.testing.assert_array_equal(arrays["X"], np.arange(6).reshape(2, 3))
+    assert metadata == {"rows": 2}
+    assert cache.get("b") is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = SequenceCache(str(tmp_path / "cache"), max_bytes=200)
+    cache.put("a", get_arrays(1))
+    cache.put("b", get_arrays(2))
+    cache.get("a")
+    cache.put("c", get_arrays(3))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.get_size() == 160
+    # Entries over the cap are not stored
+    cache.put("d", get_arrays(4, rows=100))
+    assert cache.get("d") is None
+
+
+def test_replaced_entries_stay_readable(tmp_path):
+    cache = SequenceCache(str(tmp_path / "cache"))
+    cache.put("a", get_arrays(1))
+    previous_arrays, _ = cache.get("a")
+    previous_folder = cache.get_entry_folder("a")
+    cache.put("a", get_arrays(2))
+
+    np.testing.assert_array_equal(previous_arrays["X"], 1)
+    np.testing.assert_array_equal(cache.get("a")[0]["X"], 2)
+    assert not os.path.exists(previous_folder)
+    assert cache.get_size() == 80
+
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.get_size() == 0
+
+
+def test_unversioned_index_is_migrated(tmp_path):
+    folder = tmp_path / "cache"
+    os.makedirs(folder / "a")
+    np.save(folder / "a" / "X.npy", np.ones(3))
+    (folder / "a" / "metadata.json").write_text("{}")
+    conn = sqlite3.connect(str(folder / SEQUENCE_CACHE_INDEX_NAME))
+    conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, size INTEGER, last_access REAL, created REAL)")
+    conn.execute("INSERT INTO entries VALUES ('a', 24, 0, 0)")
+    conn.commit()
+    conn.close()
+
+    cache = SequenceCache(str(folder))
+    np.testing.assert_array_equal(cache.get("a")[0]["X"], np.ones(3))
+
+
+def test_cached_sequences_follow_the_table(tmp_path, cursor):
+    conn = sqlite3.connect(str(tmp_path / "trajectories.db"))
+    table_cursor = conn.cursor()
+    create_trajectory_table(table_cursor, "trajectories", [30, 40, 50])
+    cache = SequenceCache(str(tmp_path / "cache"))
+
+    X, y = get_cached_sequences(table_cursor, "trajectories", "1=1", 0, 3, FEATURES, 5, 2, cache=cache)
+    expected_X, expected_y = create_sequences_from_database_rows(
+        fetch_data_batches(table_cursor, "trajectories", "1=1", 0, 3, FEATURES), 5, 2)
+    np.testing.assert_array_equal(X, expected_X)
+    np.testing.assert_array_equal(y, expected_y)
+    # Read from the cache the second time
+    assert isinstance(get_cached_sequences(table_cursor, "trajectories", "1=1", 0, 3, FEATURES, 5, 2, cache=cache)[0], np.memmap)
+
+    # The fingerprint of the table changes with its rows, e.g. when it is recreated
+    table_cursor.execute("DELETE FROM trajectories WHERE time >= 20")
+    conn.commit()
+    X_changed, _ = get_cached_sequences(table_cursor, "trajectories", "1=1", 0, 3, FEATURES, 5, 2, cache=cache)
+    assert len(X_changed) < len(X)
+    conn.close()
@@ -0,0 +1,98 @@
+import sqlite3
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from conftest import create_trajectory_table
+from utils import streaming_linear_regression
+from utils.compare_models import compare_models
+from utils.streaming_linear_regression import StreamingLinearRegression, StreamingLinearRegressionGrid, fit_linear_regression_grid
+from utils.windowed_sequence_dataset import create_ragged_windowed_dataset
+
+DEFAULT_FEATURES = ["normalized_pos_x", "normalized_pos_z"]
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.default_rng(0)
+    lengths = [40, 55, 35, 60]
+    values = np.cumsum(rng.normal(size=(sum(lengths), 3)), axis=0).astype(np.float32)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    return create_ragged_windowed_dataset(values, offsets, 4, 3)
+
+
+def test_partial_fit_matches_linear_regression():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(500, 6))
+    y = X @ rng.normal(size=(6, 2)) + 0.1 * rng.normal(size=(500, 2)) + 3.0
+
+    model = StreamingLinearRegression()
+    for batch_start in range(0, len(X), 64):
+        model.partial_fit(X[batch_start:batch_start + 64], y[batch_start:batch_start + 64])
+    expected_model = LinearRegression().fit(X, y)
+
+    np.testing.assert_allclose(model.coef_, expected_model.coef_, atol=1e-8)
+    np.testing.assert_allclose(model.intercept_, expected_model.intercept_, atol=1e-8)
+    np.testing.assert_allclose(model.predict(X), expected_model.predict(X), atol=1e-8)
+
+
+@pytest.mark.parametrize("fit_intercept", [True, False])
+def test_grid_matches_linear_regression_per_horizon(dataset, fit_intercept):
+    H_values, T_values = [1, 2, 4], [1, 3]
+    grid = StreamingLinearRegressionGrid(H_values, T_values, fit_intercept)
+    # Small batches, so the sums of several batches are accumulated
+    grid.partial_fit(dataset, batch_size=50)
+
+    for H in H_values:
+        for T in T_values:
+            X, y = dataset.with_horizon(H, T).to_arrays()
+            X = X.reshape(len(X), -1).astype(np.float64)
+            expected_model = LinearRegression(fit_intercept=fit_intercept).fit(X, y)
+            model = grid.get_model(H, T)
+            np.testing.assert_allclose(model.predict(X), expected_model.predict(X), rtol=1e-6, atol=1e-6)
+            expected_mse = np.mean((expected_model.predict(X) - y) ** 2)
+            assert model.mean_squared_error() == pytest.approx(expected_mse, rel=1e-6)
+
+
+@pytest.fixture
+def database_file(tmp_path, cursor):
+    database_file = str(tmp_path / "trajectories.db")
+    conn = sqlite3.connect(database_file)
+    create_trajectory_table(conn.cursor(), "trajectories", [30 + 7 * index for index in range(12)])
+    conn.close()
+    return database_file
+
+
+def test_compare_models_creates_streaming_models_once(database_file):
+    H_values, T_values = [1, 3], [1, 2]
+    created = {}
+
+    def get_streaming_model(H, T):
+        created[(H, T)] = StreamingLinearRegression()
+        return created[(H, T)], DEFAULT_FEATURES, (-1, H * len(DEFAULT_FEATURES))
+
+    trained_models, _, validation_errors = compare_models(
+        database_file, "trajectories", H_values, T_values, {"linear_regression": get_streaming_model},
+        total_keys_to_fetch=12, batch_size=4, lazy=True)
+
+    # One model per cell, created on the first batch and continued on all three batches
+    assert len(created) == len(H_values) * len(T_values)
+    assert all(len(errors) == 3 for errors in validation_errors.values())
+    for (H, T), model in created.items():
+        assert trained_models[(H, T, "linear_regression")] is model
+
+
+def test_fit_linear_regression_grid_closes_batches_on_errors(monkeypatch):
+    closed = []
+
+    def iter_failing_batches(*args, **kwargs):
+        try:
+            yield None, None, None
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(streaming_linear_regression, "iter_sequence_batches", iter_failing_batches)
+    with pytest.raises(TypeError):
+        fit_linear_regression_grid("unused.db", "trajectories", [1], [1])
+    assert closed == [True]
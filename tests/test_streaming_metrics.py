@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from utils.streaming_metrics import ErrorMetrics, TDigest
+
+QUANTILES = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+
+
+def get_rank_error(values, estimates, quantiles):
+    # Difference between the quantile and the fraction of the values below the estimate
+    values = np.sort(values)
+    return np.abs(np.searchsorted(values, estimates) / len(values) - np.asarray(quantiles))
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "exponential", "lognormal"])
+def test_quantile_rank_error(distribution):
+    rng = np.random.default_rng(0)
+    values = getattr(rng, distribution)(size=100000)
+    digest = TDigest()
+    for batch in np.array_split(values, 50):
+        digest.update(batch)
+
+    assert len(digest.means) <= digest.compression
+    assert get_rank_error(values, digest.quantile(QUANTILES), QUANTILES).max() < 0.005
+    assert digest.quantile(0) == values.min()
+    assert digest.quantile(1) == values.max()
+
+
+def test_merged_digests_match_one_digest():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(size=50000)
+    digests = [TDigest().update(batch) for batch in np.array_split(values, 8)]
+    merged_digest = digests[0]
+    for digest in digests[1:]:
+        merged_digest.merge(digest)
+
+    assert merged_digest.count == len(values)
+    assert get_rank_error(values, merged_digest.quantile(QUANTILES), QUANTILES).max() < 0.005
+
+
+def test_error_metrics_match_exact_metrics():
+    rng = np.random.default_rng(2)
+    y_true = rng.random((2000, 2))
+    y_pred = y_true + 0.1 * rng.normal(size=(2000, 2))
+    metrics = ErrorMetrics()
+    for batch_start in range(0, len(y_true), 300):
+        metrics.update(y_true[batch_start:batch_start + 300], y_pred[batch_start:batch_start + 300])
+    metrics.update(np.empty((0, 2)), np.empty((0, 2)))
+
+    distances = np.linalg.norm(y_true - y_pred, axis=1)
+    assert metrics.count == len(y_true)
+    assert metrics.mse == pytest.approx(np.mean((y_true - y_pred) ** 2))
+    assert metrics.mean_l2 == pytest.approx(distances.mean())
+    assert abs(metrics.quantile(0.5) - np.median(distances)) < 0.01 * np.median(distances)
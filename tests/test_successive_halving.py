@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.successive_halving import get_rung_epochs, successive_halving
+from utils.trajectory_predictor import TrajectoryPredictor
+
+H, T = 3, 1
+FEATURES = ["normalized_pos_x", "normalized_pos_z"]
+
+
+def get_model_getter(learning_rate):
+    def get_model(H, T):
+        parameters = {"epochs": 1, "batch_size": 32, "learning_rate": learning_rate, "dropout_rate": 0.0}
+        return TrajectoryPredictor((H, len(FEATURES)), len(FEATURES), lstm_units=4, parameters=parameters), FEATURES, (-1, H, len(FEATURES))
+    return get_model
+
+
+@pytest.fixture
+def sequences():
+    rng = np.random.default_rng(0)
+    X = rng.random((96, H, len(FEATURES))).astype(np.float32)
+    # The next position continues the last step
+    y = 2 * X[:, -1] - X[:, -2]
+    return X[:64], y[:64], X[64:], y[64:]
+
+
+@pytest.fixture
+def model_getters():
+    torch.manual_seed(0)
+    return {f"lr_{learning_rate}": get_model_getter(learning_rate) for learning_rate in [0.0, 0.001, 0.01, 0.05]}
+
+
+def test_rung_epochs():
+    assert get_rung_epochs(1, 10, 3) == [1, 3, 9, 10]
+    assert get_rung_epochs(1, 3, 3) == [1, 3]
+
+
+def test_only_the_best_trials_are_trained_further(sequences, model_getters):
+    best_name, best_model, results = successive_halving(
+        model_getters, H, T, *sequences, min_epochs=1, max_epochs=3, reduction_factor=3, patience=None)
+
+    # A quarter of the trials survives the first rung
+    assert sorted(result["epochs"] for result in results.values()) == [1, 1, 1, 3]
+    assert best_name == min(results, key=lambda name: results[name]["best_validation_loss"])
+    assert results["lr_0.0"]["epochs"] == 1
+    assert isinstance(best_model, TrajectoryPredictor)
+
+
+def test_interrupted_sweep_continues_from_checkpoints(sequences, model_getters, tmp_path):
+    checkpoint_folder = str(tmp_path / "sweep")
+    _, _, results = successive_halving(
+        model_getters, H, T, *sequences, min_epochs=1, max_epochs=3, reduction_factor=3, patience=None,
+        max_concurrent_trials=2, checkpoint_folder=checkpoint_folder)
+
+    # All rungs are done, so the trials are only loaded from their checkpoints
+    _, _, resumed_results = successive_halving(
+        model_getters, H, T, *sequences, min_epochs=1, max_epochs=3, reduction_factor=3, patience=None,
+        checkpoint_folder=checkpoint_folder)
+    assert resumed_results == results
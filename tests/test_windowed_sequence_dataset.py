@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from utils.create_sequences_in_batches import calculate_sequences_in_batches, create_sequences
+from utils.windowed_sequence_dataset import create_ragged_windowed_dataset, create_windowed_dataset_from_database_rows
+
+
+def create_baseline_sequences(data, H, T, max_H, max_T):
+    # Windows of every trajectory cut to the shortest one, like the original create_sequences_from_database_rows
+    max_row_amount = min(len(rows) for rows in data)
+    X_list, y_list = [], []
+    for rows in data:
+        equilength_rows = np.array(rows[:max_row_amount])[max_H - H:-(max_T - T + 1)]
+        X, y = create_sequences(equilength_rows, H, T)
+        X_list.append(X)
+        y_list.append(y)
+    return np.concatenate(X_list).astype(np.float32), np.concatenate(y_list).astype(np.float32)
+
+
+@pytest.fixture
+def data():
+    # Rows per key as lists of rows, like fetch_data_batches
+    rng = np.random.default_rng(0)
+    row_counts = [30, 24, 27, 40]
+    data = np.empty(len(row_counts), dtype=object)
+    for i, row_count in enumerate(row_counts):
+        data[i] = rng.random((row_count, 3)).tolist()
+    return data
+
+
+@pytest.mark.parametrize("H,T", [(1, 1), (3, 2), (5, 4), (2, 4)])
+def test_windows_match_create_sequences(data, H, T):
+    max_H, max_T = 5, 4
+    X, y = create_windowed_dataset_from_database_rows(data, H, T, max_H, max_T).to_arrays()
+    X_expected, y_expected = create_baseline_sequences(data, H, T, max_H, max_T)
+    np.testing.assert_array_equal(X, X_expected)
+    np.testing.assert_array_equal(y, y_expected)
+
+
+def test_with_horizon_matches_new_dataset(data):
+    base_dataset = create_windowed_dataset_from_database_rows(data, 5, 4)
+    for H, T in [(2, 1), (5, 3)]:
+        X, y = base_dataset.with_horizon(H, T).to_arrays()
+        X_expected, y_expected = create_windowed_dataset_from_database_rows(data, H, T, 5, 4).to_arrays()
+        np.testing.assert_array_equal(X, X_expected)
+        np.testing.assert_array_equal(y, y_expected)
+
+
+def test_ragged_windows_match_create_sequences(data):
+    H, T = 3, 2
+    lengths = [len(rows) for rows in data]
+    values = np.concatenate([np.asarray(rows, dtype=np.float32) for rows in data])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    X, y = create_ragged_windowed_dataset(values, offsets, H, T).to_arrays()
+
+    sequences = [create_sequences(np.asarray(rows, dtype=np.float32), H, T) for rows in data]
+    np.testing.assert_array_equal(X, np.concatenate([X_key for X_key, _ in sequences]))
+    np.testing.assert_array_equal(y, np.concatenate([y_key for _, y_key in sequences]))
+
+
+def test_too_short_trajectories_give_no_windows(data):
+    dataset = create_windowed_dataset_from_database_rows(data, 10, 10, 20, 10)
+    assert len(dataset) == 0
+
+
+def test_calculate_sequences_in_batches_shares_one_split(data):
+    sequences = calculate_sequences_in_batches([2, 5], [1, 4], data, random_state=0, show_progress=False)
+
+    X_train, X_test, y_train, y_test = sequences[(5, 4)]
+    X_expected, _ = create_baseline_sequences(data, 5, 4, 5, 4)
+    assert len(X_train) + len(X_test) == len(X_expected)
+    # Every (H, T) has the same windows in the training set, ending at the same rows
+    np.testing.assert_array_equal(sequences[(2, 4)][0], X_train[:, 3:])
+    np.testing.assert_array_equal(sequences[(5, 1)][0], X_train)
+    assert not np.array_equal(sequences[(5, 1)][2], y_train)
+
+
+def test_batch_size_is_deprecated(data):
+    with pytest.warns(DeprecationWarning):
+        calculate_sequences_in_batches([2], [1], data, 100, show_progress=False)
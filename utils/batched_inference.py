@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Bytes of input per chunk, small enough for the activations of a chunk to stay in the caches
+DEFAULT_CHUNK_BYTES = 1 << 20
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 16384
+
+
+def is_torch_model(model):
+    return torch is not None and isinstance(model, torch.nn.Module)
+
+
+def get_chunk_size(X, workers=1, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Choose the amount of sequences predicted at a time: about chunk_bytes of input per chunk,
+    but small enough that every worker gets at least one chunk.
+    """
+    row_bytes = max(X[:1].nbytes, 1)
+    chunk_size = min(max(chunk_bytes // row_bytes, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    return max(min(chunk_size, -(-len(X) // workers)), 1)
+
+
+def _predict_torch_chunk(model, X_chunk):
+    X_tensor = torch.from_numpy(np.ascontiguousarray(X_chunk, dtype=np.float32))
+    with torch.inference_mode():
+        return model(X_tensor.to(getattr(model, "device", "cpu"))).cpu().numpy()
+
+
+def _predict_chunk(model, X_chunk):
+    if is_torch_model(model):
+        return _predict_torch_chunk(model, X_chunk)
+    return np.asarray(model.predict(X_chunk))
+
+
+def predict_in_batches(model, X, chunk_size=None, workers=None, out=None):
+    """
+    Predict all sequences of X in chunks, instead of one predict call per sequence.
+
+    Works with TrajectoryPredictor (and other torch modules, run in eval mode under torch.inference_mode) and
+    with sklearn style models with a predict method. The chunks are predicted on a thread pool, as torch and
+    numpy release the GIL, and written straight into one preallocated output array. The intra-op threads of
+    torch are shared between the workers during the call, so the cores are not oversubscribed.
+
+    Args:
+        model: TrajectoryPredictor, torch.nn.Module or a model with a predict method
+        X (np.ndarray): Inputs, already in the input shape of the model
+        chunk_size (int): Sequences per chunk, chosen by get_chunk_size by default
+        workers (int): Threads predicting chunks, the torch threads or all cores by default
+        out (np.ndarray): Output array to write the predictions into, reused between calls of the same shape
+
+    Returns:
+        np.ndarray: The predictions of all sequences, in the order of X. Without sequences, out or an empty
+        one-dimensional array, as the output shape is not known without a prediction
+
+    Raises:
+        ValueError: If out does not have the shape of the predictions
+    """
+    if len(X) == 0:
+        if out is not None and len(out) != 0:
+            raise ValueError(f"out has {len(out)} rows, but X has no sequences")
+        return out if out is not None else np.empty(0)
+    if workers is None:
+        workers = torch.get_num_threads() if is_torch_model(model) else os.cpu_count() or 1
+    chunk_size = chunk_size or get_chunk_size(X, workers)
+    chunk_starts = range(0, len(X), chunk_size)
+
+    torch_threads = None
+    was_training = None
+    if is_torch_model(model):
+        # Evaluated in eval mode, the mode of the caller is restored afterwards
+        was_training = model.training
+        model.eval()
+        model.to(getattr(model, "device", "cpu"))
+        torch_threads = torch.get_num_threads()
+        torch.set_num_threads(max(torch_threads // workers, 1))
+
+    try:
+        # The first chunk gives the shape of the output
+        first_prediction = _predict_chunk(model, X[:chunk_size])
+        output_shape = (len(X),) + first_prediction.shape[1:]
+        if out is None:
+            out = np.empty(output_shape, dtype=first_prediction.dtype)
+        elif out.shape != output_shape:
+            raise ValueError(f"out has shape {out.shape}, but the predictions have shape {output_shape}")
+        out[:len(first_prediction)] = first_prediction
+
+        def predict_into_output(chunk_start):
+            out[chunk_start:chunk_start + chunk_size] = _predict_chunk(model, X[chunk_start:chunk_start + chunk_size])
+
+        if workers > 1 and len(chunk_starts) > 2:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(predict_into_output, chunk_starts[1:]))
+        else:
+            for chunk_start in chunk_starts[1:]:
+                predict_into_output(chunk_start)
+    finally:
+        if torch_threads is not None:
+            torch.set_num_threads(torch_threads)
+        if was_training is not None:
+            model.train(was_training)
+    return out
@@ -1,43 +1,346 @@
 import sqlite3
 import json
-from utils.create_compound_key_and_index import create_compound_key_and_index
-from utils.get_data import clear_cache
+import time
+from tqdm import tqdm
+from utils.create_compound_key_and_index import create_compound_key_and_index, get_compound_key_expression, get_integer_compound_key_expression, has_integer_compound_key, insert_trajectory_keys
+from utils.get_data import clear_cache, get_table_fingerprint, invalidate_cache_for_new_keys
+from utils.sqlite_pragmas import BULK_LOAD_PRAGMAS, apply_pragmas, restore_pragmas
 from constants import GAME_AREA_WIDTH, DB_columns
 
 def get_normalized_column_name(column_enum):
     return f"normalized_{column_enum.value.lower()}"
 
-def normalize_column(cursor, table_name, config):
+def get_dictionary_table_name(column_enum):
+    return f"{get_normalized_column_name(column_enum)}_dictionary"
+
+def get_lookup_expression(column_name, lookup_table, key_column, value_column):
+    """
+    SQL expression looking up the value of a column from a lookup table, NULL when the column value is not found.
+    The key column must be indexed (e.g. PRIMARY KEY or UNIQUE) for the lookup to be a single index search.
+    """
+    return f"(SELECT {lookup_table}.{value_column} FROM {lookup_table} WHERE {lookup_table}.{key_column} = {column_name})"
+
+def create_normalization_dictionaries(cursor, normalization_config):
+    """
+    Create a dictionary table for every categorical ("case") normalization config, mapping the values of
+    the column to their codes. Categorical columns are normalized with an index lookup into these tables
+    instead of a CASE with one branch per category.
+    """
+    for config in normalization_config:
+        if config["normalization_type"] != "case":
+            continue
+        dictionary_table_name = get_dictionary_table_name(DB_columns[config["column_enum"].upper()])
+        # Qualified with main, so a shard with the source database attached does not resolve them to the source
+        cursor.execute(f"DROP TABLE IF EXISTS main.{dictionary_table_name}")
+        cursor.execute(f"""
+            CREATE TABLE main.{dictionary_table_name} (
+                category TEXT PRIMARY KEY,
+                code INTEGER
+            ) WITHOUT ROWID
+        """)
+        cursor.executemany(
+            f"INSERT INTO main.{dictionary_table_name} (category, code) VALUES (?, ?)",
+            ((str(key), value) for key, value in config["cases"].items())
+        )
+
+def get_normalization_expression(config):
+    """
+    Get the SQL expression and column type of a normalized column from its normalization config.
+    Categorical ("case" and "lookup") expressions contain a subquery, so they can not be used in generated columns.
+
+    Returns:
+        tuple: (column_enum, expression, column_type)
+    """
     column_enum = DB_columns[config["column_enum"].upper()]
     column_name = column_enum.value
-    normalized_column_name = get_normalized_column_name(column_enum)
     normalization_type = config["normalization_type"]
-    
+
     if normalization_type == "expression":
         normalization_expression = config["normalization_expression"].format(
             column_name=column_name,
             **config["parameters"]
         )
-        cursor.execute(
-            f"ALTER TABLE {table_name} ADD COLUMN {normalized_column_name} FLOAT GENERATED ALWAYS AS ({normalization_expression}) STORED"
-        )
+        return column_enum, normalization_expression, "FLOAT"
     elif normalization_type == "case":
-        case_statement = "CASE "
-        for key, value in config["cases"].items():
-            case_statement += f"WHEN {column_name} = '{key}' THEN {value} "
-        case_statement += "ELSE NULL END"
-        cursor.execute(
-            f"ALTER TABLE {table_name} ADD COLUMN {normalized_column_name} INTEGER GENERATED ALWAYS AS ({case_statement}) STORED"
-        )
+        # The cases are stored in a dictionary table, see create_normalization_dictionaries
+        return column_enum, get_lookup_expression(column_name, get_dictionary_table_name(column_enum), "category", "code"), "INTEGER"
+    elif normalization_type == "lookup":
+        # Look up the codes from an existing table, e.g. champion_lookup
+        return column_enum, get_lookup_expression(
+            column_name, config["lookup_table"], config["key_column"], config["value_column"]), "INTEGER"
+    raise ValueError(f"Unknown normalization type: {normalization_type}")
+
+def normalize_column(cursor, table_name, config):
+    column_enum, normalization_expression, column_type = get_normalization_expression(config)
+    normalized_column_name = get_normalized_column_name(column_enum)
+    if config["normalization_type"] in ["case", "lookup"]:
+        # Categorical columns are filled with a lookup at insert time, see get_cleaned_insert_query
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {normalized_column_name} {column_type}")
+        return
+    cursor.execute(
+        f"ALTER TABLE {table_name} ADD COLUMN {normalized_column_name} {column_type} GENERATED ALWAYS AS ({normalization_expression}) STORED"
+    )
+
+def get_filter_conditions():
+    """
+    SQL condition for the rows of the raw table that are kept in the cleaned table.
+    """
+    filter_conditions = [
+        f"{DB_columns.NAME.value} IS NOT ''",
+        f"{DB_columns.TIME.value} > 5",
+        f"{DB_columns.POS_X.value} > 0",
+        f"{DB_columns.POS_X.value} < {GAME_AREA_WIDTH}",
+        f"{DB_columns.POS_Z.value} > 0",
+        f"{DB_columns.POS_Z.value} < {GAME_AREA_WIDTH}"
+    ]
+    return " AND ".join(filter_conditions)
+
+def create_cleaned_table_indices(cursor, table_name):
+    """
+    Create the indices of a cleaned table. Called once the data has been loaded.
+    """
+    columns_to_be_indexed = [DB_columns.NAME, DB_columns.GAME_ID]
+
+    for column_enum in columns_to_be_indexed:
+        cursor.execute(f"DROP INDEX IF EXISTS {table_name}_{column_enum.value.lower()}_index")
+        cursor.execute(f"CREATE INDEX {table_name}_{column_enum.value.lower()}_index ON {table_name}({column_enum.value})")
+
+    cursor.execute(f"DROP INDEX IF EXISTS {table_name}_{DB_columns.COMPOUND_KEY.value}_idx")
+    cursor.execute(f"CREATE INDEX {table_name}_{DB_columns.COMPOUND_KEY.value}_idx ON {table_name}({DB_columns.COMPOUND_KEY.value})")
+
+def get_normalized_columns(cursor, tlol_db_table_name, normalization_config, report_skipped=False):
+    """
+    Get the normalized columns of the normalization configs whose column exists in the source table.
+    With report_skipped the configs of missing columns are printed, the inserts call this once per chunk so they do not.
+
+    Returns:
+        list: (normalized_column_name, expression, column_type) tuples
+    """
+    source_columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({tlol_db_table_name})").fetchall()]
+
+    normalized_columns = []
+    for config in normalization_config:
+        column_enum, normalization_expression, column_type = get_normalization_expression(config)
+        if column_enum.value not in source_columns:
+            if report_skipped:
+                print(f"Skipping normalization of {column_enum.value}, column not found in {tlol_db_table_name}")
+            continue
+        normalized_columns.append((get_normalized_column_name(column_enum), normalization_expression, column_type))
+    return normalized_columns
+
+def create_cleaned_table(cursor, table_name, tlol_db_table_name, normalization_config, integer_keys=False, report_skipped=True):
+    """
+    Create an empty cleaned table with plain columns for the normalized values and the compound key.
+    With integer_keys the compound key is an INTEGER surrogate key from the trajectory_keys table.
+    With report_skipped the normalization configs of columns missing from the source table are printed.
+    """
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    cursor.execute(f"CREATE TABLE {table_name} AS SELECT * FROM {tlol_db_table_name} WHERE 1=0")
+    create_normalization_dictionaries(cursor, normalization_config)
+    for normalized_column_name, _, column_type in get_normalized_columns(cursor, tlol_db_table_name, normalization_config, report_skipped):
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {normalized_column_name} {column_type}")
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {DB_columns.COMPOUND_KEY.value} {'INTEGER' if integer_keys else 'TEXT'}")
+
+def get_cleaned_insert_query(cursor, table_name, tlol_db_table_name, normalization_config, condition="1=1"):
+    """
+    Build an INSERT ... SELECT filling the stored columns of an existing cleaned table from the source table.
+    Generated columns of tables created by the non-bulk path are left for SQLite to compute.
+    Tables with an INTEGER compound key get their keys from the trajectory_keys table, see insert_cleaned_rows.
+
+    Args:
+        condition (str): Additional SQL condition on the source rows, combined with the cleaning filter
+    """
+    source_columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({tlol_db_table_name})").fetchall()]
+
+    select_expressions = {column: column for column in source_columns}
+    for normalized_column_name, normalization_expression, _ in get_normalized_columns(cursor, tlol_db_table_name, normalization_config):
+        select_expressions[normalized_column_name] = normalization_expression
+    if has_integer_compound_key(cursor, table_name):
+        select_expressions[DB_columns.COMPOUND_KEY.value] = get_integer_compound_key_expression(tlol_db_table_name)
+    else:
+        select_expressions[DB_columns.COMPOUND_KEY.value] = get_compound_key_expression()
+
+    # Hidden columns (generated columns) are computed by SQLite
+    target_columns = [column[1] for column in cursor.execute(f"PRAGMA table_xinfo({table_name})").fetchall() if column[6] == 0]
+    missing_columns = [column for column in target_columns if column not in select_expressions]
+    if missing_columns:
+        raise ValueError(f"No source for columns {missing_columns} of {table_name}")
+
+    return f"""
+        INSERT INTO {table_name} ({','.join(target_columns)})
+        SELECT {','.join(select_expressions[column] for column in target_columns)}
+        FROM {tlol_db_table_name}
+        WHERE ({condition}) AND {get_filter_conditions()}
+    """
+
+def insert_cleaned_rows(cursor, table_name, tlol_db_table_name, normalization_config, condition="1=1"):
+    """
+    Clean, normalize and insert the source rows matching the condition into an existing cleaned table.
+    For tables with an INTEGER compound key, keys are first assigned to the new (game_id, team, name) combinations.
+
+    Returns:
+        int: The amount of inserted rows
+    """
+    if has_integer_compound_key(cursor, table_name):
+        insert_trajectory_keys(cursor, tlol_db_table_name, f"({condition}) AND {get_filter_conditions()}")
+    cursor.execute(get_cleaned_insert_query(cursor, table_name, tlol_db_table_name, normalization_config, condition))
+    return cursor.rowcount
+
+def rebuild_cleaned_table(database_file, table_name, tlol_db_table_name, normalization_config, chunk_size=1000000, pragmas=BULK_LOAD_PRAGMAS, before_load=None, integer_keys=False):
+    """
+    Rebuild a cleaned table in a single connection and transaction, tuned for bulk loading.
+
+    The normalized columns and the compound key are computed in the INSERT ... SELECT, so every row
+    is written once, and the indices are built after all the data has been loaded.
+    The source table is copied in rowid chunks, reporting the throughput in rows per second.
+
+    Args:
+        database_file (str): Path to the SQLite database
+        table_name (str): The cleaned table to rebuild
+        tlol_db_table_name (str): The raw table to read from
+        normalization_config (list): Normalization configs, in the format of normalization_config.json
+        chunk_size (int): Amount of source rowids copied per INSERT
+        pragmas (dict): Pragmas applied for the duration of the rebuild
+        before_load (callable): Called with the cursor inside the transaction, before the table is created
+        integer_keys (bool): Store the compound key as an INTEGER surrogate key instead of text
+    """
+    conn = sqlite3.connect(database_file, isolation_level=None)
+    cursor = conn.cursor()
+
+    # Clear cached counts of the table being rebuilt
+    clear_cache(cursor, table_name)
+
+    previous_pragmas = apply_pragmas(cursor, pragmas)
+    cursor.execute("BEGIN")
+    try:
+        if before_load is not None:
+            before_load(cursor)
+
+        create_cleaned_table(cursor, table_name, tlol_db_table_name, normalization_config, integer_keys)
+        if integer_keys:
+            # Number the keys of the whole table at once, a trajectory can span several rowid chunks
+            insert_trajectory_keys(cursor, tlol_db_table_name, get_filter_conditions())
+
+        min_rowid, max_rowid = cursor.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {tlol_db_table_name}").fetchone()
+        inserted_rows = 0
+        start_time = time.time()
+        if min_rowid is not None:
+            pbar = tqdm(total=max_rowid - min_rowid + 1, desc=f"Loading {table_name}", unit="rows")
+            for chunk_start in range(min_rowid, max_rowid + 1, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, max_rowid + 1)
+                inserted_rows += insert_cleaned_rows(
+                    cursor, table_name, tlol_db_table_name, normalization_config, f"rowid >= {chunk_start} AND rowid < {chunk_end}")
+                pbar.update(chunk_end - chunk_start)
+                pbar.set_postfix({"inserted": inserted_rows})
+            pbar.close()
+        load_time = time.time() - start_time
+        print(f"Inserted {inserted_rows} rows in {load_time:.1f}s ({inserted_rows / max(load_time, 1e-9):.0f} rows/s)")
+
+        # Build the indices once, after the data has been loaded
+        start_time = time.time()
+        create_cleaned_table_indices(cursor, table_name)
+        print(f"Created indices in {time.time() - start_time:.1f}s")
+
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        restore_pragmas(cursor, previous_pragmas)
+        conn.close()
+
+    return inserted_rows
+
+def append_new_games(database_file, table_name, tlol_db_table_name, normalization_config, pragmas=BULK_LOAD_PRAGMAS):
+    """
+    Clean, normalize and append the games of the source table that are not yet in the cleaned table.
+
+    Only the rows of the new game_ids are processed, the existing indices are updated in place and only
+    the cached counts that could contain the new compound keys are invalidated.
+
+    Returns:
+        int: The amount of inserted rows
+    """
+    conn = sqlite3.connect(database_file, isolation_level=None)
+    cursor = conn.cursor()
+
+    previous_fingerprint = get_table_fingerprint(cursor, table_name)
+
+    previous_pragmas = apply_pragmas(cursor, pragmas)
+    cursor.execute("BEGIN")
+    try:
+        # Indices for finding the games, created once
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {tlol_db_table_name}_{DB_columns.GAME_ID.value}_index ON {tlol_db_table_name}({DB_columns.GAME_ID.value})")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{DB_columns.GAME_ID.value}_index ON {table_name}({DB_columns.GAME_ID.value})")
+
+        # Refresh the dictionaries of the categorical columns from the current config
+        create_normalization_dictionaries(cursor, normalization_config)
+
+        cursor.execute("DROP TABLE IF EXISTS temp.new_games")
+        cursor.execute(f"""
+            CREATE TEMP TABLE new_games AS
+            SELECT DISTINCT {DB_columns.GAME_ID.value} FROM {tlol_db_table_name}
+            EXCEPT
+            SELECT DISTINCT {DB_columns.GAME_ID.value} FROM {table_name}
+        """)
+        new_game_count = cursor.execute("SELECT COUNT(*) FROM temp.new_games").fetchone()[0]
+
+        inserted_rows = 0
+        first_new_key = None
+        if new_game_count > 0:
+            start_time = time.time()
+            game_condition = f"{DB_columns.GAME_ID.value} IN (SELECT {DB_columns.GAME_ID.value} FROM temp.new_games)"
+            inserted_rows = insert_cleaned_rows(
+                cursor, table_name, tlol_db_table_name, normalization_config, game_condition)
+            load_time = time.time() - start_time
+            print(f"Appended {inserted_rows} rows of {new_game_count} new games in {load_time:.1f}s ({inserted_rows / max(load_time, 1e-9):.0f} rows/s)")
+
+            first_new_key = cursor.execute(
+                f"SELECT MIN({DB_columns.COMPOUND_KEY.value}) FROM {table_name} WHERE {game_condition}").fetchone()[0]
+        else:
+            print(f"No new games to append to {table_name}")
+
+        cursor.execute("DROP TABLE temp.new_games")
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        restore_pragmas(cursor, previous_pragmas)
+
+    # Stale cache entries are never used, so the cache can be updated after the data has been committed
+    if first_new_key is not None:
+        invalidate_cache_for_new_keys(cursor, table_name, first_new_key, previous_fingerprint)
+    conn.close()
+
+    return inserted_rows
+
+def clean_and_normalize_table(database_file, table_name, tlol_db_table_name, bulk=False, incremental=False, shards=None, integer_keys=False):
+    if shards is not None:
+        from utils.clean_and_normalize_table_sharded import clean_and_normalize_table_sharded
+        clean_and_normalize_table_sharded(database_file, table_name, tlol_db_table_name, shards, integer_keys=integer_keys)
+        return
+
+    if bulk or incremental:
+        # Read normalization config from JSON
+        with open("normalization_config.json", "r") as f:
+            normalization_config = json.load(f)
+
+        conn = sqlite3.connect(database_file)
+        table_exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+        conn.close()
+
+        if incremental and table_exists:
+            append_new_games(database_file, table_name, tlol_db_table_name, normalization_config)
+        else:
+            rebuild_cleaned_table(database_file, table_name, tlol_db_table_name, normalization_config, integer_keys=integer_keys)
+        return
 
-def clean_and_normalize_table(database_file, table_name, tlol_db_table_name):
     conn = sqlite3.connect(database_file)
     cursor = conn.cursor()
 
-    # Check if cache exists in db, clear if it does
-    cache_exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='count_cache'").fetchone()
-    if cache_exists:
-        clear_cache(cursor)
+    # Clear cached counts of the table being rebuilt
+    clear_cache(cursor, table_name)
 
     # Read normalization config from JSON
     with open("normalization_config.json", "r") as f:
@@ -50,6 +353,7 @@ def clean_and_normalize_table(database_file, table_name, tlol_db_table_name):
     cursor.execute(f"CREATE TABLE {table_name} AS SELECT * FROM {tlol_db_table_name} WHERE 1=0")
 
     # Normalize columns based on the configuration
+    create_normalization_dictionaries(cursor, normalization_config)
     for config in normalization_config:
         normalize_column(cursor, table_name, config)
 
@@ -57,20 +361,10 @@ def clean_and_normalize_table(database_file, table_name, tlol_db_table_name):
     conn.close()
 
     # Add data to the new table from the original table according to a filter
-    filter_conditions = [
-        f"{DB_columns.NAME.value} IS NOT ''",
-        f"{DB_columns.TIME.value} > 5",
-        f"{DB_columns.POS_X.value} > 0",
-        f"{DB_columns.POS_X.value} < {GAME_AREA_WIDTH}",
-        f"{DB_columns.POS_Z.value} > 0",
-        f"{DB_columns.POS_Z.value} < {GAME_AREA_WIDTH}"
-    ]
-    filter_conditions_str = " AND ".join(filter_conditions)
-
     conn = sqlite3.connect(database_file)
     cursor = conn.cursor()
 
-    cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {tlol_db_table_name} WHERE {filter_conditions_str}")
+    cursor.execute(get_cleaned_insert_query(cursor, table_name, tlol_db_table_name, normalization_config))
 
     conn.commit()
     conn.close()
@@ -95,7 +389,7 @@ def clean_and_normalize_table(database_file, table_name, tlol_db_table_name):
     cursor = conn.cursor()
 
     cursor.execute(f"DROP INDEX IF EXISTS {table_name}_compound_index")
-    print(create_compound_key_and_index(database_file, table_name, [DB_columns.GAME_ID.value, DB_columns.TEAM.value, DB_columns.NAME.value]))
+    print(create_compound_key_and_index(database_file, table_name, [DB_columns.GAME_ID.value, DB_columns.TEAM.value, DB_columns.NAME.value], integer_keys))
 
     indices = cursor.execute(f"PRAGMA index_list({table_name})").fetchall()
     table_info = cursor.execute(f"PRAGMA table_info({table_name})").fetchall()
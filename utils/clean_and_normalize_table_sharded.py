@@ -0,0 +1,195 @@
+import os
+import json
+import sqlite3
+import tempfile
+import time
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from constants import DB_columns
+from utils.clean_and_normalize_table import create_cleaned_table, create_cleaned_table_indices, get_filter_conditions, insert_cleaned_rows
+from utils.create_compound_key_and_index import get_integer_compound_key_expression, insert_trajectory_keys
+from utils.get_data import clear_cache
+from utils.sqlite_pragmas import BULK_LOAD_PRAGMAS, apply_pragmas, restore_pragmas
+
+# Shards are temporary, so they are written without a journal
+SHARD_PRAGMAS = {**BULK_LOAD_PRAGMAS, "journal_mode": "OFF"}
+
+# SQLite allows 10 attached databases by default
+MAX_ATTACHED_SHARDS = 8
+
+
+def get_shard_table_name(table_name):
+    # Named differently from the cleaned table, so it cannot resolve to the table in the source database
+    return f"{table_name}_shard"
+
+
+def get_rebuild_table_name(table_name):
+    # The merged table is built under this name and replaces the cleaned table in the final transaction
+    return f"{table_name}_rebuild"
+
+
+def get_shard_rowid_ranges(cursor, tlol_db_table_name, shards):
+    """
+    Partition the source table into contiguous rowid ranges of about equal size, one per shard.
+    Only the minimum and maximum rowid are read, and every shard reads its range with a rowid range search
+    instead of scanning the whole table.
+
+    Returns:
+        list: (first_rowid, end_rowid) tuples, the end is exclusive
+    """
+    min_rowid, max_rowid = cursor.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {tlol_db_table_name}").fetchone()
+    if min_rowid is None:
+        return []
+    shard_size = -(-(max_rowid - min_rowid + 1) // shards)
+    return [(first_rowid, min(first_rowid + shard_size, max_rowid + 1))
+            for first_rowid in range(min_rowid, max_rowid + 1, shard_size)]
+
+
+def clean_shard(database_file, shard_file, table_name, tlol_db_table_name, normalization_config, first_rowid, end_rowid):
+    """
+    Filter, normalize and compute the compound keys of one shard of the source table into its own database.
+    A shard holds the source rows with first_rowid <= rowid < end_rowid.
+
+    Returns:
+        tuple: (shard_file, inserted_rows)
+    """
+    if os.path.exists(shard_file):
+        os.remove(shard_file)
+
+    conn = sqlite3.connect(pathlib.Path(shard_file).absolute().as_uri(), uri=True, isolation_level=None)
+    cursor = conn.cursor()
+    apply_pragmas(cursor, SHARD_PRAGMAS)
+
+    # Unqualified names of source tables resolve to the attached source database, as the shard has no tables of that name
+    source_uri = pathlib.Path(database_file).absolute().as_uri() + "?mode=ro"
+    cursor.execute("ATTACH DATABASE ? AS source", (source_uri,))
+
+    cursor.execute("BEGIN")
+    # The skipped columns are reported once, by the merged table
+    create_cleaned_table(cursor, get_shard_table_name(table_name), tlol_db_table_name, normalization_config, report_skipped=False)
+    shard_condition = f"rowid >= {first_rowid} AND rowid < {end_rowid}"
+    inserted_rows = insert_cleaned_rows(
+        cursor, get_shard_table_name(table_name), tlol_db_table_name, normalization_config, shard_condition)
+    cursor.execute("COMMIT")
+
+    conn.close()
+    return shard_file, inserted_rows
+
+
+def clean_and_normalize_table_sharded(database_file, table_name, tlol_db_table_name, shards=None, normalization_config=None, shard_folder=None, integer_keys=False):
+    """
+    Rebuild a cleaned table by cleaning shards of the source table in parallel processes.
+
+    The source table is partitioned once into rowid ranges, each range is filtered and normalized into a temporary
+    shard database in its own process, and the shards are merged back into the database with ATTACH and bulk inserts.
+    The shards are merged into a separate table, which replaces the cleaned table and gets its indices in a single
+    final transaction, so readers see either the old or the complete new table.
+
+    Args:
+        database_file (str): Path to the SQLite database
+        table_name (str): The cleaned table to rebuild
+        tlol_db_table_name (str): The raw table to read from
+        shards (int): Amount of shards and worker processes, defaults to the amount of CPUs
+        normalization_config (list): Normalization configs, read from normalization_config.json by default
+        shard_folder (str): Folder for the temporary shard databases, defaults to the folder of the database
+        integer_keys (bool): Store the compound key as an INTEGER surrogate key, assigned while merging
+
+    Returns:
+        int: The amount of inserted rows
+    """
+    shards = shards or os.cpu_count() or 1
+
+    if normalization_config is None:
+        # Read normalization config from JSON
+        with open("normalization_config.json", "r") as f:
+            normalization_config = json.load(f)
+
+    shard_folder = shard_folder or os.path.dirname(os.path.abspath(database_file))
+
+    conn = sqlite3.connect(database_file)
+    shard_rowid_ranges = get_shard_rowid_ranges(conn.cursor(), tlol_db_table_name, shards)
+    conn.close()
+
+    with tempfile.TemporaryDirectory(dir=shard_folder, prefix=f"{table_name}_shards_") as shard_directory:
+        # Clean the shards in parallel
+        start_time = time.time()
+        shard_files = []
+        shard_rows = 0
+        with ProcessPoolExecutor(max_workers=shards) as executor:
+            futures = [
+                executor.submit(clean_shard, database_file, os.path.join(shard_directory, f"shard_{shard_index}.db"),
+                                table_name, tlol_db_table_name, normalization_config, first_rowid, end_rowid)
+                for shard_index, (first_rowid, end_rowid) in enumerate(shard_rowid_ranges)
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Cleaning shards"):
+                shard_file, inserted_rows = future.result()
+                shard_files.append(shard_file)
+                shard_rows += inserted_rows
+        clean_time = time.time() - start_time
+        print(f"Cleaned {shard_rows} rows in {len(shard_files)} shards in {clean_time:.1f}s ({shard_rows / max(clean_time, 1e-9):.0f} rows/s)")
+
+        # Merge the shards into the database
+        conn = sqlite3.connect(database_file, isolation_level=None)
+        cursor = conn.cursor()
+        rebuild_table_name = get_rebuild_table_name(table_name)
+
+        previous_pragmas = apply_pragmas(cursor, BULK_LOAD_PRAGMAS)
+        try:
+            cursor.execute("BEGIN")
+            create_cleaned_table(cursor, rebuild_table_name, tlol_db_table_name, normalization_config, integer_keys)
+            if integer_keys:
+                # Number the keys of the whole table at once, like rebuild_cleaned_table, a trajectory can span several shards
+                insert_trajectory_keys(cursor, tlol_db_table_name, get_filter_conditions())
+            cursor.execute("COMMIT")
+            columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({rebuild_table_name})").fetchall()]
+            # The shards hold text keys, the integer keys assigned above are looked up while merging
+            select_expressions = [
+                get_integer_compound_key_expression("shard") if integer_keys and column == DB_columns.COMPOUND_KEY.value else column
+                for column in columns
+            ]
+
+            # Databases can only be detached outside of a transaction, so the shards are merged in groups
+            start_time = time.time()
+            merged_rows = 0
+            shard_files = sorted(shard_files)
+            for group_start in tqdm(range(0, len(shard_files), MAX_ATTACHED_SHARDS), desc="Merging shards"):
+                group = shard_files[group_start:group_start + MAX_ATTACHED_SHARDS]
+                for i, shard_file in enumerate(group):
+                    cursor.execute(f"ATTACH DATABASE ? AS shard_{i}", (shard_file,))
+                cursor.execute("BEGIN")
+                for i in range(len(group)):
+                    shard_table_name = f"shard_{i}.{get_shard_table_name(table_name)}"
+                    cursor.execute(f"""
+                        INSERT INTO main.{rebuild_table_name} ({','.join(columns)})
+                        SELECT {','.join(select_expressions)} FROM {shard_table_name} AS shard
+                    """)
+                    merged_rows += cursor.rowcount
+                cursor.execute("COMMIT")
+                for i in range(len(group)):
+                    cursor.execute(f"DETACH DATABASE shard_{i}")
+            merge_time = time.time() - start_time
+            print(f"Merged {merged_rows} rows in {merge_time:.1f}s ({merged_rows / max(merge_time, 1e-9):.0f} rows/s)")
+
+            # Replace the cleaned table and build the indices once, after the data has been merged
+            start_time = time.time()
+            cursor.execute("BEGIN")
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+            cursor.execute(f"ALTER TABLE {rebuild_table_name} RENAME TO {table_name}")
+            create_cleaned_table_indices(cursor, table_name)
+            cursor.execute("COMMIT")
+            print(f"Created indices in {time.time() - start_time:.1f}s")
+
+            # Clear cached counts of the replaced table
+            clear_cache(cursor, table_name)
+        except BaseException:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            cursor.execute(f"DROP TABLE IF EXISTS {rebuild_table_name}")
+            raise
+        finally:
+            restore_pragmas(cursor, previous_pragmas)
+            conn.close()
+
+    return merged_rows
@@ -1,10 +1,17 @@
 from collections import defaultdict
+import pathlib
 import sqlite3
 import numpy as np
-from tqdm.notebook import tqdm
+from tqdm.auto import tqdm
 from constants import DEFAULT_DATA_FEATURES
-from utils.get_data import fetch_data_batches
+from utils.get_data import fetch_data_batches_after
+from utils.prefetch_iterator import PrefetchIterator
+from utils.model_grid_executor import ModelGridExecutor
+from utils.sequence_cache import get_sequence_cache_key
+from utils.streaming_metrics import ErrorMetrics
+from utils.trajectory_store import TrajectoryStore, fetch_data_batches_from_store, load_trajectory_store
 from utils.create_sequences_in_batches import create_sequences_from_database_rows
+from utils.windowed_sequence_dataset import WindowedSequenceDataset, create_windowed_dataset_from_database_rows
 from sklearn.metrics import mean_squared_error  # type: ignore
 from sklearn.model_selection import train_test_split
 
@@ -12,67 +19,371 @@ def shape_input_for_model(X, data_features, features, input_shape):
     X_features = X[:, :, [data_features.index(feature) for feature in features]]
     return X_features.reshape(input_shape)
 
-def compare_models(database_file, table_name, H_values, T_values, model_getters, data_features=DEFAULT_DATA_FEATURES, labels=DEFAULT_DATA_FEATURES, filter="1=1", total_keys_to_fetch=100, batch_size=20, train=True):
+def dataset_mean_squared_error(model, dataset, data_features, features, input_shape, batch_size=10000, metrics=None):
+    """
+    Mean squared error of the predictions of a model on a WindowedSequenceDataset, predicted in batches.
+    The predictions of every batch are also added to metrics, an ErrorMetrics, when given.
+    """
+    feature_indices = [data_features.index(feature) for feature in features]
+    squared_error_sum = 0.0
+    value_count = 0
+    for X, y in dataset.iter_batches(batch_size, feature_indices):
+        y_pred = np.reshape(model.predict(X.reshape(input_shape)), y.shape)
+        squared_error_sum += float(((y - y_pred) ** 2).sum())
+        value_count += y.size
+        if metrics is not None:
+            metrics.update(y, y_pred)
+    return squared_error_sum / value_count
+
+def split_sequences(data, H, T, max_H, max_T, label_indices, ragged=False, time_column_index=None, time_step=None):
+    """
+    Create the sequences of a batch of keys for one (H, T) and split them into a training and a test set.
+
+    Returns:
+        tuple: (X_train, X_test, y_train, y_test)
+    """
+    X, y = create_sequences_from_database_rows(
+        data, H, T, max_H, max_T, label_indices=label_indices, ragged=ragged, time_column_index=time_column_index, time_step=time_step)
+    return train_test_split(X, y, test_size=0.2, train_size=0.8, shuffle=True)
+
+def fetch_windowed_batch(cursor, table_name, filter, limit, continuation_token, data_features, max_H, max_T, label_indices, ragged=False, sequence_cache=None, time_column_index=None, time_step=None):
+    """
+    Fetch a batch of keys after the continuation token and create the windows of the longest history.
+    With a SequenceCache the windows of the batch are read from the cache when the table has not changed.
+
+    Returns:
+        tuple: (data, windowed_dataset, continuation_token) where data is None when the batch came from the cache
+    """
+    def fetch():
+        data, next_continuation_token = fetch_data_batches_after(
+            cursor, table_name, filter, limit, continuation_token, data_features)
+        windowed_dataset = create_windowed_dataset_from_database_rows(
+            data, max_H, max_T, max_H, max_T, label_indices=label_indices, ragged=ragged,
+            time_column_index=time_column_index, time_step=time_step)
+        return data, windowed_dataset, next_continuation_token
+
+    if sequence_cache is None:
+        return fetch()
+
+    key = get_sequence_cache_key(
+        cursor, table_name, kind="windowed_batch", filter=filter, limit=limit, continuation_token=continuation_token,
+        data_features=list(data_features), max_H=max_H, max_T=max_T, label_indices=label_indices, ragged=ragged,
+        time_column_index=time_column_index, time_step=time_step)
+    entry = sequence_cache.get(key)
+    if entry is not None:
+        arrays, metadata = entry
+        windowed_dataset = WindowedSequenceDataset(arrays["values"], arrays["starts"], max_H, max_T, label_indices)
+        return None, windowed_dataset, metadata["continuation_token"]
+
+    data, windowed_dataset, next_continuation_token = fetch()
+    if len(data) > 0:
+        sequence_cache.put(key, {"values": windowed_dataset.values, "starts": windowed_dataset.starts},
+                           {"continuation_token": next_continuation_token})
+    return data, windowed_dataset, next_continuation_token
+
+def get_trajectory_store(trajectory_store, table_name, filter):
+    """
+    Load a trajectory store given as a folder and check that it was exported from the table being compared.
+    The keys of a store were selected when it was exported, so a filter can not be applied to it.
+    """
+    if not isinstance(trajectory_store, TrajectoryStore):
+        trajectory_store = load_trajectory_store(trajectory_store)
+    if filter != "1=1":
+        raise ValueError(f"A filter can not be applied to a trajectory store, export the store with filter={filter!r} instead")
+    if trajectory_store.metadata["table_name"] != table_name:
+        raise ValueError(f"The trajectory store {trajectory_store.store_folder} was exported from "
+                         f"{trajectory_store.metadata['table_name']}, not from {table_name}")
+    return trajectory_store
+
+def iter_sequence_batches(database_file, table_name, H_values, T_values, data_features, labels, filter, total_keys_to_fetch, batch_size, trajectory_store=None, lazy=False, ragged=False, precompute_sequences=False, sequence_cache=None, time_column_index=None, time_step=None):
+    """
+    Read the batches of keys used by compare_models and prepare their sequences.
+
+    The database is opened read-only inside the generator, so the generator can run on a background thread.
+    With a SequenceCache the windows of every batch are cached, and batches read from the cache skip all data
+    preparation. Their data is then None, and all of their sequences are precomputed from the windows.
+
+    Yields:
+        tuple: (data, base_datasets, sequences) where base_datasets is the (train, test) split of the windows of
+        the longest history with lazy, and sequences maps every (H, T) to its split sequences with precompute_sequences
+    """
+    max_H = max(H_values)
+    max_T = max(T_values)
+    label_indices = [data_features.index(label) for label in labels]
+
+    conn = None
+    if trajectory_store is not None:
+        trajectory_store = get_trajectory_store(trajectory_store, table_name, filter)
+    else:
+        conn = sqlite3.connect(pathlib.Path(database_file).absolute().as_uri() + "?mode=ro", uri=True)
+        cursor = conn.cursor()
+
+    try:
+        offset = 0  # Start offset, used with the trajectory store
+        continuation_token = None  # Keyset position, used with the database
+        remaining_keys = total_keys_to_fetch
+
+        while remaining_keys > 0:
+            limit = min(batch_size, remaining_keys)
+
+            # Fetch and process data in batches, from the exported trajectory store if one is given
+            windowed_dataset = None
+            if trajectory_store is not None:
+                data = fetch_data_batches_from_store(
+                    trajectory_store, offset, limit, data_features)
+            elif lazy or sequence_cache is not None:
+                data, windowed_dataset, continuation_token = fetch_windowed_batch(
+                    cursor, table_name, filter, limit, continuation_token, data_features, max_H, max_T,
+                    label_indices, ragged, sequence_cache, time_column_index, time_step)
+            else:
+                data, continuation_token = fetch_data_batches_after(
+                    cursor, table_name, filter, limit, continuation_token, data_features)
+
+            if data is not None and len(data) == 0:
+                break  # No more data to process
+
+            base_datasets = None
+            sequences = {}
+            if lazy:
+                # Windows of the longest history, viewed with every (H, T) by compare_models
+                if windowed_dataset is None:
+                    windowed_dataset = create_windowed_dataset_from_database_rows(
+                        data, max_H, max_T, max_H, max_T, label_indices=label_indices, ragged=ragged,
+                        time_column_index=time_column_index, time_step=time_step)
+                base_datasets = windowed_dataset.split(test_size=0.2, shuffle=True)
+            elif precompute_sequences or data is None:
+                if data is None:
+                    # The same sequences as create_sequences_from_database_rows, from the cached windows
+                    sequences = {(H, T): train_test_split(*windowed_dataset.with_horizon(H, T).to_arrays(), test_size=0.2, train_size=0.8, shuffle=True)
+                                 for H in H_values for T in T_values}
+                else:
+                    sequences = {(H, T): split_sequences(data, H, T, max_H, max_T, label_indices, ragged, time_column_index, time_step)
+                                 for H in H_values for T in T_values}
+            yield data, base_datasets, sequences
+
+            # Update offset and remaining keys
+            offset += limit
+            remaining_keys -= limit
+
+            if trajectory_store is None and continuation_token is None:
+                break  # Reached the last key of the table
+    finally:
+        if conn is not None:
+            conn.close()
+
+def is_streaming_model(model):
+    """
+    Whether compare_models keeps the model across batches and updates it with partial_fit instead of refitting it.
+    Models opt in with a streaming = True class attribute, e.g. StreamingLinearRegression. Other models with a
+    partial_fit (e.g. SGDRegressor or MLPRegressor) are refitted on every batch like any other model.
+    """
+    return getattr(model, "streaming", False) is True
+
+def fit_and_evaluate_model(model, features, input_shape, data_features, train_data, test_data, prediction_batch_size=10000, validation_metrics=None):
+    """
+    Fit a model and compute its training and validation mean squared errors.
+    Streaming models (see is_streaming_model) are updated with partial_fit instead of refitted.
+
+    Args:
+        train_data: WindowedSequenceDataset, or a tuple (X, y) of sequence arrays
+        test_data: Same type as train_data
+        validation_metrics (ErrorMetrics): Streaming metrics the validation predictions are added to, if given
+
+    Returns:
+        tuple: (training_mse, validation_mse)
+    """
+    if isinstance(train_data, WindowedSequenceDataset):
+        feature_indices = [data_features.index(feature) for feature in features]
+        X_train_reshaped = train_data.to_arrays(feature_indices)[0].reshape(input_shape)
+        fit = model.partial_fit if is_streaming_model(model) else model.fit
+        fit(X_train_reshaped, train_data.get_labels())
+        del X_train_reshaped
+        training_mse = dataset_mean_squared_error(
+            model, train_data, data_features, features, input_shape, prediction_batch_size)
+        validation_mse = dataset_mean_squared_error(
+            model, test_data, data_features, features, input_shape, prediction_batch_size, validation_metrics)
+        return training_mse, validation_mse
+
+    X_train, y_train = train_data
+    X_test, y_test = test_data
+    X_train_reshaped = shape_input_for_model(
+        X_train, data_features, features, input_shape)
+    fit = model.partial_fit if is_streaming_model(model) else model.fit
+    fit(X_train_reshaped, y_train)
+    training_prediction = model.predict(X_train_reshaped)
+    training_mse = mean_squared_error(y_train, training_prediction)
+    X_test_features = X_test[:, :, [
+        data_features.index(feature) for feature in features]].reshape(input_shape)
+    X_test_reshaped = X_test_features.reshape(input_shape)
+    y_pred = model.predict(X_test_reshaped)
+    # Only use the first two values of the last dimension for mse
+    validation_mse = mean_squared_error(y_test, y_pred)
+    if validation_metrics is not None:
+        validation_metrics.update(y_test, y_pred)
+    return training_mse, validation_mse
+
+def get_shared_batch_arrays(sequences, base_datasets):
+    """
+    The arrays of a batch that are shared with the worker processes of a ModelGridExecutor.
+    """
+    if base_datasets is not None:
+        base_train_dataset, base_test_dataset = base_datasets
+        return {"values": base_train_dataset.values, "train_starts": base_train_dataset.starts,
+                "test_starts": base_test_dataset.starts}
+    return {f"{name}_{H}_{T}": array for (H, T), split in sequences.items()
+            for name, array in zip(["X_train", "X_test", "y_train", "y_test"], split)}
+
+def fit_grid_cell(context, arrays, task):
+    """
+    Fit and evaluate one model of the grid on a worker process of a ModelGridExecutor.
+    """
+    H, T, model_name, previous_model = task
+    model, features, input_shape = context["model_getters"][model_name](H, T)
+    # Streaming models continue from the previous batches
+    if previous_model is not None:
+        model = previous_model
+    print(f'Fitting model {model_name} with features {features}')
+    if "values" in arrays:
+        max_H, max_T, label_indices = context["max_H"], context["max_T"], context["label_indices"]
+        train_data = WindowedSequenceDataset(arrays["values"], arrays["train_starts"], max_H, max_T, label_indices).with_horizon(H, T)
+        test_data = WindowedSequenceDataset(arrays["values"], arrays["test_starts"], max_H, max_T, label_indices).with_horizon(H, T)
+    else:
+        train_data = (arrays[f"X_train_{H}_{T}"], arrays[f"y_train_{H}_{T}"])
+        test_data = (arrays[f"X_test_{H}_{T}"], arrays[f"y_test_{H}_{T}"])
+    # The metrics of the cell are merged into the metrics of compare_models by the main process
+    metrics = ErrorMetrics(**context["metrics_parameters"]) if context["metrics_parameters"] is not None else None
+    training_mse, validation_mse = fit_and_evaluate_model(
+        model, features, input_shape, context["data_features"], train_data, test_data, context["prediction_batch_size"], metrics)
+    # Streaming models are sent back to continue on the next batch
+    return_model = context["train"] or is_streaming_model(model)
+    return H, T, model_name, model if return_model else None, training_mse, validation_mse, metrics
+
+def compare_models(database_file, table_name, H_values, T_values, model_getters, data_features=DEFAULT_DATA_FEATURES, labels=DEFAULT_DATA_FEATURES, filter="1=1", total_keys_to_fetch=100, batch_size=20, train=True, trajectory_store=None, lazy=False, prediction_batch_size=10000, ragged=False, prefetch_batches=0, workers=0, torch_threads=None, sequence_cache=None, metrics=None, start_method=None, time_column_index=None, time_step=None):
+    """
+    Train and evaluate models for every combination of H, T and model getter on batches of keys.
+
+    With lazy the sequences are served from a WindowedSequenceDataset: the windows of each batch of keys are
+    stored once for all (H, T), the same train/test split is used for all (H, T), only the features of each
+    model are copied for fitting, and predictions are made in batches of prediction_batch_size sequences.
+
+    With ragged every window of every key is used, instead of cutting the keys of a batch to the shortest key.
+    With ragged and a time_column_index (the index of the time feature in data_features) only the windows of
+    consecutive samples, time_step apart, are used, so windows do not span gaps in the trajectories.
+
+    With a trajectory_store (a TrajectoryStore or the folder of one, see export_trajectory_store) the keys are
+    read from the memory-mapped store instead of the database, in the order they were exported. The store must
+    have been exported from table_name, and the filter must be "1=1", as the keys of a store were selected when
+    it was exported.
+
+    With prefetch_batches > 0 a background thread with its own read-only connection reads and sequences the
+    next batches while the models are fitted on the current one, keeping at most prefetch_batches batches ready.
+    Without lazy the sequences of every (H, T) of those batches are then held in memory at once.
+
+    Streaming models (see is_streaming_model) are kept across batches and updated with partial_fit on every batch
+    instead of refitted, so e.g. a StreamingLinearRegression is fitted on the training sequences of all batches.
+
+    With a SequenceCache the windows of every batch are cached on disk, so re-running the same experiment on an
+    unchanged table skips fetching and sequencing.
+
+    With workers > 1 the (H, T, model) cells of every batch are fitted in parallel by a ModelGridExecutor of
+    that many processes, each limited to torch_threads intra-op threads. The sequences of the batch are
+    shared with the workers through shared memory, and the fitted models are sent back when train is set.
+    The workers are forked on Linux and spawned on Windows and macOS, or started with start_method. Spawned
+    and forkserver workers need model getters that can be pickled, i.e. defined in a module instead of a
+    notebook; otherwise the cells are fitted one at a time in this process. In a Jupyter kernel that already
+    runs torch or OpenMP threads, forking can deadlock, so use start_method="forkserver" there.
+
+    With a StreamingMetrics the validation predictions of every batch are added to its ErrorMetrics of
+    (H, T, model_name), so the distribution of the validation errors is summarized without keeping them.
+    The workers summarize their cells in their own ErrorMetrics, which are merged into it.
+    """
+    if trajectory_store is not None:
+        trajectory_store = get_trajectory_store(trajectory_store, table_name, filter)
     training_errors = defaultdict(list)
     validation_errors = defaultdict(list)
     trained_models = {}
+    # Streaming models, kept across batches
+    streaming_models = {}
+    # Features and input shapes of the streaming models, so their getters are only called on the first batch
+    streaming_model_inputs = {}
     max_H = max(H_values)
     max_T = max(T_values)
 
-    conn = sqlite3.connect(database_file)
-    cursor = conn.cursor()
-
     pbar = tqdm(total=len(H_values) * len(T_values) *
                 len(model_getters), desc='Model loop')
 
-    offset = 0  # Start offset
-    remaining_keys = total_keys_to_fetch
-
-    while remaining_keys > 0:
-        limit = min(batch_size, remaining_keys)
-
-        # Fetch and process data in batches
-        data = fetch_data_batches(
-            cursor, table_name, filter, offset, limit, data_features)
-
-        if len(data) == 0:
-            break  # No more data to process
-
-        for H in H_values:
-            for T in tqdm(T_values, desc=f'H={H}', leave=False):
-                # Calculate the sequence on the fly
-                label_indices = [data_features.index(label) for label in labels]
-                sequence = create_sequences_from_database_rows(
-                    data, H, T, max_H, max_T, label_indices=label_indices)
-                X, y = sequence
-                X_train, X_test, y_train, y_test = train_test_split(
-                    X, y, test_size=0.2, train_size=0.8, shuffle=True)
-                models = {model_name: model_getter(
-                    H, T) for model_name, model_getter in model_getters.items()}
-                for model_name, (model, features, input_shape) in tqdm(models.items(), desc=f'T={T}', leave=False):
-                    print(
-                        f'Fitting model {model_name} with features {features}')
-                    X_train_reshaped = shape_input_for_model(
-                        X_train, data_features, features, input_shape)
-                    model.fit(X_train_reshaped, y_train)
-                    training_prediction = model.predict(X_train_reshaped)
-                    training_mse = mean_squared_error(y_train, training_prediction)
+    label_indices = [data_features.index(label) for label in labels]
+    executor = None
+    batches = None
+    try:
+        if workers > 1:
+            context = {"model_getters": model_getters, "data_features": data_features, "label_indices": label_indices,
+                       "max_H": max_H, "max_T": max_T, "prediction_batch_size": prediction_batch_size, "train": train,
+                       "metrics_parameters": metrics.metrics_parameters if metrics is not None else None}
+            executor = ModelGridExecutor(context, workers, torch_threads, start_method)
+
+        batches = iter_sequence_batches(
+            database_file, table_name, H_values, T_values, data_features, labels, filter, total_keys_to_fetch,
+            batch_size, trajectory_store, lazy, ragged, precompute_sequences=prefetch_batches > 0 or executor is not None,
+            sequence_cache=sequence_cache, time_column_index=time_column_index, time_step=time_step)
+        if prefetch_batches > 0:
+            batches = PrefetchIterator(batches, prefetch_batches)
+
+        for data, base_datasets, sequences in batches:
+            if executor is not None:
+                tasks = [(H, T, model_name, streaming_models.get((H, T, model_name)))
+                         for H in H_values for T in T_values for model_name in model_getters]
+                for H, T, model_name, model, training_mse, validation_mse, cell_metrics in executor.run(
+                        fit_grid_cell, get_shared_batch_arrays(sequences, base_datasets), tasks):
+                    if cell_metrics is not None:
+                        metrics.get_or_create((H, T, model_name)).merge(cell_metrics)
+                    if is_streaming_model(model):
+                        streaming_models[(H, T, model_name)] = model
                     training_errors[(H, T, model_name)] += [training_mse]
-                    X_test_features = X_test[:, :, [
-                        data_features.index(feature) for feature in features]].reshape(input_shape)
-                    X_test_reshaped = X_test_features.reshape(input_shape)
-                    y_pred = model.predict(X_test_reshaped)
-                    # Only use the first two values of the last dimension for mse
-                    mse = mean_squared_error(y_test, y_pred)
-                    validation_errors[(H, T, model_name)] += [mse]
+                    validation_errors[(H, T, model_name)] += [validation_mse]
                     if train:
                         trained_models[(H, T, model_name)] = model
                     pbar.update(1)
+                continue
 
-        # Update offset and remaining keys
-        offset += limit
-        remaining_keys -= limit
+            if lazy:
+                base_train_dataset, base_test_dataset = base_datasets
 
-    pbar.close()
-    conn.close()
+            for H in H_values:
+                for T in tqdm(T_values, desc=f'H={H}', leave=False):
+                    if lazy:
+                        train_data = base_train_dataset.with_horizon(H, T)
+                        test_data = base_test_dataset.with_horizon(H, T)
+                    else:
+                        # Calculate the sequence on the fly, unless it was prepared by the prefetching thread
+                        X_train, X_test, y_train, y_test = sequences.pop((H, T), None) or split_sequences(
+                            data, H, T, max_H, max_T, label_indices, ragged, time_column_index, time_step)
+                        train_data = (X_train, y_train)
+                        test_data = (X_test, y_test)
+                    for model_name, model_getter in tqdm(model_getters.items(), desc=f'T={T}', leave=False):
+                        if (H, T, model_name) in streaming_models:
+                            model = streaming_models[(H, T, model_name)]
+                            features, input_shape = streaming_model_inputs[(H, T, model_name)]
+                        else:
+                            model, features, input_shape = model_getter(H, T)
+                            if is_streaming_model(model):
+                                streaming_models[(H, T, model_name)] = model
+                                streaming_model_inputs[(H, T, model_name)] = (features, input_shape)
+                        print(
+                            f'Fitting model {model_name} with features {features}')
+                        training_mse, validation_mse = fit_and_evaluate_model(
+                            model, features, input_shape, data_features, train_data, test_data, prediction_batch_size,
+                            metrics.get_or_create((H, T, model_name)) if metrics is not None else None)
+                        training_errors[(H, T, model_name)] += [training_mse]
+                        validation_errors[(H, T, model_name)] += [validation_mse]
+                        if train:
+                            trained_models[(H, T, model_name)] = model
+                        pbar.update(1)
+    finally:
+        # Stop the prefetching thread, the connection of the batches and the worker processes, also on errors
+        if batches is not None:
+            batches.close()
+        if executor is not None:
+            executor.close()
+        pbar.close()
     return trained_models, training_errors, validation_errors
\ No newline at end of file
@@ -0,0 +1,216 @@
+import numpy as np
+from tqdm import tqdm
+
+DEFAULT_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def to_numeric_array(values):
+    """
+    Convert the values of a numeric column to floats. NULL values become NaN, and numeric text is converted like
+    SQLite does with numeric affinity. Other values (e.g. text in a REAL column of a mixed table) are dropped.
+
+    Returns:
+        tuple: (array, invalid_count) where invalid_count is the amount of dropped values
+    """
+    try:
+        return np.array(values, dtype=np.float64), 0
+    except (TypeError, ValueError):
+        pass
+    numeric_values = []
+    for value in values:
+        try:
+            numeric_values.append(np.nan if value is None else float(value))
+        except (TypeError, ValueError):
+            continue
+    return np.array(numeric_values, dtype=np.float64), len(values) - len(numeric_values)
+
+
+class NumericColumnStatistics:
+    """
+    Streaming statistics of a numeric column, updated one chunk of values at a time.
+
+    Mean and variance are merged per chunk with Chan's parallel algorithm, and the quantiles are
+    estimated from a uniform reservoir sample of the non-null values. Values that are not numeric are
+    counted in invalid_count and left out of the statistics.
+    """
+
+    def __init__(self, sample_size, rng):
+        self.count = 0
+        self.null_count = 0
+        self.invalid_count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sample = np.empty(sample_size, dtype=np.float64)
+        self.sample_size = sample_size
+        self.seen = 0
+        self.rng = rng
+
+    def update(self, values, invalid_count=0):
+        self.invalid_count += invalid_count
+        null_mask = np.isnan(values)
+        self.null_count += int(null_mask.sum())
+        values = values[~null_mask]
+        n = len(values)
+        if n == 0:
+            return
+
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        chunk_mean = float(values.mean())
+        chunk_m2 = float(((values - chunk_mean) ** 2).sum())
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+        self._update_sample(values)
+
+    def _update_sample(self, values):
+        # Fill the reservoir first, then replace its items with decreasing probability (Algorithm R)
+        fill = min(self.sample_size - self.seen, len(values)) if self.seen < self.sample_size else 0
+        self.sample[self.seen:self.seen + fill] = values[:fill]
+        rest = values[fill:]
+        if len(rest):
+            positions = self.seen + fill + np.arange(1, len(rest) + 1)
+            accepted = self.rng.random(len(rest)) < self.sample_size / positions
+            self.sample[self.rng.integers(0, self.sample_size, int(accepted.sum()))] = rest[accepted]
+        self.seen += len(values)
+
+    def to_dict(self, quantiles=DEFAULT_QUANTILES):
+        if self.count == 0:
+            return {"count": 0, "null_count": self.null_count, "invalid_count": self.invalid_count}
+        sample = self.sample[:min(self.seen, self.sample_size)]
+        return {
+            "count": self.count,
+            "null_count": self.null_count,
+            "invalid_count": self.invalid_count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "std": float(np.sqrt(self.m2 / self.count)),
+            "quantiles": {str(q): float(value) for q, value in zip(quantiles, np.quantile(sample, quantiles))},
+        }
+
+
+class TextColumnStatistics:
+    """
+    Streaming statistics of a text column: the null count and the distinct values in order of appearance.
+    NULL is one of the distinct values when the column contains it, like in SELECT DISTINCT.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.null_count = 0
+        self.distinct_values = {}
+
+    def update(self, values):
+        for value in dict.fromkeys(values):
+            self.distinct_values.setdefault(value, None)
+        null_count = values.count(None)
+        self.null_count += null_count
+        self.count += len(values) - null_count
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "null_count": self.null_count,
+            "distinct_count": len(self.distinct_values),
+        }
+
+    def get_dictionary(self):
+        """
+        The distinct values mapped to codes starting from 1, the format of "case" normalization configs.
+        """
+        return {value: idx + 1 for idx, value in enumerate(self.distinct_values)}
+
+
+def compute_column_statistics(cursor, table_name, numeric_columns, text_columns, filter="1=1", fetch_size=100000,
+                              sample_size=100000, quantiles=DEFAULT_QUANTILES, seed=0):
+    """
+    Compute the statistics of many columns of a table in one streaming pass.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the database
+        table_name (str): The table to compute the statistics of
+        numeric_columns (list): Columns to compute min, max, mean, std, null count and approximate quantiles of
+        text_columns (list): Columns to compute the distinct values (including NULL) and null count of
+        filter (str): SQL condition selecting the rows to include
+        fetch_size (int): Amount of rows fetched from SQLite at a time
+        sample_size (int): Size of the reservoir sample the quantiles are estimated from, per column
+        quantiles (list): The quantiles to estimate
+        seed (int): Seed of the reservoir sampling
+
+    Returns:
+        tuple: (statistics, dictionaries) where statistics maps every column to a dict of its statistics
+        and dictionaries maps every text column to its distinct values and their codes
+    """
+    rng = np.random.default_rng(seed)
+    numeric_statistics = {column: NumericColumnStatistics(sample_size, rng) for column in numeric_columns}
+    text_statistics = {column: TextColumnStatistics() for column in text_columns}
+
+    columns = list(numeric_columns) + list(text_columns)
+    if not columns:
+        return {}, {}
+
+    total_rows = cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE {filter}").fetchone()[0]
+    cursor.execute(f"SELECT {','.join(columns)} FROM {table_name} WHERE {filter}")
+
+    pbar = tqdm(total=total_rows, desc=f"Computing statistics of {table_name}", unit="rows")
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+
+        column_values = list(zip(*rows))
+        for column, values in zip(numeric_columns, column_values):
+            # NULL values become NaN, values that are not numeric are counted and skipped
+            numeric_statistics[column].update(*to_numeric_array(values))
+        for column, values in zip(text_columns, column_values[len(numeric_columns):]):
+            text_statistics[column].update(values)
+
+        pbar.update(len(rows))
+    pbar.close()
+
+    statistics = {column: column_statistics.to_dict(quantiles) for column, column_statistics in numeric_statistics.items()}
+    statistics.update({column: column_statistics.to_dict() for column, column_statistics in text_statistics.items()})
+    dictionaries = {column: column_statistics.get_dictionary() for column, column_statistics in text_statistics.items()}
+    return statistics, dictionaries
+
+
+def get_expression_normalization_config(column_name, statistics, normalization_method="max"):
+    """
+    Get an "expression" normalization config of a numeric column from its statistics.
+
+    Args:
+        column_name (str): The column to normalize
+        statistics (dict): Statistics of the column from compute_column_statistics
+        normalization_method (str): "max" divides by the maximum, "min_max" scales to [0, 1]
+            and "z_score" subtracts the mean and divides by the standard deviation
+
+    Returns:
+        dict: The normalization config, including the statistics it was computed from
+    """
+    if normalization_method == "max":
+        normalization_expression = "({column_name} / {max_value})"
+        parameters = {"max_value": statistics["max"]}
+    elif normalization_method == "min_max":
+        normalization_expression = "(({column_name} - {min_value}) / {value_range})"
+        parameters = {"min_value": statistics["min"], "value_range": (statistics["max"] - statistics["min"]) or 1}
+    elif normalization_method == "z_score":
+        normalization_expression = "(({column_name} - {mean}) / {std})"
+        parameters = {"mean": statistics["mean"], "std": statistics["std"] or 1}
+    else:
+        raise ValueError(f"Unknown normalization method: {normalization_method}")
+
+    return {
+        "column_enum": column_name,
+        "normalization_type": "expression",
+        "normalization_method": normalization_method,
+        "normalization_expression": normalization_expression,
+        "parameters": parameters,
+        "statistics": statistics
+    }
@@ -2,17 +2,79 @@ import sqlite3
 
 from constants import DB_columns
 
+COMPOUND_KEY_COLUMNS = [DB_columns.GAME_ID.value, DB_columns.TEAM.value, DB_columns.NAME.value]
 
-def create_compound_key_and_index(db_path, table_name, column_names):
+
+def get_compound_key_expression(column_names=COMPOUND_KEY_COLUMNS):
+    """
+    SQL expression building the compound key by concatenating the given columns with underscores.
+    """
+    return " || '_' || ".join(column_names)
+
+
+# Lookup table from integer compound keys to the columns they stand for
+TRAJECTORY_KEYS_TABLE = "trajectory_keys"
+
+
+def create_trajectory_keys_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TRAJECTORY_KEYS_TABLE} (
+            key_id INTEGER PRIMARY KEY,
+            {DB_columns.GAME_ID.value} INTEGER,
+            {DB_columns.TEAM.value} INTEGER,
+            {DB_columns.NAME.value} TEXT,
+            UNIQUE ({', '.join(COMPOUND_KEY_COLUMNS)})
+        )
+    """)
+
+
+def insert_trajectory_keys(cursor, source_table_name, condition="1=1"):
+    """
+    Assign integer keys to the (game_id, team, name) combinations of the source rows that do not have one yet.
+    New keys are numbered in (game_id, team, name) order after the existing ones, so existing keys never change.
+    """
+    create_trajectory_keys_table(cursor)
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO {TRAJECTORY_KEYS_TABLE} ({', '.join(COMPOUND_KEY_COLUMNS)})
+        SELECT DISTINCT {', '.join(COMPOUND_KEY_COLUMNS)}
+        FROM {source_table_name}
+        WHERE {condition}
+        ORDER BY {', '.join(COMPOUND_KEY_COLUMNS)}
+    """)
+    return cursor.rowcount
+
+
+def get_integer_compound_key_expression(source_table_name):
+    """
+    SQL expression looking up the integer compound key of a row of the given source table (or alias).
+    """
+    conditions = " AND ".join(
+        f"{TRAJECTORY_KEYS_TABLE}.{column} = {source_table_name}.{column}" for column in COMPOUND_KEY_COLUMNS)
+    return f"(SELECT key_id FROM {TRAJECTORY_KEYS_TABLE} WHERE {conditions})"
+
+
+def has_integer_compound_key(cursor, table_name):
+    columns = cursor.execute(f"PRAGMA table_info({table_name})").fetchall()
+    return any(column[1] == DB_columns.COMPOUND_KEY.value and column[2].upper() == "INTEGER" for column in columns)
+
+
+def create_compound_key_and_index(db_path, table_name, column_names, integer_keys=False):
     """
     Create a compound key and an index on the given columns in the specified SQLite database table.
+
+    With integer_keys the compound key is an INTEGER surrogate key from the trajectory_keys table instead of
+    the concatenated text, which keeps the index small and makes sorting and grouping cheaper.
+    Integer keys are always built from (game_id, team, name).
     """
     # Connect to the SQLite database
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
     # Construct the compound key by concatenating the given columns with underscores
-    compound_key_expr = " || '_' || ".join(column_names)
+    compound_key_expr = get_compound_key_expression(column_names)
+    if integer_keys:
+        insert_trajectory_keys(cursor, table_name)
+        compound_key_expr = get_integer_compound_key_expression(table_name)
 
     # Check if the compound key column already exists
     check_compound_key_column_sql = f"""
@@ -29,7 +91,7 @@ def create_compound_key_and_index(db_path, table_name, column_names):
         # Add a new column for the compound key
         add_compound_key_column_sql = f"""
         ALTER TABLE {table_name}
-        ADD COLUMN {DB_columns.COMPOUND_KEY.value} TEXT;
+        ADD COLUMN {DB_columns.COMPOUND_KEY.value} {"INTEGER" if integer_keys else "TEXT"};
         """
         cursor.execute(add_compound_key_column_sql)
 
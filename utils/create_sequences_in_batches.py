@@ -1,7 +1,10 @@
+import warnings
+
 import numpy as np
-from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
+from utils.windowed_sequence_dataset import create_windowed_dataset_from_database_rows
+
 
 def create_sequences(rows, H, T, label_indices=[0,1]):
     num_sequences = len(rows) - H - T + 1
@@ -16,56 +19,71 @@ def create_sequences(rows, H, T, label_indices=[0,1]):
     return X, y
 
 
-def create_sequences_from_database_rows(data, H, T, max_H=None, max_T=None, batch_size=1000, label_indices=[0,1]):
-    max_H = max_H or H
-    max_T = max_T or T
-
-    max_row_amount = min([len(rows) for rows in data])
-
-    X_list, y_list = [], []
-    for i in range(0, len(data), batch_size):
-        batch = data[i:i+batch_size]
-        for rows in batch:
-            if len(rows) < H + T:
-                continue
-            # Ensure all sequences are from the same points in time
-            equilength_rows = np.array(rows[:max_row_amount])[
-                max_H-H:-(max_T-T+1)]
-            _X, _y = create_sequences(equilength_rows, H, T, label_indices)
-            if _X.size > 0 and _y.size > 0:
-                X_list.append(_X)
-                y_list.append(_y)
-
-    if X_list and y_list:
-        X = np.array(X_list).reshape(-1, H,
-                                     X_list[0].shape[2]).astype(np.float32)
-        y = np.array(y_list).reshape(-1, y_list[0].shape[1]).astype(np.float32)
-    else:
-        X, y = np.array([]), np.array([])
+def create_sequences_from_database_rows(data, H, T, max_H=None, max_T=None, batch_size=None, label_indices=[0,1], ragged=False, time_column_index=None, time_step=None):
+    # batch_size is kept for the callers that pass it positionally, the windows are no longer built in batches
+    if batch_size is not None:
+        warnings.warn("batch_size of create_sequences_from_database_rows is ignored and deprecated",
+                      DeprecationWarning, stacklevel=2)
+    # The windows are copied once from the lazy dataset, see utils.windowed_sequence_dataset
+    dataset = create_windowed_dataset_from_database_rows(data, H, T, max_H, max_T, label_indices, ragged, time_column_index, time_step)
 
-    return X, y
+    if len(dataset) == 0:
+        return np.array([]), np.array([])
+
+    return dataset.to_arrays()
+
+
+def calculate_sequences_in_batches(H_values, T_values, data, batch_size=None, split=True, test_size=0.2, random_state=None, show_progress=True, label_indices=[0,1], lazy=False, ragged=False):
+    """
+    Calculate the sequences of every (H, T) combination from the same rows.
+
+    The rows are windowed once for max_H and max_T, and every (H, T) is a view of those windows.
+    The train/test split is made once, so all (H, T) share the same split.
 
+    Args:
+        batch_size (int): Ignored and deprecated, the rows are windowed at once
+        lazy (bool): Return WindowedSequenceDataset views as (train_dataset, test_dataset, None, None)
+            instead of copying the windows into (X_train, X_test, y_train, y_test) arrays
+        ragged (bool): Use every window of every trajectory instead of cutting them to the shortest trajectory
 
-def calculate_sequences_in_batches(H_values, T_values, data, batch_size=1000, split=True, test_size=0.2, random_state=None, show_progress=True):
+    Returns:
+        dict: (H, T) mapped to (X_train, X_test, y_train, y_test), or (X, None, y, None) without split
+    """
+    if batch_size is not None:
+        warnings.warn("batch_size of calculate_sequences_in_batches is ignored and deprecated",
+                      DeprecationWarning, stacklevel=2)
     sequences = {}
 
     # Get the max H and T values
     max_H = max(H_values)
     max_T = max(T_values)
 
-    for H in tqdm(H_values, desc='H loop', leave=False):
-        for T in tqdm(T_values, desc='T loop', leave=False):
-            X, y = create_sequences_from_database_rows(
-                data, H, T, max_H, max_T, batch_size)
-            if X.size > 0 and y.size > 0:
-                if split:
-                    X_train, X_test, y_train, y_test = train_test_split(
-                        X, y, test_size=test_size, random_state=random_state)
+    base_dataset = create_windowed_dataset_from_database_rows(
+        data, max_H, max_T, max_H, max_T, label_indices, ragged)
+    if len(base_dataset) > 0 and split:
+        base_train_dataset, base_test_dataset = base_dataset.split(
+            test_size=test_size, random_state=random_state)
+
+    for H in tqdm(H_values, desc='H loop', leave=False, disable=not show_progress):
+        for T in tqdm(T_values, desc='T loop', leave=False, disable=not show_progress):
+            if len(base_dataset) == 0:
+                sequences[(H, T)] = (np.array([]), np.array([]),
+                                     np.array([]), np.array([]))
+            elif split:
+                train_dataset = base_train_dataset.with_horizon(H, T)
+                test_dataset = base_test_dataset.with_horizon(H, T)
+                if lazy:
+                    sequences[(H, T)] = (train_dataset, test_dataset, None, None)
+                else:
+                    X_train, y_train = train_dataset.to_arrays()
+                    X_test, y_test = test_dataset.to_arrays()
                     sequences[(H, T)] = (X_train, X_test, y_train, y_test)
+            else:
+                dataset = base_dataset.with_horizon(H, T)
+                if lazy:
+                    sequences[(H, T)] = (dataset, None, None, None)
                 else:
+                    X, y = dataset.to_arrays()
                     sequences[(H, T)] = (X, None, y, None)
-            else:
-                sequences[(H, T)] = (np.array([]), np.array([]),
-                                     np.array([]), np.array([]))
 
-    return sequences
\ No newline at end of file
+    return sequences
@@ -0,0 +1,370 @@
+import os
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tqdm import tqdm
+
+from constants import DB_columns, GAME_AREA_WIDTH
+from utils.sqlite_pragmas import BULK_LOAD_PRAGMAS, apply_pragmas
+
+# The raw columns of a replay database, in the order of DB_columns
+REPLAY_COLUMNS = [column for column in DB_columns
+                  if not column.value.startswith("normalized_") and column != DB_columns.COMPOUND_KEY]
+INTEGER_COLUMNS = [DB_columns.GAME_ID, DB_columns.LEVEL, DB_columns.VISIBLE, DB_columns.TEAM]
+TEXT_COLUMNS = [DB_columns.NAME, DB_columns.Q_NAME, DB_columns.W_NAME, DB_columns.E_NAME, DB_columns.R_NAME,
+                DB_columns.D_NAME, DB_columns.F_NAME]
+SPELL_COLUMNS = [(DB_columns.Q_NAME, DB_columns.Q_CD), (DB_columns.W_NAME, DB_columns.W_CD),
+                 (DB_columns.E_NAME, DB_columns.E_CD), (DB_columns.R_NAME, DB_columns.R_CD),
+                 (DB_columns.D_NAME, DB_columns.D_CD), (DB_columns.F_NAME, DB_columns.F_CD)]
+
+TEAMS = [100, 200]
+ROLES = ["top", "jungle", "mid", "bot", "support"]
+DEFAULT_TICK_INTERVAL = 0.25
+
+# Fountains of the blue (100) and red (200) team
+FOUNTAINS = np.array([[400.0, 420.0], [14340.0, 14390.0]])
+# Lanes from the blue base to the red base
+LANES = {
+    "top": np.array([[600.0, 1800.0], [1300.0, 13600.0], [13000.0, 14200.0]]),
+    "mid": np.array([[1800.0, 1800.0], [13000.0, 13000.0]]),
+    "bot": np.array([[1800.0, 600.0], [13600.0, 1300.0], [14200.0, 13000.0]]),
+}
+# Jungle camps of the blue side, the camps of the red side are mirrored over the map
+BLUE_CAMPS = np.array([[3800.0, 7900.0], [3800.0, 6500.0], [7000.0, 5400.0], [7800.0, 4000.0], [8400.0, 2700.0], [2100.0, 8400.0]])
+MAP_MIRROR = 14800.0
+
+# Modes of a player
+ACTIVE, RECALLING, SHOPPING, DEAD = range(4)
+RECALL_TIME = 8.0
+VISION_RANGE = 1350.0
+ENGAGE_RANGE = 900.0
+LEVEL_UP_TIME = 2100.0
+
+# Stat profiles of the roles: (base hp, hp per level, base mana, ad, ad per minute, ap per minute, attack range, speed)
+ROLE_STATS = {
+    "top": (640.0, 105.0, 320.0, 66.0, 2.0, 0.5, 175.0, 345.0),
+    "jungle": (610.0, 100.0, 300.0, 63.0, 2.2, 1.0, 150.0, 350.0),
+    "mid": (580.0, 92.0, 450.0, 55.0, 0.8, 6.0, 525.0, 335.0),
+    "bot": (570.0, 92.0, 350.0, 60.0, 3.5, 0.3, 600.0, 330.0),
+    "support": (560.0, 88.0, 420.0, 50.0, 0.5, 2.5, 550.0, 335.0),
+}
+# Base cooldowns of the q, w, e, r, d and f spells in seconds
+BASE_COOLDOWNS = np.array([8.0, 14.0, 16.0, 100.0, 300.0, 240.0])
+# Chance per second of casting a ready spell while engaged
+CAST_RATES = np.array([0.8, 0.4, 0.4, 0.1, 0.02, 0.03])
+SUMMONER_SPELLS = {"top": ("SummonerFlash", "SummonerTeleport"), "jungle": ("SummonerFlash", "SummonerSmite"),
+                   "mid": ("SummonerFlash", "SummonerDot"), "bot": ("SummonerFlash", "SummonerHeal"),
+                   "support": ("SummonerFlash", "SummonerExhaust")}
+
+
+def get_normalization_cases(normalization_config_file="normalization_config.json"):
+    """
+    The known values of the categorical columns, so the generated names can be normalized like real replays.
+
+    Returns:
+        dict: Column name to the sorted values of its cases
+    """
+    with open(normalization_config_file, "r") as f:
+        normalization_config = json.load(f)
+    return {config["column_enum"]: sorted(config["cases"]) for config in normalization_config
+            if config["normalization_type"] == "case"}
+
+
+def get_spell_name(champion, spell_names, key):
+    # The spells of a champion are named after it in the replays, e.g. AhriQ
+    spell_name = f"{champion}{key.upper()}"
+    if spell_name in spell_names:
+        return spell_name
+    own_spells = [name for name in spell_names if name.startswith(champion)]
+    return own_spells[0] if own_spells else spell_name
+
+
+def get_lane_points(lane, fractions):
+    """
+    Points at the given fractions of the length of a lane, from the blue base to the red base.
+    """
+    segment_lengths = np.linalg.norm(np.diff(lane, axis=0), axis=1)
+    cumulative_lengths = np.concatenate(([0.0], np.cumsum(segment_lengths))) / segment_lengths.sum()
+    return np.stack([np.interp(fractions, cumulative_lengths, lane[:, axis]) for axis in range(2)], axis=-1)
+
+
+def get_level(time, experience_rate):
+    return np.clip(np.floor(1 + 17 * (time / LEVEL_UP_TIME) ** 0.7 * experience_rate), 1, 18)
+
+
+def simulate_replay(game_id, ticks, players=10, tick_interval=DEFAULT_TICK_INTERVAL, seed=0, cases=None):
+    """
+    Simulate one game as the per-tick snapshots of every player, in the columns of DB_columns.
+
+    The players of each team get the roles top, jungle, mid, bot and support in turn. Laners follow the front of
+    their lane, which moves back and forth over time, supports follow their bot laner and junglers clear the camps
+    of their side and gank the lanes. Players take damage from the enemies in range and from the spells they cast,
+    recall when low, die at zero HP and respawn at their fountain after a death timer that grows with their level.
+    Levels, and with them the stats, grow over the game. Cooldowns count down and are reset when a spell is cast.
+
+    The same arguments always produce the same replay.
+
+    Args:
+        game_id (int): Game id of the rows, also seeds the game
+        ticks (int): Snapshots per player
+        players (int): Players of both teams together
+        tick_interval (float): Seconds between the snapshots
+        cases (dict): Known categorical values, see get_normalization_cases
+
+    Returns:
+        dict: Column name to an array of ticks * players values, ordered by tick and then player
+    """
+    cases = cases if cases is not None else get_normalization_cases()
+    rng = np.random.default_rng([seed, game_id])
+
+    team_indices = np.arange(players) % 2
+    team_roles = [ROLES[(player // 2) % len(ROLES)] for player in range(players)]
+    champions = rng.choice(cases[DB_columns.NAME.value], players, replace=False)
+    enemies = team_indices[:, None] != team_indices[None, :]
+    fountains = FOUNTAINS[team_indices]
+    # Blue players stand on the blue side of the front of their lane, red players on the red side
+    front_offsets = np.where(team_indices == 0, -0.02, 0.02)
+    is_jungler = np.array([role == "jungle" for role in team_roles])
+
+    role_stats = np.array([ROLE_STATS[role] for role in team_roles]).T
+    # Every champion differs a little from the profile of its role
+    base_hp, hp_per_level, base_mana, base_ad, ad_per_minute, ap_per_minute, attack_range, speed = \
+        role_stats * rng.uniform(0.9, 1.1, role_stats.shape)
+    experience_rate = np.where(np.array(team_roles) == "support", 0.85, np.where(is_jungler, 0.95, 1.0)) * rng.uniform(0.95, 1.05, players)
+    cooldowns = BASE_COOLDOWNS * rng.uniform(0.8, 1.2, (players, len(BASE_COOLDOWNS)))
+
+    # The partner of a support is the bot laner of its team
+    partners = np.array([next((other for other in range(players) if team_indices[other] == team_indices[player]
+                               and team_roles[other] == "bot"), player) for player in range(players)])
+    is_support = np.array([role == "support" for role in team_roles])
+    camps = [BLUE_CAMPS, MAP_MIRROR - BLUE_CAMPS]
+
+    time = np.arange(ticks) * tick_interval
+    # The fronts of the lanes move back and forth over the game, the laners follow the front of their lane
+    lane_fronts = 0.5 + 0.15 * np.sin(2 * np.pi * time[:, None] / rng.uniform(60, 120, len(LANES)) + rng.uniform(0, 2 * np.pi, len(LANES)))
+    lane_front_points = np.stack([get_lane_points(lane, lane_fronts[:, i]) for i, lane in enumerate(LANES.values())], axis=1)
+    lane_targets = np.empty((ticks, players, 2))
+    for player in range(players):
+        lane_index = list(LANES).index("bot" if is_support[player] or is_jungler[player] else team_roles[player])
+        lane_targets[:, player] = get_lane_points(list(LANES.values())[lane_index], lane_fronts[:, lane_index] + front_offsets[player])
+    level = get_level(time[:, None], experience_rate[None, :])
+    minutes = time[:, None] / 60
+    max_hp = base_hp + hp_per_level * (level - 1) + 25 * minutes
+    max_mana = base_mana + 40 * (level - 1)
+    armor = rng.uniform(25, 40, players) + 4.2 * (level - 1) + 0.8 * minutes
+    mr = rng.uniform(28, 32, players) + 1.3 * (level - 1) + 0.5 * minutes
+    ad = base_ad + 3.0 * (level - 1) + ad_per_minute * minutes
+    ap = ap_per_minute * minutes
+    attack_range = np.broadcast_to(attack_range, (ticks, players))
+    # Cooldowns shrink with ability haste over the game
+    haste = 1 / (1 + np.minimum(minutes, 40)[:, :, None] / 100)
+
+    positions = np.empty((ticks, players, 2))
+    hp = np.empty((ticks, players))
+    mana = np.empty((ticks, players))
+    visible = np.empty((ticks, players), dtype=np.int64)
+    remaining_cooldowns = np.empty((ticks, players, len(BASE_COOLDOWNS)))
+
+    position = fountains + rng.normal(0, 100, (players, 2))
+    current_hp = max_hp[0].copy()
+    current_mana = max_mana[0].copy()
+    current_cooldowns = np.zeros((players, len(BASE_COOLDOWNS)))
+    mode = np.full(players, ACTIVE)
+    mode_timer = np.zeros(players)
+    jungle_target = np.array([camps[team][rng.integers(len(BLUE_CAMPS))] for team in team_indices])
+    jungle_timer = np.zeros(players)
+    wander = rng.normal(0, 1, (players, 2))
+
+    for tick in range(ticks):
+        # Junglers pick a new camp, or a lane to gank, once they have cleared the previous one
+        for player in np.flatnonzero(is_jungler & (jungle_timer <= 0)):
+            if rng.random() < 0.25:
+                jungle_target[player] = lane_front_points[tick, rng.integers(len(LANES))]
+            else:
+                jungle_target[player] = camps[team_indices[player]][rng.integers(len(BLUE_CAMPS))]
+            jungle_timer[player] = rng.uniform(25, 45)
+
+        # Targets of the active players
+        wander = 0.95 * wander + rng.normal(0, 0.3, (players, 2))
+        targets = lane_targets[tick].copy()
+        targets[is_jungler] = jungle_target[is_jungler]
+        targets[is_support] = position[partners[is_support]] + np.array([-150.0, 150.0])
+        targets += 120 * wander
+
+        # Move towards the targets
+        active = mode == ACTIVE
+        direction = targets - position
+        distance = np.linalg.norm(direction, axis=1)
+        step = np.minimum(speed * tick_interval, distance) / np.maximum(distance, 1e-9)
+        position[active] += direction[active] * step[active, None]
+        jungle_timer -= np.where(distance < 300, tick_interval, tick_interval / 4)
+
+        # Damage from the enemies in range, by auto attacks and by the spells they cast
+        distances = np.linalg.norm(position[:, None, :] - position[None, :, :], axis=2)
+        alive = mode != DEAD
+        in_range = enemies & (distances < np.maximum(attack_range[tick], ENGAGE_RANGE)[:, None]) & alive[:, None] & alive[None, :]
+        engaged = in_range.any(axis=1) & active
+        ready = (current_cooldowns <= 0) & (level[tick][:, None] >= np.array([1, 1, 1, 6, 1, 1]))
+        casts = ready & engaged[:, None] & (rng.random(current_cooldowns.shape) < CAST_RATES * tick_interval)
+        # Smite is cast on the camps as well
+        casts[:, 5] |= ready[:, 5] & is_jungler & active & (distance < 300) & (rng.random(players) < 0.05 * tick_interval)
+        attacks = engaged & (rng.random(players) < 0.8 * tick_interval)
+        spell_damage = casts[:, :4].sum(axis=1) * (0.6 * ap[tick] + 0.4 * ad[tick] + 40 * level[tick])
+        damage_dealt = attacks * ad[tick] + spell_damage
+        targets_in_range = np.maximum(in_range.sum(axis=1), 1)
+        damage_taken = (in_range * (damage_dealt / targets_in_range)[:, None]).sum(axis=0)
+        damage_taken *= 100 / (100 + armor[tick])
+        # Minions and camps chip away at the players who are not in a fight
+        damage_taken += active * ~engaged * (distance < 400) * rng.exponential(0.004, players) * max_hp[tick]
+
+        current_cooldowns = np.where(casts, cooldowns * haste[tick], np.maximum(current_cooldowns - tick_interval, 0))
+        current_mana = np.clip(current_mana - casts[:, :4].sum(axis=1) * 0.07 * max_mana[tick]
+                               + 0.004 * max_mana[tick] * tick_interval, 0, max_mana[tick])
+        current_hp = np.where(alive, current_hp - damage_taken + 0.003 * max_hp[tick] * tick_interval, 0)
+        current_hp = np.minimum(current_hp, max_hp[tick])
+
+        # Deaths, recalls and respawns
+        dying = alive & (current_hp <= 0)
+        mode[dying] = DEAD
+        mode_timer[dying] = np.minimum(4 + 1.6 * level[tick][dying], 50)
+        current_hp[dying] = 0
+        recalling = active & ~dying & ~engaged & ((current_hp < 0.3 * max_hp[tick]) | (rng.random(players) < tick_interval / 300))
+        mode[recalling] = RECALLING
+        mode_timer[recalling] = RECALL_TIME
+
+        mode_timer -= tick_interval
+        finished = (mode != ACTIVE) & (mode_timer <= 0)
+        arrived = finished & ((mode == RECALLING) | (mode == DEAD))
+        position[arrived] = fountains[arrived] + rng.normal(0, 100, (arrived.sum(), 2))
+        current_hp[arrived] = max_hp[tick][arrived]
+        current_mana[arrived] = max_mana[tick][arrived]
+        mode_timer[arrived] = rng.uniform(3, 12, arrived.sum())
+        mode[finished & (mode == SHOPPING)] = ACTIVE
+        mode[arrived] = SHOPPING
+
+        positions[tick] = position
+        hp[tick] = current_hp
+        mana[tick] = current_mana
+        remaining_cooldowns[tick] = current_cooldowns
+        # Players are visible near their enemies and in the warded river
+        river = np.abs(position[:, 0] - position[:, 1]) < 900
+        visible[tick] = ((distances < VISION_RANGE) & enemies).any(axis=1) | river
+
+    positions = np.clip(positions, 1, GAME_AREA_WIDTH - 1)
+
+    spell_names = []
+    for (name_column, _), key in zip(SPELL_COLUMNS[:4], "qwer"):
+        spell_names.append([get_spell_name(champion, cases.get(name_column.value, []), key) for champion in champions])
+    spell_names += [[SUMMONER_SPELLS[role][0] for role in team_roles], [SUMMONER_SPELLS[role][1] for role in team_roles]]
+
+    def per_tick(values):
+        return np.tile(np.asarray(values), ticks)
+
+    replay = {
+        DB_columns.GAME_ID.value: np.full(ticks * players, game_id),
+        DB_columns.TIME.value: np.repeat(time, players),
+        DB_columns.NAME.value: per_tick(champions),
+        DB_columns.HP.value: hp.ravel(),
+        DB_columns.MAX_HP.value: max_hp.ravel(),
+        DB_columns.MANA.value: mana.ravel(),
+        DB_columns.MAX_MANA.value: max_mana.ravel(),
+        DB_columns.ARMOR.value: armor.ravel(),
+        DB_columns.MR.value: mr.ravel(),
+        DB_columns.AD.value: ad.ravel(),
+        DB_columns.AP.value: ap.ravel(),
+        DB_columns.LEVEL.value: level.astype(np.int64).ravel(),
+        DB_columns.ATK_RANGE.value: attack_range.ravel(),
+        DB_columns.VISIBLE.value: visible.ravel(),
+        DB_columns.TEAM.value: per_tick(np.array(TEAMS)[team_indices]),
+        DB_columns.POS_X.value: positions[:, :, 0].ravel(),
+        DB_columns.POS_Z.value: positions[:, :, 1].ravel(),
+    }
+    for spell, ((name_column, cooldown_column), names) in enumerate(zip(SPELL_COLUMNS, spell_names)):
+        replay[name_column.value] = per_tick(names)
+        replay[cooldown_column.value] = remaining_cooldowns[:, :, spell].ravel()
+    return replay
+
+
+def write_replay_database(database_file, replay, table_name="champs"):
+    """
+    Write a simulated replay into a new database with a table in the columns of a TLoL replay database.
+
+    Returns:
+        int: The amount of written rows
+    """
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    conn = sqlite3.connect(database_file, isolation_level=None)
+    cursor = conn.cursor()
+    # A failed write leaves a partial file anyway, which is replaced on the next run
+    apply_pragmas(cursor, {**BULK_LOAD_PRAGMAS, "journal_mode": "OFF"})
+
+    column_types = {column: "INTEGER" if column in INTEGER_COLUMNS else "TEXT" if column in TEXT_COLUMNS else "REAL"
+                    for column in REPLAY_COLUMNS}
+    cursor.execute(f"CREATE TABLE {table_name} ({', '.join(f'{column.value} {column_types[column]}' for column in REPLAY_COLUMNS)})")
+    cursor.execute("BEGIN")
+    cursor.executemany(
+        f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * len(REPLAY_COLUMNS))})",
+        zip(*[replay[column.value].tolist() for column in REPLAY_COLUMNS]))
+    cursor.execute("COMMIT")
+    conn.close()
+    return len(replay[DB_columns.GAME_ID.value])
+
+
+def generate_synthetic_replay_database(database_file, game_id, ticks, players=10, tick_interval=DEFAULT_TICK_INTERVAL, seed=0, cases=None):
+    return write_replay_database(database_file, simulate_replay(game_id, ticks, players, tick_interval, seed, cases))
+
+
+def _generate_replay_task(task):
+    return generate_synthetic_replay_database(*task)
+
+
+def generate_synthetic_replays(database_folder, games, ticks, players=10, tick_interval=DEFAULT_TICK_INTERVAL, seed=0, first_game_id=1000000000, workers=None):
+    """
+    Generate a folder of simulated per-match replay databases, e.g. as the DATABASE_FOLDER of
+    get_or_create_combined_database. See simulate_replay for the simulation.
+
+    The games are simulated and written in parallel, one database file per game named like the real replays.
+    A game takes roughly 220 bytes per row on disk, i.e. ticks * players * 220 bytes.
+
+    Args:
+        database_folder (str): Folder to write the databases to
+        games (int): Amount of games
+        ticks (int): Snapshots per player per game
+        players (int): Players per game
+        tick_interval (float): Seconds between the snapshots
+        seed (int): Seed of the games, the same seed always produces the same files
+        first_game_id (int): Game id of the first game, the following games get consecutive ids
+        workers (int): Processes writing games, all cores by default
+
+    Returns:
+        int: The amount of written rows
+    """
+    os.makedirs(database_folder, exist_ok=True)
+    cases = get_normalization_cases()
+    tasks = [(os.path.join(database_folder, f"SYN1-{game_id}.db"), game_id, ticks, players, tick_interval, seed, cases)
+             for game_id in range(first_game_id, first_game_id + games)]
+
+    rows = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for game_rows in tqdm(executor.map(_generate_replay_task, tasks), total=len(tasks), desc="Generating replays"):
+            rows += game_rows
+    print(f"Generated {games} games with {rows} rows in {database_folder}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate simulated per-match replay databases")
+    parser.add_argument("database_folder")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--ticks", type=int, default=7200)
+    parser.add_argument("--players", type=int, default=10)
+    parser.add_argument("--tick-interval", type=float, default=DEFAULT_TICK_INTERVAL)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--first-game-id", type=int, default=1000000000)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    generate_synthetic_replays(args.database_folder, args.games, args.ticks, args.players, args.tick_interval,
+                               args.seed, args.first_game_id, args.workers)
@@ -1,9 +1,13 @@
-import dis
+import io
+import os
 import sqlite3
-from collections import defaultdict
+import base64
+import hashlib
+import json
+import weakref
+from collections import OrderedDict, defaultdict
 import numpy as np
-from tqdm import tqdm
-from typing import Any, Dict, List
+from typing import Dict, Tuple
 
 from constants import DB_columns, DEFAULT_DATA_FEATURES
 
@@ -13,108 +17,262 @@ def get_table_columns(cursor, table_name):
     columns = cursor.fetchall()
     return columns
 
+# Normalization config that the cleaned tables are built from, part of the cache fingerprint
+NORMALIZATION_CONFIG_FILE = "normalization_config.json"
+
+# Table holding the cached counts as packed NumPy arrays
+COUNT_CACHE_TABLE = "count_cache_arrays"
+# Text based cache table used by earlier versions
+LEGACY_COUNT_CACHE_TABLE = "count_cache"
+
+# Rows without a compound key are not part of any trajectory. NULL keys sort first, so they would shift
+# the row offsets of the keys, and would need object arrays, which can not be stored without pickling
+NOT_NULL_KEY = f"{DB_columns.COMPOUND_KEY.value} IS NOT NULL"
+
+DEFAULT_CACHE_BYTE_BUDGET = 256 * 1024 * 1024
+
+
+class CountCache:
+    """
+    In-memory LRU cache of (counts, keys) arrays, bounded by the total size of the arrays in bytes.
+    Entries are keyed on (table_name, query, fingerprint).
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTE_BUDGET):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[str, str, str], Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, counts, keys):
+        self.remove(key)
+        nbytes = counts.nbytes + keys.nbytes
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (counts, keys)
+        self.size += nbytes
+        self.evict()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0].nbytes + entry[1].nbytes
+
+    def evict(self):
+        # Drop least recently used entries until the cache fits in the budget
+        while self.size > self.max_bytes and self.entries:
+            _, (counts, keys) = self.entries.popitem(last=False)
+            self.size -= counts.nbytes + keys.nbytes
+
+    def clear(self, table_name=None):
+        for key in [key for key in self.entries if table_name is None or key[0] == table_name]:
+            self.remove(key)
+
+
 # In-memory cache
-cache: Dict[str, Any] = {
-    "counts": {},
-    "keys": {}
-}
+cache = CountCache()
+
+def set_cache_byte_budget(max_bytes):
+    cache.max_bytes = max_bytes
+    cache.evict()
+
+# Pack an array into a BLOB, without pickling
+def pack_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def unpack_array(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+# Hash of the normalization config, memoized on the file modification time
+_normalization_config_hash: Dict[Tuple[float, int], str] = {}
+
+def get_normalization_config_hash(config_file=NORMALIZATION_CONFIG_FILE):
+    if not os.path.exists(config_file):
+        return ""
+    stat = os.stat(config_file)
+    memo_key = (stat.st_mtime, stat.st_size)
+    if memo_key not in _normalization_config_hash:
+        _normalization_config_hash.clear()
+        with open(config_file, "rb") as f:
+            _normalization_config_hash[memo_key] = hashlib.sha1(f.read()).hexdigest()
+    return _normalization_config_hash[memo_key]
+
+# Fingerprints per cursor and table, valid while the database has not been changed.
+# Keyed on the cursor because connections can not be weakly referenced, entries go away with their cursor
+_fingerprints: "weakref.WeakKeyDictionary[sqlite3.Cursor, Dict[str, Tuple[int, int, str]]]" = weakref.WeakKeyDictionary()
+
+def get_table_fingerprint(cursor, table_name):
+    """
+    Fingerprint of the contents of a table: row count, max rowid and the hash of the normalization config.
+    Cache entries with a different fingerprint are stale and get recomputed.
+
+    The fingerprint is memoized per cursor until PRAGMA data_version or the connection's own
+    change counter shows that the database has been written to.
+    """
+    connection = cursor.connection
+    data_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+    memo = _fingerprints.setdefault(cursor, {})
+    entry = memo.get(table_name)
+    if entry is not None and entry[:2] == (data_version, connection.total_changes):
+        table_fingerprint = entry[2]
+    else:
+        row_count, max_rowid = cursor.execute(
+            f"SELECT COUNT(*), MAX(rowid) FROM {table_name}").fetchone()
+        table_fingerprint = f"{row_count}:{max_rowid}"
+        memo[table_name] = (data_version, connection.total_changes, table_fingerprint)
+    return f"{table_fingerprint}:{get_normalization_config_hash()}"
 
 # Function to create cache table if it doesn't exist
 def create_cache_table(cursor):
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS count_cache (
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {COUNT_CACHE_TABLE} (
             table_name TEXT,
-            filter TEXT,
-            counts TEXT,
-            PRIMARY KEY (table_name, filter)
+            query TEXT,
+            fingerprint TEXT,
+            counts BLOB,
+            keys BLOB,
+            row_limit INTEGER,
+            PRIMARY KEY (table_name, query)
         )
     """)
+    # Migrate cache tables created before entries stored their row limit
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({COUNT_CACHE_TABLE})").fetchall()]
+    if "row_limit" not in columns:
+        cursor.execute(f"ALTER TABLE {COUNT_CACHE_TABLE} ADD COLUMN row_limit INTEGER")
     cursor.connection.commit()
 
-def clear_cache(cursor):
-    global cache
-    cache["counts"] = {}
+def clear_cache(cursor, table_name=None):
+    cache.clear(table_name)
 
     # Clear cache table
-    cursor.execute("DELETE FROM count_cache")
+    create_cache_table(cursor)
+    if table_name is None:
+        cursor.execute(f"DELETE FROM {COUNT_CACHE_TABLE}")
+    else:
+        cursor.execute(f"DELETE FROM {COUNT_CACHE_TABLE} WHERE table_name = ?", (table_name,))
+    cursor.execute(f"DROP TABLE IF EXISTS {LEGACY_COUNT_CACHE_TABLE}")
     cursor.connection.commit()
 
-# Function to fetch count from cache
-def fetch_count_from_cache(cursor, table_name, filter):
-    cursor.execute("""
-        SELECT counts FROM count_cache WHERE table_name = ? AND filter = ?
-    """, (table_name, filter))
+# Function to fetch counts from cache, returns None if missing or stale
+def fetch_count_from_cache(cursor, table_name, query, fingerprint):
+    cursor.execute(f"""
+        SELECT counts, keys FROM {COUNT_CACHE_TABLE} WHERE table_name = ? AND query = ? AND fingerprint = ?
+    """, (table_name, query, fingerprint))
     row = cursor.fetchone()
     if row:
-        counts = eval(row[0])
-        return counts
+        return unpack_array(row[0]), unpack_array(row[1])
     return None
 
-# Function to save count to cache
-def save_count_to_cache(cursor, table_name, filter, counts):
-    global cache 
+# Function to save counts to cache
+def save_count_to_cache(cursor, table_name, query, fingerprint, counts, keys, row_limit=None):
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO {COUNT_CACHE_TABLE} (table_name, query, fingerprint, counts, keys, row_limit) VALUES (?, ?, ?, ?, ?, ?)
+    """, (table_name, query, fingerprint, pack_array(counts), pack_array(keys), row_limit))
+
+    cursor.connection.commit()
+    cache.put((table_name, query, fingerprint), counts, keys)
+
+def invalidate_cache_for_new_keys(cursor, table_name, first_new_key, previous_fingerprint):
+    """
+    Update the cache after rows with new compound keys, all greater or equal to first_new_key, were appended to a table.
 
-    counts_str = str(counts)
-    cursor.execute("""
-        INSERT OR REPLACE INTO count_cache (table_name, filter, counts) VALUES (?, ?, ?)
-    """, (table_name, filter, counts_str))
+    Entries that were valid before the append and whose keys all come before the new keys are moved to the
+    new fingerprint of the table. Entries that could contain new keys, or that ran to the end of the table, are deleted.
+    """
+    cache.clear(table_name)
+    create_cache_table(cursor)
+    fingerprint = get_table_fingerprint(cursor, table_name)
 
+    entries = cursor.execute(f"""
+        SELECT query, keys, row_limit FROM {COUNT_CACHE_TABLE} WHERE table_name = ? AND fingerprint = ?
+    """, (table_name, previous_fingerprint)).fetchall()
+
+    kept_entries = 0
+    for query, keys_blob, row_limit in entries:
+        keys = unpack_array(keys_blob)
+        unaffected = row_limit is not None and 0 < len(keys) == row_limit and keys[-1].item() < first_new_key
+        if unaffected:
+            cursor.execute(f"UPDATE {COUNT_CACHE_TABLE} SET fingerprint = ? WHERE table_name = ? AND query = ?",
+                           (fingerprint, table_name, query))
+            kept_entries += 1
+        else:
+            cursor.execute(f"DELETE FROM {COUNT_CACHE_TABLE} WHERE table_name = ? AND query = ?", (table_name, query))
     cursor.connection.commit()
-    cache["counts"][filter] = {
-        "counts": counts
-    }
 
+    print(f"Kept {kept_entries} and invalidated {len(entries) - kept_entries} cache entries of {table_name}")
 
-# Get amount of unique keys in a table
-def get_unique_key_count(cursor, table_name, filter="1=1"):
-    global cache
+def get_cached_query(cursor, table_name, query, description, row_limit=None):
+    """
+    Run a counting query through the in-memory and database caches.
+    The query must return rows of (count, compound_key) or a single count.
+    row_limit is the LIMIT of the query, used when invalidating entries after an append.
 
+    Returns:
+        tuple: (counts, keys) arrays
+    """
     # Create cache table if it doesn't exist
     create_cache_table(cursor)
+    fingerprint = get_table_fingerprint(cursor, table_name)
 
-    count_query = f"""
-        SELECT COUNT(DISTINCT {DB_columns.COMPOUND_KEY.value})
-        FROM {table_name}
-        WHERE {filter}
-    """
-        
     # Check in-memory cache
-    if count_query in cache["keys"]:
-        print("Using in-memory cache for keys")
-        keys = cache["keys"][count_query]
-        return keys
+    entry = cache.get((table_name, query, fingerprint))
+    if entry is not None:
+        print(f"Using in-memory cache for {description}")
+        return entry
 
     # Check database cache
-    keys = fetch_count_from_cache(cursor, table_name, count_query)
+    entry = fetch_count_from_cache(cursor, table_name, query, fingerprint)
+    if entry is not None:
+        print(f"Using database cache for {description}")
+        cache.put((table_name, query, fingerprint), *entry)
+        return entry
 
-    if keys is not None:
-        print("Using database cache for key count")
-        cache["keys"][count_query] = keys
-        return keys
-
-    print("Counting keys...")
-    cursor.execute(count_query)
-    key_count = cursor.fetchone()[0]
-    print(f"Key count: {key_count}")
+    print(f"Counting {description}...")
+    rows = cursor.execute(query).fetchall()
+    counts = np.array([row[0] for row in rows], dtype=np.int64)
+    keys = np.array([row[1] for row in rows] if rows and len(rows[0]) > 1 else [])
+    print(f"Counted {len(counts)} entries for {description}")
 
     # Save results to cache table
-    save_count_to_cache(cursor, table_name, count_query, key_count)
+    save_count_to_cache(cursor, table_name, query, fingerprint, counts, keys, row_limit)
+
+    return counts, keys
+
 
+# Get amount of unique keys in a table
+def get_unique_key_count(cursor, table_name, filter="1=1"):
+    count_query = f"""
+        SELECT COUNT(DISTINCT {DB_columns.COMPOUND_KEY.value})
+        FROM {table_name}
+        WHERE {filter}
+    """
+    counts, _ = get_cached_query(cursor, table_name, count_query, "key count")
+    key_count = int(counts[0])
+    print(f"Key count: {key_count}")
     return key_count
 
 
-def get_counts(cursor, table_name, filter="1=1", limit=None, offset=None, recreate_cache=False):
-    global cache
-    
+def get_count_arrays(cursor, table_name, filter="1=1", limit=None, offset=None, recreate_cache=False):
+    """
+    Get the row count of each compound key as arrays.
+
+    Returns:
+        tuple: (counts, keys) where counts is an int64 array and keys holds the matching compound keys
+    """
     if recreate_cache:
-        cursor.execute("DELETE FROM count_cache")
-    # Create cache table if it doesn't exist
-    create_cache_table(cursor)
-    
+        clear_cache(cursor, table_name)
+
     count_query = f"""
         SELECT COUNT(*), {DB_columns.COMPOUND_KEY.value}
         FROM {table_name}
-        WHERE {filter}
+        WHERE ({filter}) AND {NOT_NULL_KEY}
         GROUP BY {DB_columns.COMPOUND_KEY.value}
         ORDER BY {DB_columns.COMPOUND_KEY.value}
     """
@@ -123,61 +281,145 @@ def get_counts(cursor, table_name, filter="1=1", limit=None, offset=None, recrea
     if offset is not None:
         count_query += f" OFFSET {offset}"
 
-    # Check in-memory cache
-    if count_query in cache["counts"]:
-        print("Using in-memory cache for counts")
-        counts = cache["counts"][count_query]["counts"]
-        return counts
+    return get_cached_query(cursor, table_name, count_query, "counts", limit)
 
-    # Check database cache
-    counts = fetch_count_from_cache(cursor, table_name, count_query)
-    if counts is not None:
-        print("Using database cache for counts")
-        cache["counts"][count_query] = {
-            "counts": counts
-        }
-        return counts
-            
-    print("Counting rows...")
-    cursor.execute(count_query)
-    counts = cursor.fetchall()
-    print(f"Counts: {counts}")
-    
-    # Save results to cache table
-    save_count_to_cache(cursor, table_name, count_query, counts)
-    
-    return counts
+
+def get_counts(cursor, table_name, filter="1=1", limit=None, offset=None, recreate_cache=False):
+    counts, keys = get_count_arrays(cursor, table_name, filter, limit, offset, recreate_cache)
+    return list(zip(counts.tolist(), keys.tolist()))
 
 def get_data_by_compound_key(cursor, table_name, offset, limit, filter, data_features=DEFAULT_DATA_FEATURES):
     query = f"""
         SELECT {','.join(data_features)}
         FROM {table_name}
-        WHERE {filter}
+        WHERE ({filter}) AND {NOT_NULL_KEY}
         ORDER BY {DB_columns.COMPOUND_KEY.value}
         LIMIT {limit} OFFSET {offset}
     """
     return cursor.execute(query).fetchall()
 
+def encode_continuation_token(table_name, filter, last_key):
+    """
+    Encode the position after the given compound key into an opaque continuation token.
+    """
+    filter_hash = hashlib.sha1(filter.encode("utf-8")).hexdigest()
+    token = json.dumps({"table_name": table_name, "filter": filter_hash, "last_key": last_key})
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+def decode_continuation_token(table_name, filter, continuation_token):
+    """
+    Decode a continuation token into the last compound key that was returned, or None for the start of the table.
+    """
+    if continuation_token is None:
+        return None
+    token = json.loads(base64.urlsafe_b64decode(continuation_token.encode("ascii")))
+    filter_hash = hashlib.sha1(filter.encode("utf-8")).hexdigest()
+    if token["table_name"] != table_name or token["filter"] != filter_hash:
+        raise ValueError("Continuation token was created for a different table or filter")
+    return token["last_key"]
+
+def get_counts_after(cursor, table_name, filter="1=1", limit=None, continuation_token=None):
+    """
+    Get the row count of each compound key, resuming after the key stored in the continuation token.
+
+    Uses WHERE compound_key > :last_key instead of OFFSET, so the {table_name}_compound_key_idx index
+    seeks directly to the next page and the cost per page stays flat across the whole table.
+
+    Returns:
+        tuple: (counts, continuation_token) where counts is a list of (count, compound_key) and
+        continuation_token is None when the end of the table has been reached
+    """
+    last_key = decode_continuation_token(table_name, filter, continuation_token)
+
+    conditions = f"({filter}) AND {NOT_NULL_KEY}"
+    parameters = []
+    if last_key is not None:
+        conditions += f" AND {DB_columns.COMPOUND_KEY.value} > ?"
+        parameters.append(last_key)
+
+    count_query = f"""
+        SELECT COUNT(*), {DB_columns.COMPOUND_KEY.value}
+        FROM {table_name}
+        WHERE {conditions}
+        GROUP BY {DB_columns.COMPOUND_KEY.value}
+        ORDER BY {DB_columns.COMPOUND_KEY.value}
+    """
+    if limit is not None:
+        count_query += " LIMIT ?"
+        parameters.append(limit)
+
+    counts = cursor.execute(count_query, parameters).fetchall()
+
+    if limit is None or len(counts) < limit:
+        return counts, None
+    return counts, encode_continuation_token(table_name, filter, counts[-1][1])
+
+def get_data_by_compound_key_range(cursor, table_name, first_key, last_key, filter, data_features=DEFAULT_DATA_FEATURES):
+    """
+    Get the rows of the compound keys in the range (first_key, last_key], ordered by compound key.
+    A first_key of None starts from the beginning of the table.
+    """
+    conditions = f"({filter}) AND {DB_columns.COMPOUND_KEY.value} <= ?"
+    parameters = [last_key]
+    if first_key is not None:
+        conditions += f" AND {DB_columns.COMPOUND_KEY.value} > ?"
+        parameters.append(first_key)
+
+    query = f"""
+        SELECT {','.join(data_features)}
+        FROM {table_name}
+        WHERE {conditions}
+        ORDER BY {DB_columns.COMPOUND_KEY.value}
+    """
+    return cursor.execute(query, parameters).fetchall()
+
+def fetch_data_batches_after(cursor, table_name, filter, limit, continuation_token=None, data_features=DEFAULT_DATA_FEATURES):
+    """
+    Keyset-paginated version of fetch_data_batches.
+
+    Pass None as the continuation token to start from the first key, and the returned token to fetch the next batch.
+
+    Returns:
+        tuple: (data, continuation_token) where data holds the rows of each key and
+        continuation_token is None when there are no more keys
+    """
+    first_key = decode_continuation_token(table_name, filter, continuation_token)
+    counts, next_continuation_token = get_counts_after(
+        cursor, table_name, filter, limit, continuation_token)
+
+    data = np.empty(len(counts), dtype=object)
+    if len(counts) == 0:
+        return data, None
+
+    all_rows = get_data_by_compound_key_range(
+        cursor, table_name, first_key, counts[-1][1], filter, data_features)
+
+    row_offset = 0
+    for i, (count, _) in enumerate(counts):
+        data[i] = all_rows[row_offset:row_offset + count]
+        row_offset += count
+
+    print(f"Fetched {len(data)} keys after key: {first_key}, limit: {limit}")
+    return data, next_continuation_token
+
 def fetch_data_batches(cursor, table_name, filter, offset, limit, data_features=DEFAULT_DATA_FEATURES):
-    counts = get_counts(cursor, table_name, filter, limit=offset+limit, offset=0)
-    
-    offsets = []
-    cumulative_sum = 0
-    for count in counts:
-        offsets.append(cumulative_sum)
-        cumulative_sum += count[0]
-    
+    counts, keys = get_count_arrays(cursor, table_name, filter, limit=offset+limit, offset=0)
+
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    cumulative_sum = int(offsets[-1])
+    offsets = offsets[:-1]
+
     rows_per_key = defaultdict(list)
-    total_row_offset = offsets[min(offset, len(offsets)-1)]
+    total_row_offset = int(offsets[min(offset, len(offsets)-1)]) if len(offsets) > 0 else 0
     total_row_limit = cumulative_sum - total_row_offset
     all_rows = get_data_by_compound_key(cursor, table_name, total_row_offset, total_row_limit, filter, data_features)
-    
+
     for i in range(len(counts))[offset:offset+limit]:
-        result_offset = offsets[i] - total_row_offset
-        result_count = counts[i][0]
+        result_offset = int(offsets[i]) - total_row_offset
+        result_count = int(counts[i])
         key_slice = all_rows[result_offset:result_offset + result_count]
         if len(key_slice) > 0:
-            rows_per_key[counts[i][1]].extend(key_slice)
+            rows_per_key[keys[i]].extend(key_slice)
 
     print(f"Fetched {len(rows_per_key.keys())} keys for offset: {offset}, limit: {limit}")    
-    return np.array(list(rows_per_key.values()), dtype=object)
+    return np.array(list(rows_per_key.values()), dtype=object)
\ No newline at end of file
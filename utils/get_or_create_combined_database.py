@@ -1,12 +1,224 @@
 import os
 import sqlite3
+import datetime
+import pathlib
 
 from constants import DB_columns
+from utils.get_data import clear_cache
+from utils.sqlite_pragmas import BULK_LOAD_PRAGMAS, apply_pragmas, restore_pragmas
 
+COMBINED_DATABASE_NAME = "combined2.db"
 
-def get_or_create_combined_database(database_folder):
+# Table in the combined database recording which source files have been merged
+MANIFEST_TABLE = "combined_manifest"
+
+# SQLite allows 10 attached databases by default
+ATTACH_BATCH_SIZE = 8
+
+COMBINED_COLUMNS = [DB_columns.NAME.value, DB_columns.POS_X.value, DB_columns.POS_Z.value,
+                    DB_columns.TIME.value, DB_columns.HP.value, DB_columns.TEAM.value, DB_columns.GAME_ID.value]
+
+
+def create_manifest_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            first_rowid INTEGER,
+            last_rowid INTEGER,
+            row_count INTEGER,
+            merge_date TEXT
+        )
+    """)
+
+
+def get_read_only_uri(database_file):
+    return pathlib.Path(database_file).absolute().as_uri() + "?mode=ro"
+
+
+def get_source_file_info(database_file):
+    stat = os.stat(database_file)
+    return stat.st_size, stat.st_mtime
+
+
+def get_cleaned_table_names(cursor):
+    """
+    Names of the cleaned tables of the combined database, the tables with a game_id and a compound key column.
+    """
+    table_names = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+    cleaned_table_names = []
+    for table_name in table_names:
+        columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({table_name})").fetchall()]
+        if DB_columns.GAME_ID.value in columns and DB_columns.COMPOUND_KEY.value in columns:
+            cleaned_table_names.append(table_name)
+    return cleaned_table_names
+
+
+def backfill_manifest(cursor, database_folder, source_files):
+    """
+    Record the source files of a combined database created before the manifest existed.
+    A file counts as merged when all of its games are already in the combined database.
+    The rowid ranges of backfilled files are unknown and left NULL.
+    """
+    print(f"Backfilling {MANIFEST_TABLE} of an existing combined database")
+    combined_game_ids = {row[0] for row in cursor.execute(f"SELECT DISTINCT {DB_columns.GAME_ID.value} FROM champs")}
+
+    merge_date = datetime.datetime.now().isoformat()
+    manifest_rows = []
+    for source_file in source_files:
+        source_uri = get_read_only_uri(os.path.join(database_folder, source_file))
+        cursor.execute("ATTACH DATABASE ? AS source", (source_uri,))
+        try:
+            game_ids = {row[0] for row in cursor.execute(f"SELECT DISTINCT {DB_columns.GAME_ID.value} FROM source.champs")}
+        except sqlite3.OperationalError as e:
+            print(f"Skipping {source_file}: {e}")
+            game_ids = set()
+        cursor.execute("DETACH DATABASE source")
+
+        if game_ids and game_ids <= combined_game_ids:
+            size, mtime = get_source_file_info(os.path.join(database_folder, source_file))
+            manifest_rows.append((source_file, size, mtime, merge_date))
+
+    # Databases can only be detached outside of a transaction, so the manifest is written once all files are checked
+    cursor.execute("BEGIN")
+    cursor.executemany(f"INSERT OR REPLACE INTO {MANIFEST_TABLE} (path, size, mtime, merge_date) VALUES (?, ?, ?, ?)", manifest_rows)
+    cursor.execute("COMMIT")
+    print(f"Backfilled {len(manifest_rows)} of {len(source_files)} files into {MANIFEST_TABLE}")
+
+
+def merge_source_files(cursor, database_folder, source_files):
+    """
+    Append the champs tables of the source files to the combined database, attaching them in batches.
+    Every batch is inserted in one transaction together with its manifest entries.
+
+    Returns:
+        int: The amount of inserted rows
+    """
+    merge_date = datetime.datetime.now().isoformat()
+    inserted_rows = 0
+    for batch_start in range(0, len(source_files), ATTACH_BATCH_SIZE):
+        batch = source_files[batch_start:batch_start + ATTACH_BATCH_SIZE]
+        for i, source_file in enumerate(batch):
+            source_uri = get_read_only_uri(os.path.join(database_folder, source_file))
+            cursor.execute(f"ATTACH DATABASE ? AS source_{i}", (source_uri,))
+
+        cursor.execute("BEGIN")
+        try:
+            for i, source_file in enumerate(batch):
+                if not cursor.execute(f"SELECT name FROM source_{i}.sqlite_master WHERE type='table' AND name='champs'").fetchone():
+                    print(f"Skipping {source_file}: no champs table")
+                    continue
+
+                # The rows of one INSERT get consecutive rowids after the current maximum
+                first_rowid = cursor.execute("SELECT IFNULL(MAX(rowid), 0) + 1 FROM main.champs").fetchone()[0]
+                cursor.execute(f"INSERT INTO main.champs ({','.join(COMBINED_COLUMNS)}) SELECT {','.join(COMBINED_COLUMNS)} FROM source_{i}.champs")
+                row_count = cursor.rowcount
+                inserted_rows += row_count
+
+                size, mtime = get_source_file_info(os.path.join(database_folder, source_file))
+                cursor.execute(f"""
+                    INSERT OR REPLACE INTO {MANIFEST_TABLE} (path, size, mtime, first_rowid, last_rowid, row_count, merge_date)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (source_file, size, mtime, first_rowid, first_rowid + row_count - 1, row_count, merge_date))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            # Databases can only be detached outside of a transaction
+            for i in range(len(batch)):
+                cursor.execute(f"DETACH DATABASE source_{i}")
+
+        print(f"Merged {min(batch_start + ATTACH_BATCH_SIZE, len(source_files))}/{len(source_files)} files")
+    return inserted_rows
+
+
+def update_combined_database(combined_db, database_folder, source_files):
+    """
+    Append the source files that are not yet in the manifest of the combined database.
+    Files whose size or modification time changed since they were merged have their old rows replaced. Their
+    games are also deleted from the cleaned tables, so incremental cleaning adds them again from the new rows.
+
+    Returns:
+        int: The amount of inserted rows
+    """
+    # Opened as a URI, so the source files can be attached read-only
+    conn = sqlite3.connect(pathlib.Path(combined_db).absolute().as_uri(), uri=True, isolation_level=None)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS champs (name TEXT, pos_x REAL, pos_z REAL, time REAL, hp REAL, team INTEGER, game_id INTEGER)")
+    manifest_exists = cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (MANIFEST_TABLE,)).fetchone()
+    create_manifest_table(cursor)
+
+    # Combined databases created before the manifest already contain data
+    if not manifest_exists and cursor.execute("SELECT EXISTS (SELECT 1 FROM champs)").fetchone()[0]:
+        backfill_manifest(cursor, database_folder, source_files)
+
+    manifest = {row[0]: row[1:] for row in cursor.execute(
+        f"SELECT path, size, mtime, first_rowid, last_rowid FROM {MANIFEST_TABLE}")}
+
+    new_files = []
+    changed_files = []
+    for source_file in source_files:
+        if source_file not in manifest:
+            new_files.append(source_file)
+        elif tuple(manifest[source_file][:2]) != get_source_file_info(os.path.join(database_folder, source_file)):
+            changed_files.append(source_file)
+
+    # Remove the previously merged rows of changed files, and their games from the cleaned tables, so they can be merged again
+    replaced_files = []
+    cleaned_table_names = get_cleaned_table_names(cursor) if changed_files else []
+    for source_file in changed_files:
+        _, _, first_rowid, last_rowid = manifest[source_file]
+        if first_rowid is None:
+            print(f"{source_file} changed after it was merged, but its rows are unknown. Not merging it again, "
+                  f"rebuild the combined database to include its changes")
+            continue
+        cursor.execute("BEGIN")
+        game_ids = cursor.execute(f"SELECT DISTINCT {DB_columns.GAME_ID.value} FROM champs WHERE rowid BETWEEN ? AND ?",
+                                  (first_rowid, last_rowid)).fetchall()
+        for table_name in cleaned_table_names:
+            cursor.executemany(f"DELETE FROM {table_name} WHERE {DB_columns.GAME_ID.value} = ?", game_ids)
+        cursor.execute("DELETE FROM champs WHERE rowid BETWEEN ? AND ?", (first_rowid, last_rowid))
+        cursor.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE path = ?", (source_file,))
+        cursor.execute("COMMIT")
+        replaced_files.append(source_file)
+
+    # The cached counts of the cleaned tables can include the deleted games
+    if replaced_files:
+        for table_name in cleaned_table_names:
+            clear_cache(cursor, table_name)
+
+    files_to_merge = new_files + replaced_files
+    inserted_rows = 0
+    if files_to_merge:
+        print(f"Merging {len(new_files)} new and {len(replaced_files)} changed files into {combined_db}")
+        previous_pragmas = apply_pragmas(cursor, BULK_LOAD_PRAGMAS)
+        try:
+            inserted_rows = merge_source_files(cursor, database_folder, files_to_merge)
+        finally:
+            restore_pragmas(cursor, previous_pragmas)
+        print(f"Inserted {inserted_rows} rows. Use incremental cleaning to add them to the cleaned tables")
+    else:
+        print(f"Combined database {combined_db} is up to date")
+
+    conn.close()
+    return inserted_rows
+
+
+def get_or_create_combined_database(database_folder, update=True):
     """
     Get the path to a combined SQLite database file containing all the data from the individual database files in the folder specified by the DATABASE_FOLDER environment variable.
+
+    The combined database keeps a manifest of the merged files, so files added to the folder later are appended
+    to the existing combined database instead of being ignored.
+
+    Args:
+        database_folder (str): The folder containing the database files
+        update (bool): Merge new and changed files into an existing combined database, otherwise it is used as-is
     """
     if not database_folder:
         raise ValueError(
@@ -14,45 +226,29 @@ def get_or_create_combined_database(database_folder):
 
     # Find all SQLite databases in the folder
     database_files = []
-    for file in os.listdir(database_folder):
+    for file in sorted(os.listdir(database_folder)):
         if file.endswith(".db"):
-            print(file)
-            database_files.append(os.path.join(database_folder, file))
+            database_files.append(file)
 
     if len(database_files) == 0:
         raise ValueError(
             "No SQLite database files found in the folder specified by DATABASE_FOLDER")
 
-    if len(database_files) > 1:
+    if len(database_files) == 1:
+        return os.path.join(database_folder, database_files[0])
+
+    print(
+        f"Found {len(database_files)} database files in the folder specified by DATABASE_FOLDER")
+    combined_db = os.path.join(database_folder, COMBINED_DATABASE_NAME)
+    if COMBINED_DATABASE_NAME in database_files:
+        print(f"Found combined database {combined_db}")
+        if not update:
+            return combined_db
+    else:
         print(
-            f"Found {len(database_files)} database files in the folder specified by DATABASE_FOLDER")
-        # See if a database with the name "combined" exists
-        combined_db = os.path.join(database_folder, "combined2.db")
-        if combined_db in database_files:
-            print(f"Found combined database {combined_db}")
-            database_files = [combined_db]
-        else:
-            print(
-                f"Combined database {combined_db} not found. Creating a new combined database")
-            # If there are multiple databases, create a combined database
-            conn = sqlite3.connect(combined_db)
-            cursor = conn.cursor()
-            # Create the table in the database
-            # Column names are the same as the keys in the game_dict
-            columns = [DB_columns.NAME.value, DB_columns.POS_X.value, DB_columns.POS_Z.value,
-                       DB_columns.TIME.value, DB_columns.HP.value, DB_columns.TEAM.value, DB_columns.GAME_ID.value]
-            # column_names = [f"{column}" for column in columns]
-            cursor.execute(
-                "CREATE TABLE champs (name TEXT, pos_x REAL, pos_z REAL, time REAL, hp REAL, team INTEGER, game_id INTEGER)")
-
-            for database_file in database_files:
-                cursor.execute(f"ATTACH DATABASE '{database_file}' AS db")
-                cursor.execute(
-                    f"INSERT INTO champs SELECT {','.join(columns)} FROM db.champs")
-                conn.commit()
-                cursor.execute("DETACH DATABASE db")
-            conn.close()
-
-            database_files = [combined_db]
-
-    return database_files[0]
+            f"Combined database {combined_db} not found. Creating a new combined database")
+
+    source_files = [file for file in database_files if file != COMBINED_DATABASE_NAME]
+    update_combined_database(combined_db, database_folder, source_files)
+
+    return combined_db
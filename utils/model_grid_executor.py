@@ -0,0 +1,176 @@
+import os
+import gc
+import sys
+import pickle
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+# State of each worker process, set by _initialize_worker
+_worker_context = None
+_worker_attachments = {}
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into shared memory blocks, so worker processes can read them without pickling.
+
+    Args:
+        arrays (dict): Name to np.ndarray
+
+    Returns:
+        tuple: (shared_memories, descriptors) where descriptors maps every name to (block name, shape, dtype)
+            and is sent to the workers instead of the arrays
+    """
+    shared_memories = []
+    descriptors = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        # Shared memory blocks can not be empty
+        shared_memory_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory_block.buf)[...] = array
+        shared_memories.append(shared_memory_block)
+        descriptors[name] = (shared_memory_block.name, array.shape, array.dtype.str)
+    return shared_memories, descriptors
+
+
+def release_shared_arrays(shared_memories):
+    for shared_memory_block in shared_memories:
+        shared_memory_block.close()
+        shared_memory_block.unlink()
+
+
+def _close_worker_attachments(keep_names):
+    gc.collect()
+    for block_name in list(_worker_attachments):
+        if block_name in keep_names:
+            continue
+        try:
+            _worker_attachments.pop(block_name).close()
+        except BufferError:
+            # Arrays of the block are still referenced, it is unmapped once they are collected
+            pass
+
+
+def _attach_arrays(descriptors):
+    # Blocks stay attached while a batch is processed, and are closed when the next batch arrives
+    block_names = {block_name for block_name, _, _ in descriptors.values()}
+    if not block_names.issubset(_worker_attachments):
+        _close_worker_attachments(block_names)
+
+    arrays = {}
+    for name, (block_name, shape, dtype) in descriptors.items():
+        if block_name not in _worker_attachments:
+            _worker_attachments[block_name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_worker_attachments[block_name].buf)
+    return arrays
+
+
+def _initialize_worker(context, torch_threads):
+    global _worker_context
+    _worker_context = context
+    # Cap the intra-op threads of torch in every worker, so the workers do not oversubscribe the cores.
+    # The OpenMP and BLAS threads of other libraries read their environment variables before the worker gets here
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+
+
+def _run_task(function, descriptors, task):
+    return function(_worker_context, _attach_arrays(descriptors), task)
+
+
+def get_default_start_method():
+    """
+    fork on Linux, where the context is inherited instead of pickled, and spawn elsewhere:
+    Windows can not fork, and forking is unsafe on macOS.
+    """
+    return "fork" if sys.platform.startswith("linux") else "spawn"
+
+
+class ModelGridExecutor:
+    """
+    Process pool that runs the cells of a model grid in parallel on arrays in shared memory.
+
+    With the fork start method (the default on Linux) the context, e.g. model getters defined in a notebook, is
+    inherited instead of pickled. With spawn (the default on Windows and macOS) or forkserver the context is pickled,
+    so its functions must be importable from a module. When the workers can not be started with the context, the
+    tasks are run one at a time in the calling process instead. The function run on the workers must be defined at
+    module level, as it is pickled by reference.
+
+    Forking a process that already runs OpenMP or torch threads can deadlock, e.g. in a Jupyter kernel that
+    trained a torch model before. Use forkserver or spawn with importable model getters there.
+
+    Args:
+        context: Object available to every task, e.g. the model getters
+        workers (int): Amount of worker processes, all cores by default
+        torch_threads (int): Intra-op threads of torch in every worker, the cores divided by the workers by default
+        start_method (str): fork, spawn or forkserver, see get_default_start_method by default
+    """
+
+    def __init__(self, context, workers=None, torch_threads=None, start_method=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.torch_threads = torch_threads or max((os.cpu_count() or 1) // self.workers, 1)
+        self.start_method = start_method or get_default_start_method()
+        self.context = context
+        self.executor = None
+        if self.start_method not in multiprocessing.get_all_start_methods():
+            print(f"Start method {self.start_method} is not available, running the tasks in this process")
+            return
+        # The workers inherit the resource tracker of the shared memory blocks when it runs before the fork
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_initialize_worker, initargs=(context, self.torch_threads))
+        try:
+            # Start all workers now, before any background threads (e.g. prefetching) are started
+            self.executor.submit(int).result()
+        except (pickle.PicklingError, AttributeError, TypeError, BrokenProcessPool) as e:
+            # The context could not be pickled, or not be unpickled by the workers (e.g. functions of a notebook)
+            print(f"Could not start {self.start_method} workers with the context ({type(e).__name__}: {e}), "
+                  f"running the tasks in this process")
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def run(self, function, arrays, tasks):
+        """
+        Run function(context, arrays, task) for every task on the workers.
+
+        Args:
+            function: Module level function
+            arrays (dict): Name to np.ndarray, shared with the workers for the duration of the call
+            tasks (list): Picklable arguments of the tasks
+
+        Yields:
+            The results of the tasks, in the order they are completed
+        """
+        if self.executor is None:
+            for task in tasks:
+                yield function(self.context, arrays, task)
+            return
+        shared_memories, descriptors = share_arrays(arrays)
+        futures = []
+        try:
+            futures = [self.executor.submit(_run_task, function, descriptors, task) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Tasks still running when a task failed must finish before their arrays are released
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            release_shared_arrays(shared_memories)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
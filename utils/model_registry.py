@@ -0,0 +1,284 @@
+import os
+import json
+import pickle
+import sqlite3
+import datetime
+from collections.abc import Mapping
+import numpy as np
+
+from utils.streaming_metrics import ErrorMetrics, StreamingMetrics
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+REGISTRY_DATABASE_NAME = "registry.db"
+REGISTRY_TABLE = "models"
+
+
+class LazyDict(Mapping):
+    """
+    Read-only dict whose values are loaded on first access and then kept.
+    Iterating over the keys does not load anything, unlike values() and items().
+    """
+
+    def __init__(self, keys, load):
+        self._keys = list(keys)
+        self._key_set = set(self._keys)
+        self._load = load
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        if key not in self._values:
+            self._values[key] = self._load(key)
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_loaded(self, key):
+        return key in self._values
+
+
+def is_torch_model(model):
+    return torch is not None and isinstance(model, torch.nn.Module)
+
+
+def get_model_parameters(model):
+    # Hyperparameters of a TrajectoryPredictor, or the parameters of an sklearn model
+    if hasattr(model, "get_params"):
+        return model.get_params()
+    parameters = {name: getattr(model, name) for name in ["epochs", "batch_size", "learning_rate", "dropout_rate"]
+                  if hasattr(model, name)}
+    return parameters or None
+
+
+class ModelRegistry:
+    """
+    Registry of the trained (H, T, model_name) models of a folder.
+
+    The metadata and errors of every model are indexed in one SQLite table, so listing the models and comparing
+    their errors does not open any artifacts. Torch models are saved as state_dicts and rebuilt with their model
+    getter, other models (e.g. linear regressions) are pickled. The per-sequence test errors are saved as .npy files.
+    Models are only loaded when accessed.
+
+    Args:
+        folder (str): Folder of the index and the artifacts
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.database_file = os.path.join(folder, REGISTRY_DATABASE_NAME)
+        os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.database_file)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {REGISTRY_TABLE} (
+                H INTEGER,
+                T INTEGER,
+                model_name TEXT,
+                model_class TEXT,
+                artifact_file TEXT,
+                artifact_format TEXT,
+                features TEXT,
+                input_shape TEXT,
+                parameters TEXT,
+                training_error TEXT,
+                validation_error TEXT,
+                test_error_file TEXT,
+                test_error_mean REAL,
+                training_size INTEGER,
+                training_date TEXT,
+                test_metrics TEXT,
+                PRIMARY KEY (H, T, model_name)
+            )
+        """)
+        # Registries created before the test metrics were added
+        columns = [column[1] for column in cursor.execute(f"PRAGMA table_info({REGISTRY_TABLE})").fetchall()]
+        if "test_metrics" not in columns:
+            cursor.execute(f"ALTER TABLE {REGISTRY_TABLE} ADD COLUMN test_metrics TEXT")
+        conn.commit()
+        conn.close()
+
+    def _query(self, query, parameters=()):
+        conn = sqlite3.connect(self.database_file)
+        rows = conn.execute(query, parameters).fetchall()
+        conn.close()
+        return rows
+
+    def save_model(self, H, T, model_name, model, features, input_shape, training_error=None, validation_error=None, test_error=None, training_size=None, test_metrics=None):
+        """
+        Save a model, its metadata and its errors, replacing an earlier model of the same (H, T, model_name).
+
+        Args:
+            training_error (list): Training errors of the model, e.g. one per batch from compare_models
+            validation_error (list): Validation errors of the model
+            test_error (np.ndarray): Per-sequence test errors, saved as a binary array
+            test_metrics (ErrorMetrics): Streaming summary of the test errors, stored in the index instead of
+                the per-sequence errors
+        """
+        file_stem = f"{H}_{T}_{model_name}"
+        if is_torch_model(model):
+            artifact_file, artifact_format = f"{file_stem}.state_dict.pt", "state_dict"
+            torch.save(model.state_dict(), os.path.join(self.folder, artifact_file))
+        else:
+            artifact_file, artifact_format = f"{file_stem}.pkl", "pickle"
+            with open(os.path.join(self.folder, artifact_file), "wb") as f:
+                pickle.dump(model, f)
+
+        test_error_file, test_error_mean = None, None
+        if test_error is not None:
+            test_error = np.asarray(test_error, dtype=np.float32)
+            test_error_file = f"{file_stem}.test_error.npy"
+            np.save(os.path.join(self.folder, test_error_file), test_error)
+            test_error_mean = float(np.mean(test_error)) if len(test_error) > 0 else None
+        if test_metrics is not None and test_metrics.count > 0:
+            test_error_mean = test_metrics.mean_l2
+
+        row = (H, T, model_name, type(model).__name__, artifact_file, artifact_format, json.dumps(features),
+               json.dumps(list(input_shape)), json.dumps(get_model_parameters(model), default=str),
+               json.dumps([float(error) for error in (training_error if training_error is not None else [])]),
+               json.dumps([float(error) for error in (validation_error if validation_error is not None else [])]),
+               test_error_file, test_error_mean, training_size, datetime.datetime.now().isoformat(),
+               json.dumps(test_metrics.to_dict()) if test_metrics is not None else None)
+
+        conn = sqlite3.connect(self.database_file)
+        conn.execute(f"INSERT OR REPLACE INTO {REGISTRY_TABLE} VALUES ({', '.join(['?'] * len(row))})", row)
+        conn.commit()
+        conn.close()
+
+    def get_keys(self):
+        """
+        The (H, T, model_name) of every model, in the order they were saved.
+        """
+        return [(H, T, model_name) for H, T, model_name in self._query(
+            f"SELECT H, T, model_name FROM {REGISTRY_TABLE} ORDER BY rowid")]
+
+    def get_metadata(self, key):
+        rows = self._query(f"SELECT * FROM {REGISTRY_TABLE} WHERE H = ? AND T = ? AND model_name = ?", key)
+        if len(rows) == 0:
+            raise KeyError(key)
+        columns = [column[1] for column in self._query(f"PRAGMA table_info({REGISTRY_TABLE})")]
+        metadata = dict(zip(columns, rows[0]))
+        for column in ["features", "input_shape", "parameters", "training_error", "validation_error", "test_metrics"]:
+            metadata[column] = json.loads(metadata[column]) if metadata[column] is not None else None
+        return metadata
+
+    def load_model(self, key, model_getters, device="cpu"):
+        """
+        Load a model. Torch models are created with their model getter and get the saved state_dict.
+        """
+        H, T, model_name = key
+        metadata = self.get_metadata(key)
+        artifact_file = os.path.join(self.folder, metadata["artifact_file"])
+        if metadata["artifact_format"] == "pickle":
+            with open(artifact_file, "rb") as f:
+                return pickle.load(f)
+
+        model = model_getters[model_name](H, T)[0]
+        model.load_state_dict(torch.load(artifact_file, map_location=torch.device(device)))
+        model.device = device
+        return model.to(device)
+
+    def load_test_error(self, key):
+        test_error_file = self._query(
+            f"SELECT test_error_file FROM {REGISTRY_TABLE} WHERE H = ? AND T = ? AND model_name = ?", key)[0][0]
+        if test_error_file is None:
+            return None
+        return np.load(os.path.join(self.folder, test_error_file), mmap_mode="r")
+
+    def get_models(self, model_getters, device="cpu", keys=None):
+        """
+        All models (or the given keys) as a dict that loads every model on first access.
+        """
+        return LazyDict(keys if keys is not None else self.get_keys(),
+                        lambda key: self.load_model(key, model_getters, device))
+
+    def get_errors(self):
+        """
+        The training and validation errors of every model, read from the index only.
+
+        Returns:
+            tuple: (training_errors, validation_errors) in the format of compare_models
+        """
+        training_errors = {}
+        validation_errors = {}
+        for H, T, model_name, training_error, validation_error in self._query(
+                f"SELECT H, T, model_name, training_error, validation_error FROM {REGISTRY_TABLE} ORDER BY rowid"):
+            training_errors[(H, T, model_name)] = json.loads(training_error)
+            validation_errors[(H, T, model_name)] = json.loads(validation_error)
+        return training_errors, validation_errors
+
+    def get_test_error_means(self):
+        return {(H, T, model_name): test_error_mean for H, T, model_name, test_error_mean in self._query(
+            f"SELECT H, T, model_name, test_error_mean FROM {REGISTRY_TABLE} WHERE test_error_mean IS NOT NULL ORDER BY rowid")}
+
+    def get_test_metrics(self):
+        """
+        The streaming test error metrics of every model that has test errors. Models saved with per-sequence
+        test errors only get metrics computed from those errors, without a mean squared error.
+
+        Returns:
+            StreamingMetrics: Metrics per (H, T, model_name)
+        """
+        test_metrics = StreamingMetrics()
+        for H, T, model_name, metrics, test_error_file in self._query(
+                f"SELECT H, T, model_name, test_metrics, test_error_file FROM {REGISTRY_TABLE} ORDER BY rowid"):
+            if metrics is not None:
+                test_metrics.metrics[(H, T, model_name)] = ErrorMetrics.from_dict(json.loads(metrics))
+            elif test_error_file is not None:
+                test_metrics.update_distances((H, T, model_name), self.load_test_error((H, T, model_name)))
+        return test_metrics
+
+
+def get_legacy_model_names(legacy_folder):
+    """
+    The names of the models saved by earlier versions of train_model.ipynb in a folder, see import_legacy_models.
+    """
+    if not os.path.isdir(legacy_folder):
+        return []
+    file_names = set(os.listdir(legacy_folder))
+    return [file_name[:-len(".json")] for file_name in sorted(file_names)
+            if file_name.endswith(".json") and not file_name.startswith("registry") and file_name[:-len(".json")] + ".pt" in file_names]
+
+
+def open_model_registry(folder):
+    """
+    Open the registry of a folder. The models saved by earlier versions of train_model.ipynb in a folder without
+    any registered models are imported first, so the models of an old folder are still found.
+    """
+    registry = ModelRegistry(folder)
+    if len(registry.get_keys()) == 0:
+        legacy_model_names = get_legacy_model_names(folder)
+        if legacy_model_names:
+            print(f"Importing {len(legacy_model_names)} models saved without a registry in {folder}")
+            import_legacy_models(registry, folder)
+    return registry
+
+
+def import_legacy_models(registry, legacy_folder, training_size=None):
+    """
+    Import the models saved by earlier versions of train_model.ipynb, as a whole torch.save(model) .pt file
+    with a .json file of training information per model.
+    """
+    for file_name in sorted(os.listdir(legacy_folder)):
+        if not file_name.endswith(".json") or file_name.startswith("registry"):
+            continue
+        with open(os.path.join(legacy_folder, file_name), "r") as f:
+            training_info = json.load(f)
+        model_file = os.path.join(legacy_folder, file_name[:-len(".json")] + ".pt")
+        if not os.path.exists(model_file):
+            print(f"No model file for {file_name}, skipping")
+            continue
+        model = torch.load(model_file, map_location=torch.device("cpu"), weights_only=False)
+        registry.save_model(
+            training_info["H"], training_info["T"], training_info["model_type"], model, training_info["features"],
+            training_info["input_shape"], training_info.get("training_error"), training_info.get("validation_error"),
+            training_info.get("test_error"), training_info.get("training_size", training_size))
+        print(f"Imported {file_name[:-len('.json')]}")
@@ -0,0 +1,86 @@
+import queue
+import threading
+
+# Marks the end of the source iterable in the queue
+_END = object()
+
+
+class PrefetchIterator:
+    """
+    Iterate over an iterable while a background thread reads ahead into a bounded queue.
+
+    The source is consumed on the background thread, so I/O (e.g. SQLite queries, which release the GIL)
+    overlaps with the work done on the items. At most queue_size items are read ahead.
+    Exceptions raised by the source are raised again from the iteration.
+    """
+
+    def __init__(self, iterable, queue_size=2):
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._read, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Wait for space in the queue, giving up when the iterator is closed
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((None, e))
+            return
+        finally:
+            # Generators are closed on this thread, so their cleanup (e.g. closing connections) runs where they ran
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        self._put((_END, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop_event.is_set():
+            raise StopIteration
+        item, exception = self.queue.get()
+        if exception is not None:
+            self.close()
+            raise exception
+        if item is _END:
+            self.close()
+            raise StopIteration
+        return item
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        """
+        Stop reading ahead, drop the items read ahead and wait for the background thread to finish its current item
+        and close the source.
+        """
+        self.stop_event.set()
+        self._drain()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        # An item may have been put while the queue was drained
+        self._drain()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
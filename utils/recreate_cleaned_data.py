@@ -2,22 +2,13 @@ import sqlite3
 import json
 
 from constants import DB_columns
+from utils.clean_and_normalize_table import get_lookup_expression, rebuild_cleaned_table
 from utils.create_compound_key_and_index import create_compound_key_and_index
 from utils.get_data import clear_cache
 
 from constants import GAME_AREA_WIDTH, MAX_TIME, MAX_HP
 
-def recreate_cleaned_data(database_file, table_name):
-    conn = sqlite3.connect(database_file)
-    cursor = conn.cursor()
-
-    # Check if cache exists in db, clear if it does
-    cache_exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='count_cache'").fetchone()
-    if cache_exists:
-        clear_cache(cursor)
-
-    tlol_db_table_name = "champs"
-
+def load_champions_dict():
     # Read champions info from JSON
     champions_dict = {}
     with open("denormalization_data.json", "r") as f:
@@ -27,13 +18,10 @@ def recreate_cleaned_data(database_file, table_name):
             for champion_name, champion_id in champions_mapping.items():
                 champion = [champ for champ in normalized_champions if champ["Champion"] == champion_id][0]
                 champions_dict[champion_name] = champion
+    return champions_dict
 
-    print(champions_dict)
-
-    # Drop previous tables if they exist
-    cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+def create_champion_lookup(cursor, champions_dict):
     cursor.execute(f"DROP TABLE IF EXISTS champion_lookup")
-    conn.commit()
 
     # Create a lookup table for champions
     cursor.execute("""
@@ -48,6 +36,57 @@ def recreate_cleaned_data(database_file, table_name):
         idx = champion_dict["Champion"]
         cursor.execute("INSERT INTO champion_lookup (champion_id, champion_name) VALUES (?, ?)", (idx, champion_name))
 
+def get_recreate_normalization_config():
+    """
+    The normalizations of recreate_cleaned_data, in the format of normalization_config.json.
+    Champion names are looked up from the champion_lookup table created by create_champion_lookup.
+    """
+    def divide_by(column_enum, max_value):
+        return {
+            "column_enum": column_enum.value,
+            "normalization_type": "expression",
+            "normalization_expression": "({column_name} / {max_value})",
+            "parameters": {"max_value": max_value}
+        }
+
+    return [
+        divide_by(DB_columns.POS_X, GAME_AREA_WIDTH),
+        divide_by(DB_columns.POS_Z, GAME_AREA_WIDTH),
+        divide_by(DB_columns.TIME, MAX_TIME),
+        divide_by(DB_columns.HP, MAX_HP),
+        {
+            "column_enum": DB_columns.NAME.value,
+            "normalization_type": "lookup",
+            "lookup_table": "champion_lookup",
+            "key_column": "champion_name",
+            "value_column": "champion_id"
+        }
+    ]
+
+def recreate_cleaned_data(database_file, table_name, bulk=False):
+    tlol_db_table_name = "champs"
+
+    champions_dict = load_champions_dict()
+    print(champions_dict)
+
+    if bulk:
+        # Rebuild in a single transaction, creating the champion lookup table in the same transaction
+        rebuild_cleaned_table(database_file, table_name, tlol_db_table_name, get_recreate_normalization_config(),
+                              before_load=lambda cursor: create_champion_lookup(cursor, champions_dict))
+        return
+
+    conn = sqlite3.connect(database_file)
+    cursor = conn.cursor()
+
+    # Clear cached counts of the table being rebuilt
+    clear_cache(cursor, table_name)
+
+    # Drop previous tables if they exist
+    cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    conn.commit()
+
+    create_champion_lookup(cursor, champions_dict)
+
     conn.commit()
 
     # Create the main table
@@ -66,17 +105,9 @@ def recreate_cleaned_data(database_file, table_name):
     cursor.execute(
         f"ALTER TABLE {table_name} ADD COLUMN {DB_columns.NORMALIZED_HP.value} FLOAT GENERATED ALWAYS AS ({DB_columns.HP.value} / {MAX_HP}) STORED")
 
-    # Generate the CASE statement for the champion_id column
-    case_statement = "CASE "
-    for champion_name, champion_dict in champions_dict.items():
-        idx = champion_dict["Champion"]
-        escaped_champion_name = champion_name.replace("'", "''")
-        case_statement += f"WHEN {DB_columns.NAME.value} = '{escaped_champion_name}' THEN {idx} "
-    case_statement += "ELSE NULL END"
-
-    # Add the generated column using the CASE statement
+    # Add the champion id column, looked up from champion_lookup when the data is inserted
     cursor.execute(
-        f"ALTER TABLE {table_name} ADD COLUMN {DB_columns.NORMALIZED_NAME.value} INTEGER GENERATED ALWAYS AS ({case_statement}) STORED"
+        f"ALTER TABLE {table_name} ADD COLUMN {DB_columns.NORMALIZED_NAME.value} INTEGER"
     )
 
     conn.commit()
@@ -95,7 +126,11 @@ def recreate_cleaned_data(database_file, table_name):
     conn = sqlite3.connect(database_file)
     cursor = conn.cursor()
 
-    cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {tlol_db_table_name} WHERE {filter_conditions}")
+    champion_id_expression = get_lookup_expression(DB_columns.NAME.value, "champion_lookup", "champion_name", "champion_id")
+    cursor.execute(f"""
+        INSERT INTO {table_name}
+        SELECT *, {champion_id_expression} FROM {tlol_db_table_name} WHERE {filter_conditions}
+    """)
 
     conn.commit()
     conn.close()
@@ -0,0 +1,165 @@
+import os
+import json
+import numpy as np
+
+from constants import DB_columns
+from utils.trajectory_store import METADATA_FILE_NAME, load_trajectory_store, save_trajectory_store
+from utils.windowed_sequence_dataset import get_valid_window_starts
+
+
+def get_time_grid(times, offsets, time_step):
+    """
+    Get the fixed time grid of every trajectory: the multiples of time_step between its first and last time.
+    Grids of trajectories of the same game line up, as all of them are on the multiples of time_step.
+
+    Returns:
+        tuple: (grid_times, grid_offsets) where the grid of trajectory i is grid_times[grid_offsets[i]:grid_offsets[i+1]]
+    """
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+
+    first_steps = np.zeros(len(lengths), dtype=np.int64)
+    last_steps = np.full(len(lengths), -1, dtype=np.int64)
+    first_steps[non_empty] = np.ceil(times[offsets[:-1][non_empty]] / time_step)
+    last_steps[non_empty] = np.floor(times[offsets[1:][non_empty] - 1] / time_step)
+
+    counts = np.maximum(last_steps - first_steps + 1, 0)
+    grid_offsets = np.concatenate(([0], np.cumsum(counts)))
+    steps = np.repeat(first_steps, counts) + np.arange(grid_offsets[-1]) - np.repeat(grid_offsets[:-1], counts)
+    return steps * time_step, grid_offsets
+
+
+def resample_trajectories(values, offsets, time_column_index, time_step, hold_column_indices=[]):
+    """
+    Resample all trajectories onto a fixed time grid in one vectorized pass.
+
+    Every trajectory is shifted by its own time offset, so the concatenated times of all trajectories are increasing
+    and one np.searchsorted finds the samples around every grid time. Columns are linearly interpolated between
+    the samples, except for the hold columns (e.g. names, teams and ids), which keep the value of the previous sample.
+
+    Args:
+        values (np.ndarray): The rows of all trajectories, stored contiguously and ordered by time within a trajectory
+        offsets (np.ndarray): Row offsets of the trajectories, trajectory i is rows offsets[i]:offsets[i+1]
+        time_column_index (int): Index of the time column
+        time_step (float): Time between the resampled rows, in the units of the time column
+        hold_column_indices (list): Columns that are not interpolated
+
+    Returns:
+        tuple: (resampled_values, resampled_offsets)
+    """
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    times = values[:, time_column_index].astype(np.float64)
+
+    grid_times, grid_offsets = get_time_grid(times, offsets, time_step)
+    if len(grid_times) == 0:
+        return np.empty((0, values.shape[1]), dtype=np.float32), grid_offsets
+
+    # Shift every trajectory past the end of the previous one
+    lengths = np.diff(offsets)
+    span = float(times.max() - times.min()) + 2 * time_step
+    time_offsets = np.arange(len(lengths)) * span
+    shifted_times = times + np.repeat(time_offsets, lengths)
+    if np.any(np.diff(shifted_times) < 0):
+        raise ValueError("Rows must be ordered by time within every trajectory")
+    grid_counts = np.diff(grid_offsets)
+    shifted_grid_times = grid_times + np.repeat(time_offsets, grid_counts)
+
+    # The previous and next sample of every grid time, both inside the same trajectory
+    trajectory_ends = np.repeat(offsets[1:], grid_counts)
+    # Rounding can put the first grid time a hair before the first sample of a trajectory
+    previous_rows = np.maximum(np.searchsorted(shifted_times, shifted_grid_times, side="right") - 1,
+                               np.repeat(offsets[:-1], grid_counts))
+    next_rows = np.minimum(previous_rows + 1, trajectory_ends - 1)
+
+    time_differences = shifted_times[next_rows] - shifted_times[previous_rows]
+    weights = np.divide(shifted_grid_times - shifted_times[previous_rows], time_differences,
+                        out=np.zeros_like(shifted_grid_times), where=time_differences > 0)
+
+    previous_values = values[previous_rows].astype(np.float32)
+    next_values = values[next_rows].astype(np.float32)
+    weights = weights.astype(np.float32)[:, None]
+    # Weights of 0 and 1 must not pull in NaNs from the other sample
+    resampled = np.where(weights == 0, previous_values, previous_values + weights * (next_values - previous_values))
+    resampled[:, hold_column_indices] = previous_values[:, hold_column_indices]
+    resampled[:, time_column_index] = grid_times
+    return resampled, grid_offsets
+
+
+def create_lag_tensor(values, offsets, lags, lag_stride=1, window_step=1):
+    """
+    Create the strided lag windows of all trajectories as a view of the rows, without copying them.
+
+    The window starting at row s holds the rows s, s + lag_stride, ..., s + (lags - 1) * lag_stride. The windows of
+    every row are a sliding_window_view of the values with a step slice over the lags, and the valid starts are the
+    rows whose window stays within one trajectory, every window_step rows from the start of the trajectory.
+    windows[starts] copies the valid windows into one (windows, lags, features) array, index with batches of the
+    starts to copy only a batch at a time.
+
+    Args:
+        values (np.ndarray): The rows of all trajectories, e.g. resampled by resample_trajectories
+        offsets (np.ndarray): Row offsets of the trajectories
+        lags (int): Amount of rows in a window
+        lag_stride (int): Rows between the lags of a window
+        window_step (int): Rows between the starts of consecutive windows
+
+    Returns:
+        tuple: (windows, starts) where windows is a read-only view of shape (rows, lags, features) indexed by
+        the start row, only the rows in starts start a window within one trajectory
+    """
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    window_length = (lags - 1) * lag_stride + 1
+    starts = get_valid_window_starts(offsets, window_length)
+    if window_step > 1:
+        trajectory_starts = offsets[np.searchsorted(offsets, starts, side="right") - 1]
+        starts = starts[(starts - trajectory_starts) % window_step == 0]
+
+    if len(values) < window_length:
+        return np.empty((0, lags, values.shape[1]), dtype=values.dtype), starts
+    # (rows - window_length + 1, features, window_length) view, the lags are every lag_stride-th row of the window
+    windows = np.lib.stride_tricks.sliding_window_view(values, window_length, axis=0)[:, :, ::lag_stride]
+    return windows.transpose(0, 2, 1), starts
+
+
+def get_or_create_resampled_store(store_folder, resampled_store_folder, time_step, time_feature=DB_columns.NORMALIZED_TIME.value, hold_features=[]):
+    """
+    Resample a trajectory store onto a fixed time grid and cache the result as another trajectory store.
+    The cached store is reused when it was resampled from the same store with the same parameters.
+
+    Args:
+        store_folder (str): The trajectory store to resample, see utils.trajectory_store
+        resampled_store_folder (str): The folder of the resampled store
+        time_step (float): Time between the resampled rows, in the units of time_feature
+        time_feature (str): The time column
+        hold_features (list): Features that are not interpolated, see resample_trajectories
+
+    Returns:
+        TrajectoryStore: The resampled store
+    """
+    store = load_trajectory_store(store_folder)
+    resample_parameters = {
+        "source_store": os.path.abspath(store_folder),
+        "source_export_date": store.metadata["export_date"],
+        "time_feature": time_feature,
+        "time_step": time_step,
+        "hold_features": list(hold_features),
+    }
+
+    metadata_file = os.path.join(resampled_store_folder, METADATA_FILE_NAME)
+    if os.path.exists(metadata_file):
+        with open(metadata_file, "r") as f:
+            if json.load(f).get("resample_parameters") == resample_parameters:
+                print(f"Using cached resampled store {resampled_store_folder}")
+                return load_trajectory_store(resampled_store_folder)
+
+    resampled_values, resampled_offsets = resample_trajectories(
+        store.values, store.offsets, store.feature_indices([time_feature])[0], time_step,
+        store.feature_indices(hold_features))
+
+    # Trajectories shorter than one time step have no rows left, but keep their key so indices stay aligned
+    metadata = {key: value for key, value in store.metadata.items() if key not in ["row_count", "key_count", "export_date"]}
+    metadata["resample_parameters"] = resample_parameters
+    save_trajectory_store(resampled_store_folder, resampled_values, resampled_offsets, store.keys, metadata)
+    print(f"Resampled {store.metadata['row_count']} rows to {len(resampled_values)} rows in {resampled_store_folder}")
+    return load_trajectory_store(resampled_store_folder)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import numpy as np
+
+from utils.get_data import fetch_data_batches, get_table_fingerprint
+from utils.create_sequences_in_batches import create_sequences_from_database_rows
+
+SEQUENCE_CACHE_FOLDER = "sequence_cache"
+SEQUENCE_CACHE_INDEX_NAME = "index.db"
+METADATA_FILE_NAME = "metadata.json"
+DEFAULT_SEQUENCE_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+
+
+def get_sequence_cache_key(cursor, table_name, **parameters):
+    """
+    Content address of a set of arrays generated from a table: the hash of the parameters they were generated with
+    and the fingerprint of the table, so entries are not reused after the table or its normalization changes.
+    """
+    content = {
+        "database_file": os.path.abspath(cursor.connection.execute("PRAGMA database_list").fetchone()[2]),
+        "table_name": table_name,
+        "fingerprint": get_table_fingerprint(cursor, table_name),
+        **parameters,
+    }
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class SequenceCache:
+    """
+    On-disk cache of generated arrays (e.g. (X, y) sequence sets), one folder of .npy files per key.
+
+    Arrays are loaded back memory-mapped, so a hit costs no data preparation and only the pages that are used are read.
+    The total size is capped at max_bytes by evicting the least recently used entries, tracked in a SQLite index.
+
+    Every put writes a new versioned folder, and the index points each key to its current folder, so files that are
+    still memory-mapped are never overwritten. Folders that can not be removed yet (memory-mapped files can not be
+    deleted on Windows) stay in the index as removed folders, count towards the size, and are removed later.
+
+    Args:
+        folder (str): Folder of the cache
+        max_bytes (int): Size cap of all entries
+    """
+
+    def __init__(self, folder=SEQUENCE_CACHE_FOLDER, max_bytes=DEFAULT_SEQUENCE_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        self.index_file = os.path.join(folder, SEQUENCE_CACHE_INDEX_NAME)
+        conn = sqlite3.connect(self.index_file)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                last_access REAL,
+                created REAL,
+                folder TEXT
+            )
+        """)
+        # Migrate indices created before the entries were versioned, their folders are named after their key
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)").fetchall()]
+        if "folder" not in columns:
+            conn.execute("ALTER TABLE entries ADD COLUMN folder TEXT")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS removed_folders (
+                folder TEXT PRIMARY KEY,
+                size INTEGER
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    def _execute(self, query, parameters=()):
+        conn = sqlite3.connect(self.index_file)
+        rows = conn.execute(query, parameters).fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def get_entry_folder(self, key):
+        """
+        The current folder of an entry, or None when it is not cached.
+        """
+        rows = self._execute("SELECT COALESCE(folder, key) FROM entries WHERE key = ?", (key,))
+        return os.path.join(self.folder, rows[0][0]) if rows else None
+
+    def _remove_folder(self, folder, size):
+        """
+        Remove the folder of an entry that is no longer in the index.
+        A folder that can not be removed yet is kept in removed_folders, and removed by a later call.
+
+        Returns:
+            bool: Whether the folder was removed
+        """
+        shutil.rmtree(os.path.join(self.folder, folder), ignore_errors=True)
+        if os.path.exists(os.path.join(self.folder, folder)):
+            self._execute("INSERT OR REPLACE INTO removed_folders VALUES (?, ?)", (folder, size))
+            return False
+        self._execute("DELETE FROM removed_folders WHERE folder = ?", (folder,))
+        return True
+
+    def _remove_pending_folders(self):
+        for folder, size in self._execute("SELECT folder, size FROM removed_folders"):
+            self._remove_folder(folder, size)
+
+    def get(self, key):
+        """
+        Load an entry, or None when it is not cached.
+
+        Returns:
+            tuple: (arrays, metadata) where arrays maps every name to a read-only memory-mapped np.ndarray
+        """
+        entry_folder = self.get_entry_folder(key)
+        if entry_folder is None:
+            return None
+        if not os.path.isdir(entry_folder):
+            self._execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+
+        arrays = {file_name[:-len(".npy")]: np.load(os.path.join(entry_folder, file_name), mmap_mode="r")
+                  for file_name in os.listdir(entry_folder) if file_name.endswith(".npy")}
+        with open(os.path.join(entry_folder, METADATA_FILE_NAME), "r") as f:
+            metadata = json.load(f)
+        self._execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return arrays, metadata
+
+    def put(self, key, arrays, metadata=None):
+        """
+        Store arrays under a key, then evict the least recently used entries over the size cap.
+        Entries larger than the cap are not stored.
+        """
+        size = sum(np.asarray(array).nbytes for array in arrays.values())
+        if size > self.max_bytes:
+            print(f"Not caching {key}, {size} bytes is over the cache size cap of {self.max_bytes} bytes")
+            return
+
+        # Written to a new folder, which readers only see once the index points to it
+        folder = f"{key}-{time.time_ns()}-{os.getpid()}"
+        os.makedirs(os.path.join(self.folder, folder))
+        for name, array in arrays.items():
+            np.save(os.path.join(self.folder, folder, f"{name}.npy"), np.asarray(array), allow_pickle=False)
+        with open(os.path.join(self.folder, folder, METADATA_FILE_NAME), "w") as f:
+            json.dump(metadata or {}, f)
+
+        previous_entry = self._execute("SELECT COALESCE(folder, key), size FROM entries WHERE key = ?", (key,))
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (key, size, now, now, folder))
+        if previous_entry:
+            self._remove_folder(*previous_entry[0])
+        self.evict(keep_key=key)
+
+    def evict(self, keep_key=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        self._remove_pending_folders()
+        entries = self._execute("SELECT key, COALESCE(folder, key), size FROM entries ORDER BY last_access")
+        total_size = self.get_size()
+        for key, folder, size in entries:
+            if total_size <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            # Arrays that are still memory-mapped stay readable after their files are removed (or, on Windows, their
+            # files stay until they are unmapped and are counted in the size until then)
+            self._execute("DELETE FROM entries WHERE key = ?", (key,))
+            if self._remove_folder(folder, size):
+                total_size -= size
+
+    def get_or_create(self, key, create):
+        """
+        Load an entry, or create it with create() -> (arrays, metadata) and store it.
+
+        Returns:
+            tuple: (arrays, metadata)
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        arrays, metadata = create()
+        self.put(key, arrays, metadata)
+        return arrays, metadata
+
+    def get_size(self):
+        """
+        Size of the entries and of the removed folders that are still on disk.
+        """
+        return (self._execute("SELECT COALESCE(SUM(size), 0) FROM entries")[0][0] +
+                self._execute("SELECT COALESCE(SUM(size), 0) FROM removed_folders")[0][0])
+
+    def clear(self):
+        for key, folder, size in self._execute("SELECT key, COALESCE(folder, key), size FROM entries"):
+            self._execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._remove_folder(folder, size)
+        self._remove_pending_folders()
+
+
+def get_cached_sequences(cursor, table_name, filter, offset, limit, data_features, H, T, max_H=None, max_T=None, label_indices=[0, 1], ragged=False, cache=None):
+    """
+    Cached version of fetch_data_batches followed by create_sequences_from_database_rows.
+
+    Returns:
+        tuple: (X, y) as read-only memory-mapped arrays when they come from the cache
+    """
+    cache = cache or SequenceCache()
+    key = get_sequence_cache_key(
+        cursor, table_name, kind="sequences", filter=filter, offset=offset, limit=limit, data_features=list(data_features),
+        H=H, T=T, max_H=max_H, max_T=max_T, label_indices=list(label_indices), ragged=ragged)
+
+    def create():
+        data = fetch_data_batches(cursor, table_name, filter, offset, limit, data_features)
+        X, y = create_sequences_from_database_rows(data, H, T, max_H, max_T, label_indices=label_indices, ragged=ragged)
+        return {"X": X, "y": y}, {}
+
+    arrays, _ = cache.get_or_create(key, create)
+    return arrays["X"], arrays["y"]
@@ -0,0 +1,27 @@
+# Pragmas for loading large amounts of data in one go.
+# The journal is kept in memory so a failed load can still be rolled back, but a crash mid-load is not survivable.
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -1024 * 1024,  # Negative values are in KiB, i.e. 1 GiB
+    "temp_store": "MEMORY",
+}
+
+
+def apply_pragmas(cursor, pragmas):
+    """
+    Set the given pragmas on the connection of the cursor.
+
+    Returns:
+        dict: The previous values of the pragmas, to be passed to restore_pragmas
+    """
+    previous_values = {}
+    for pragma, value in pragmas.items():
+        previous_values[pragma] = cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    return previous_values
+
+
+def restore_pragmas(cursor, previous_values):
+    for pragma, value in previous_values.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
@@ -0,0 +1,231 @@
+from collections import defaultdict
+import numpy as np
+from tqdm.auto import tqdm
+
+from constants import DEFAULT_DATA_FEATURES
+from utils.compare_models import iter_sequence_batches
+from utils.prefetch_iterator import PrefetchIterator
+
+
+def solve_normal_equations(gram, xty):
+    """
+    Solve gram @ weights = xty for the least squares weights. Singular systems get the minimum norm solution,
+    like sklearn's LinearRegression.
+    """
+    return np.linalg.lstsq(gram, xty, rcond=None)[0]
+
+
+def get_squared_error_sum(weights, gram, xty, yty):
+    """
+    Sum of the squared errors of the weights on the samples summarized by gram = X^T X, xty = X^T y and
+    yty = sum of y^2 per target, without the samples themselves.
+    """
+    return float(np.einsum("it,ij,jt->", weights, gram, weights) - 2 * np.sum(weights * xty) + np.sum(yty))
+
+
+class StreamingLinearRegression:
+    """
+    Least squares linear regression fitted from the accumulated X^T X and X^T y of any amount of batches.
+
+    partial_fit adds a batch to the sums, so a model can be fitted on more data than fits in memory at once.
+    fit, predict, coef_ and intercept_ follow sklearn's LinearRegression.
+    """
+
+    # compare_models keeps the model across batches and updates it with partial_fit, see is_streaming_model
+    streaming = True
+
+    def __init__(self, fit_intercept=True):
+        self.fit_intercept = fit_intercept
+        self.gram_ = None
+        self.xty_ = None
+        self.yty_ = None
+        self.n_samples_ = 0
+        self._weights = None
+        self._single_target = False
+
+    def _augment(self, X):
+        X = np.asarray(X, dtype=np.float64).reshape(len(X), -1)
+        if self.fit_intercept:
+            X = np.hstack((np.ones((len(X), 1)), X))
+        return X
+
+    def partial_fit(self, X, y):
+        """
+        Add the samples of a batch to the accumulated sums.
+        """
+        X = self._augment(X)
+        y = np.asarray(y, dtype=np.float64)
+        self._single_target = y.ndim == 1
+        y = y.reshape(len(y), -1)
+
+        if self.gram_ is None:
+            self.gram_ = np.zeros((X.shape[1], X.shape[1]))
+            self.xty_ = np.zeros((X.shape[1], y.shape[1]))
+            self.yty_ = np.zeros(y.shape[1])
+        self.gram_ += X.T @ X
+        self.xty_ += X.T @ y
+        self.yty_ += np.einsum("ij,ij->j", y, y)
+        self.n_samples_ += len(X)
+        self._weights = None
+        return self
+
+    def fit(self, X, y):
+        """
+        Fit on the given samples only, discarding the previously accumulated sums.
+        """
+        self.gram_ = None
+        self.n_samples_ = 0
+        return self.partial_fit(X, y)
+
+    @property
+    def weights(self):
+        # Solved lazily, so partial_fit stays cheap
+        if self._weights is None:
+            if self.gram_ is None:
+                raise ValueError("The model has not been fitted")
+            self._weights = solve_normal_equations(self.gram_, self.xty_)
+        return self._weights
+
+    @property
+    def coef_(self):
+        coef = self.weights[1:].T if self.fit_intercept else self.weights.T
+        return coef[0] if self._single_target else coef
+
+    @property
+    def intercept_(self):
+        intercept = self.weights[0] if self.fit_intercept else np.zeros(self.weights.shape[1])
+        return intercept[0] if self._single_target else intercept
+
+    def predict(self, X):
+        prediction = self._augment(X) @ self.weights
+        return prediction[:, 0] if self._single_target else prediction
+
+    def mean_squared_error(self, gram=None, xty=None, yty=None, n_samples=None):
+        """
+        Mean squared error over all targets on the samples summarized by the given sums,
+        by default on the accumulated training samples.
+        """
+        if gram is None:
+            gram, xty, yty, n_samples = self.gram_, self.xty_, self.yty_, self.n_samples_
+        return get_squared_error_sum(self.weights, gram, xty, yty) / (n_samples * xty.shape[1])
+
+
+class StreamingLinearRegressionGrid:
+    """
+    Streaming linear regressions for every (H, T) of a grid, accumulated in one pass over the windows.
+
+    Only the sums of the windows of the longest history max_H are accumulated. The flattened input of a history H
+    is the last H rows of a max_H window, so the X^T X of every H is a nested sub-block of the one max_H Gram matrix.
+    The labels of every T are the columns of one multi-target X^T Y, so all T are solved from the same sums.
+
+    Args:
+        H_values (list): History lengths
+        T_values (list): Prediction offsets
+        fit_intercept (bool): Fit an intercept, see StreamingLinearRegression
+    """
+
+    def __init__(self, H_values, T_values, fit_intercept=True):
+        self.H_values = list(H_values)
+        self.T_values = list(T_values)
+        self.max_H = max(H_values)
+        self.fit_intercept = fit_intercept
+        self.gram_ = None
+        self.xty_ = None
+        self.yty_ = None
+        self.n_samples_ = 0
+        self.feature_count = None
+        self.label_count = None
+
+    def partial_fit(self, dataset, feature_indices=None, batch_size=10000):
+        """
+        Add the windows of a dataset to the accumulated sums.
+
+        Args:
+            dataset (WindowedSequenceDataset): Windows with a history of at least max(H_values) rows and
+                labels at least max(T_values) rows ahead, e.g. the base dataset of compare_models with lazy
+            feature_indices (list): Features of the inputs, all features by default
+            batch_size (int): Windows read at a time
+        """
+        history_dataset = dataset.with_horizon(self.max_H, 1)
+        label_datasets = [dataset.with_horizon(self.max_H, T) for T in self.T_values]
+        model = StreamingLinearRegression(self.fit_intercept)
+        model.gram_, model.xty_, model.yty_ = self.gram_, self.xty_, self.yty_
+
+        for batch_start in range(0, len(dataset), batch_size):
+            indices = slice(batch_start, batch_start + batch_size)
+            X = history_dataset.get_batch(indices, feature_indices)[0]
+            y = np.hstack([label_dataset.get_labels(indices) for label_dataset in label_datasets])
+            model.partial_fit(X, y)
+            self.feature_count = X.shape[2]
+            self.label_count = y.shape[1] // len(self.T_values)
+
+        self.gram_, self.xty_, self.yty_ = model.gram_, model.xty_, model.yty_
+        self.n_samples_ += model.n_samples_
+        return self
+
+    def get_columns(self, H):
+        # Input columns of history H: the last H rows of the flattened max_H window, after the intercept column
+        first_column = int(self.fit_intercept)
+        columns = np.arange(first_column + (self.max_H - H) * self.feature_count, first_column + self.max_H * self.feature_count)
+        return np.concatenate(([0], columns)) if self.fit_intercept else columns
+
+    def get_statistics(self, H, T):
+        """
+        The accumulated sums of (H, T).
+
+        Returns:
+            tuple: (gram, xty, yty, n_samples)
+        """
+        columns = self.get_columns(H)
+        targets = slice(self.T_values.index(T) * self.label_count, (self.T_values.index(T) + 1) * self.label_count)
+        return self.gram_[np.ix_(columns, columns)], self.xty_[columns, targets], self.yty_[targets], self.n_samples_
+
+    def get_model(self, H, T):
+        """
+        The StreamingLinearRegression of (H, T), taking inputs of shape (-1, H * features).
+        """
+        model = StreamingLinearRegression(self.fit_intercept)
+        gram, xty, yty, model.n_samples_ = self.get_statistics(H, T)
+        model.gram_, model.xty_, model.yty_ = gram.copy(), xty.copy(), yty.copy()
+        return model
+
+    def get_models(self):
+        return {(H, T): self.get_model(H, T) for H in self.H_values for T in self.T_values}
+
+
+def fit_linear_regression_grid(database_file, table_name, H_values, T_values, features=DEFAULT_DATA_FEATURES, data_features=DEFAULT_DATA_FEATURES, labels=DEFAULT_DATA_FEATURES, filter="1=1", total_keys_to_fetch=100, batch_size=20, trajectory_store=None, ragged=False, prefetch_batches=0, model_name="linear_regression"):
+    """
+    Linear regression baseline of compare_models for the whole (H, T) grid in one pass over the data.
+
+    The batches and train/test splits are read like compare_models with lazy. Every model is fitted on the
+    training windows of all batches, and the errors are computed from the accumulated sums of the training
+    and test windows, so no second pass is needed.
+
+    Returns:
+        tuple: (trained_models, training_errors, validation_errors) in the format of compare_models
+    """
+    feature_indices = [data_features.index(feature) for feature in features]
+    train_grid = StreamingLinearRegressionGrid(H_values, T_values)
+    test_grid = StreamingLinearRegressionGrid(H_values, T_values)
+
+    batches = iter_sequence_batches(
+        database_file, table_name, H_values, T_values, data_features, labels, filter, total_keys_to_fetch,
+        batch_size, trajectory_store, lazy=True, ragged=ragged)
+    if prefetch_batches > 0:
+        batches = PrefetchIterator(batches, prefetch_batches)
+    try:
+        for _, (base_train_dataset, base_test_dataset), _ in tqdm(batches, desc='Accumulating batches'):
+            train_grid.partial_fit(base_train_dataset, feature_indices)
+            test_grid.partial_fit(base_test_dataset, feature_indices)
+    finally:
+        # Stop the prefetching thread and the connection of the batches, also on errors
+        batches.close()
+
+    trained_models = {}
+    training_errors = defaultdict(list)
+    validation_errors = defaultdict(list)
+    for (H, T), model in train_grid.get_models().items():
+        trained_models[(H, T, model_name)] = model
+        training_errors[(H, T, model_name)] += [model.mean_squared_error()]
+        validation_errors[(H, T, model_name)] += [model.mean_squared_error(*test_grid.get_statistics(H, T))]
+    return trained_models, training_errors, validation_errors
@@ -0,0 +1,247 @@
+import json
+import math
+from collections.abc import Mapping
+import numpy as np
+
+# Errors are distances between normalized positions, so they are mostly below one
+DEFAULT_HISTOGRAM_RANGE = (0.0, 1.5)
+DEFAULT_HISTOGRAM_BINS = 150
+DEFAULT_COMPRESSION = 200
+
+
+class TDigest:
+    """
+    Mergeable sketch of a distribution for approximate quantiles, in the style of a merging t-digest.
+
+    The values are summarized by at most about compression / 2 weighted centroids. The centroids are small near
+    the tails and large near the median, so the extreme quantiles stay accurate. Values are added a batch at a
+    time, and two digests are merged by merging their centroids.
+
+    Args:
+        compression (int): Accuracy of the sketch, the amount of centroids grows linearly with it
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        cumulative_weights = np.cumsum(weights)
+        total_weight = cumulative_weights[-1]
+        # Group the centroids by the unit intervals of the k1 scale function k(q) = compression / (2 pi) * asin(2q - 1)
+        q = (cumulative_weights - weights / 2) / total_weight
+        k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1))
+        groups = np.floor(k - k[0]).astype(np.int64)
+        group_starts = np.flatnonzero(np.diff(groups, prepend=-1))
+        self.weights = np.add.reduceat(weights, group_starts)
+        self.means = np.add.reduceat(means * weights, group_starts) / self.weights
+
+    def update(self, values):
+        """
+        Add a batch of values.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate((self.means, values)), np.concatenate((self.weights, np.ones(len(values)))))
+        return self
+
+    def merge(self, other):
+        """
+        Add the values summarized by another digest.
+        """
+        if len(other.weights) == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.concatenate((self.means, other.means)), np.concatenate((self.weights, other.weights)))
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate q quantile(s) of the values, interpolated between the centroids and the exact minimum and maximum.
+        """
+        if len(self.weights) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else math.nan
+        cumulative_weights = np.cumsum(self.weights)
+        centers = cumulative_weights - self.weights / 2
+        positions = np.concatenate(([0.0], centers, [cumulative_weights[-1]]))
+        values = np.concatenate(([self.min], self.means, [self.max]))
+        quantiles = np.interp(np.asarray(q) * cumulative_weights[-1], positions, values)
+        return float(quantiles) if np.ndim(quantiles) == 0 else quantiles
+
+    def to_dict(self):
+        return {"compression": self.compression, "means": self.means.tolist(), "weights": self.weights.tolist(),
+                "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, summary):
+        digest = cls(summary["compression"])
+        digest.means = np.asarray(summary["means"], dtype=np.float64)
+        digest.weights = np.asarray(summary["weights"], dtype=np.float64)
+        digest.min, digest.max = summary["min"], summary["max"]
+        return digest
+
+
+class ErrorMetrics:
+    """
+    Streaming summary of the prediction errors of one model, updated a batch of predictions at a time.
+
+    Keeps the mean squared error (over all label values, like sklearn's mean_squared_error), the mean L2 distance
+    per sequence, a histogram of the L2 distances over fixed bins and a TDigest of them for quantiles. Memory does
+    not grow with the amount of sequences, and the metrics of several batches or workers can be merged.
+
+    Args:
+        histogram_range (tuple): (min, max) of the histogram bins, distances outside it are counted in the edge bins
+        histogram_bins (int): Amount of histogram bins
+        compression (int): Compression of the TDigest
+    """
+
+    def __init__(self, histogram_range=DEFAULT_HISTOGRAM_RANGE, histogram_bins=DEFAULT_HISTOGRAM_BINS, compression=DEFAULT_COMPRESSION):
+        self.histogram_edges = np.linspace(*histogram_range, histogram_bins + 1)
+        self.histogram = np.zeros(histogram_bins, dtype=np.int64)
+        self.digest = TDigest(compression)
+        self.count = 0
+        self.value_count = 0
+        self.squared_error_sum = 0.0
+        self.l2_sum = 0.0
+
+    def update(self, y_true, y_pred):
+        """
+        Add a batch of predictions, with one row of label values per sequence.
+        """
+        y_true = np.asarray(y_true, dtype=np.float64)
+        if len(y_true) == 0:
+            return self
+        difference = y_true.reshape(len(y_true), -1) - np.asarray(y_pred, dtype=np.float64).reshape(len(y_true), -1)
+        squared_errors = difference ** 2
+        self.squared_error_sum += float(squared_errors.sum())
+        self.value_count += squared_errors.size
+        return self.update_distances(np.sqrt(squared_errors.sum(axis=1)))
+
+    def update_distances(self, distances):
+        """
+        Add a batch of per-sequence L2 distances only, e.g. test errors computed elsewhere.
+        """
+        distances = np.asarray(distances, dtype=np.float64).ravel()
+        self.count += len(distances)
+        self.l2_sum += float(distances.sum())
+        bins = np.searchsorted(self.histogram_edges, distances, side="right") - 1
+        self.histogram += np.bincount(np.clip(bins, 0, len(self.histogram) - 1), minlength=len(self.histogram))
+        self.digest.update(distances)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.histogram_edges, other.histogram_edges):
+            raise ValueError("Cannot merge metrics with different histogram bins")
+        self.histogram += other.histogram
+        self.digest.merge(other.digest)
+        self.count += other.count
+        self.value_count += other.value_count
+        self.squared_error_sum += other.squared_error_sum
+        self.l2_sum += other.l2_sum
+        return self
+
+    @property
+    def mse(self):
+        return self.squared_error_sum / self.value_count if self.value_count > 0 else math.nan
+
+    @property
+    def mean_l2(self):
+        return self.l2_sum / self.count if self.count > 0 else math.nan
+
+    def quantile(self, q):
+        return self.digest.quantile(q)
+
+    def to_dict(self):
+        return {"histogram_edges": self.histogram_edges.tolist(), "histogram": self.histogram.tolist(),
+                "digest": self.digest.to_dict(), "count": self.count, "value_count": self.value_count,
+                "squared_error_sum": self.squared_error_sum, "l2_sum": self.l2_sum}
+
+    @classmethod
+    def from_dict(cls, summary):
+        metrics = cls()
+        metrics.histogram_edges = np.asarray(summary["histogram_edges"], dtype=np.float64)
+        metrics.histogram = np.asarray(summary["histogram"], dtype=np.int64)
+        metrics.digest = TDigest.from_dict(summary["digest"])
+        for name in ["count", "value_count", "squared_error_sum", "l2_sum"]:
+            setattr(metrics, name, summary[name])
+        return metrics
+
+
+class StreamingMetrics(Mapping):
+    """
+    ErrorMetrics per key, e.g. per (H, T, model_name), created on first update.
+
+    Args:
+        **metrics_parameters: Parameters of every ErrorMetrics, see ErrorMetrics
+    """
+
+    def __init__(self, **metrics_parameters):
+        self.metrics_parameters = metrics_parameters
+        self.metrics = {}
+
+    def __getitem__(self, key):
+        return self.metrics[key]
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def get_or_create(self, key):
+        if key not in self.metrics:
+            self.metrics[key] = ErrorMetrics(**self.metrics_parameters)
+        return self.metrics[key]
+
+    def update(self, key, y_true, y_pred):
+        return self.get_or_create(key).update(y_true, y_pred)
+
+    def update_distances(self, key, distances):
+        return self.get_or_create(key).update_distances(distances)
+
+    def merge(self, other):
+        """
+        Merge the metrics of another StreamingMetrics (or a dict of ErrorMetrics), e.g. from another worker.
+        """
+        for key, metrics in other.items():
+            self.get_or_create(key).merge(metrics)
+        return self
+
+    def get_summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        The scalar metrics of every key.
+
+        Returns:
+            dict: Key to a dict of count, mse, mean_l2 and the L2 quantiles
+        """
+        return {key: {"count": metrics.count, "mse": metrics.mse, "mean_l2": metrics.mean_l2,
+                      **{f"p{round(q * 100)}": metrics.quantile(q) for q in quantiles}}
+                for key, metrics in self.metrics.items()}
+
+    def save(self, file):
+        with open(file, "w") as f:
+            json.dump([{"key": list(key) if isinstance(key, tuple) else key, "metrics": metrics.to_dict()}
+                       for key, metrics in self.metrics.items()], f)
+
+    @classmethod
+    def load(cls, file):
+        streaming_metrics = cls()
+        with open(file, "r") as f:
+            for entry in json.load(f):
+                key = tuple(entry["key"]) if isinstance(entry["key"], list) else entry["key"]
+                streaming_metrics.metrics[key] = ErrorMetrics.from_dict(entry["metrics"])
+        return streaming_metrics
@@ -0,0 +1,186 @@
+import sqlite3
+import numpy as np
+import torch
+
+from constants import DEFAULT_DATA_FEATURES
+from utils.get_data import fetch_data_batches_after, get_counts_after
+from utils.prefetch_iterator import PrefetchIterator
+from utils.trajectory_store import load_trajectory_store
+from utils.windowed_sequence_dataset import create_ragged_windowed_dataset, create_windowed_dataset_from_database_rows
+
+
+class StreamingSequenceDataset(torch.utils.data.IterableDataset):
+    """
+    Stream (X, y) training batches from a cleaned table or a trajectory store in constant memory.
+
+    Keys are read in chunks of keys_per_chunk on a background thread, so reading overlaps with training.
+    The windows of each chunk go through a bounded shuffle buffer of shuffle_buffer_size windows and come out
+    as batches of batch_size windows. With a DataLoader of several workers, or with shard_count, every worker
+    or shard reads its own chunks of keys, so use the DataLoader with batch_size=None.
+
+    The shuffling of every epoch is seeded with the epoch. DataLoader workers that are not persistent get a new
+    copy of the dataset every epoch, so the training loop has to call set_epoch before every epoch.
+
+    Args:
+        H (int): History length of the windows
+        T (int): Prediction offset of the windows
+        database_file (str): Database to read from, when no trajectory store is given
+        table_name (str): The cleaned table to read from
+        trajectory_store_folder (str): Trajectory store to read from instead of the database
+        data_features (list): Columns read from the database. Trajectory stores use their exported features
+        features (list): Features of X, all data features by default
+        labels (list): Features of y
+        filter (str): SQL condition selecting the rows, for the database
+        keys_per_chunk (int): Keys read at a time
+        batch_size (int): Windows per batch
+        shuffle_buffer_size (int): Windows kept for shuffling, 0 to keep the order of the keys
+        prefetch_chunks (int): Chunks read ahead by the background thread
+        ragged (bool): Use every window of every key instead of cutting the keys of a chunk to the shortest key.
+            Trajectory stores are always read ragged
+        max_keys (int): Stop after this many keys, all keys by default
+        shard_index (int): Index of this shard when the keys are split between processes
+        shard_count (int): Amount of shards
+        seed (int): Seed of the shuffling, a new seed is drawn every epoch when None
+    """
+
+    def __init__(self, H, T, database_file=None, table_name=None, trajectory_store_folder=None,
+                 data_features=DEFAULT_DATA_FEATURES, features=None, labels=DEFAULT_DATA_FEATURES, filter="1=1",
+                 keys_per_chunk=20, batch_size=640, shuffle_buffer_size=100000, prefetch_chunks=2, ragged=True,
+                 max_keys=None, shard_index=0, shard_count=1, seed=None):
+        super().__init__()
+        if trajectory_store_folder is None and (database_file is None or table_name is None):
+            raise ValueError("Give either a trajectory store folder or a database file and a table name")
+        self.H = H
+        self.T = T
+        self.database_file = database_file
+        self.table_name = table_name
+        self.trajectory_store_folder = trajectory_store_folder
+        self.data_features = list(data_features)
+        self.features = list(features) if features is not None else None
+        self.labels = list(labels)
+        self.filter = filter
+        self.keys_per_chunk = keys_per_chunk
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.prefetch_chunks = prefetch_chunks
+        self.ragged = ragged
+        self.max_keys = max_keys
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch of the next iteration, which seeds its shuffling. Call before every epoch, like
+        DistributedSampler.set_epoch, as the epoch of the copies in the DataLoader workers is not kept.
+        """
+        self.epoch = epoch
+
+    def _get_worker_shard(self):
+        # Shards of the DataLoader workers within the shard of this process
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, worker_count = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return self.shard_index * worker_count + worker_id, self.shard_count * worker_count
+
+    def _iter_store_chunks(self, shard_index, shard_count):
+        store = load_trajectory_store(self.trajectory_store_folder)
+        feature_indices = store.feature_indices(self.features or store.data_features)
+        label_indices = store.feature_indices(self.labels)
+        key_count = len(store) if self.max_keys is None else min(len(store), self.max_keys)
+
+        # The chunks of this shard
+        for offset in range(shard_index * self.keys_per_chunk, key_count, shard_count * self.keys_per_chunk):
+            values, offsets = store.get_rows(offset, min(self.keys_per_chunk, key_count - offset))
+            dataset = create_ragged_windowed_dataset(values, offsets, self.H, self.T, label_indices=label_indices)
+            if len(dataset) > 0:
+                yield dataset.to_arrays(feature_indices)
+
+    def _iter_database_chunks(self, shard_index, shard_count):
+        feature_indices = [self.data_features.index(feature) for feature in (self.features or self.data_features)]
+        label_indices = [self.data_features.index(label) for label in self.labels]
+
+        # Keys of the chunks of the other shards before the first chunk of this shard
+        skip_keys = shard_index * self.keys_per_chunk
+        if self.max_keys is not None and skip_keys >= self.max_keys:
+            return  # This shard has no chunks
+
+        # Every thread needs its own connection
+        conn = sqlite3.connect(self.database_file)
+        cursor = conn.cursor()
+        try:
+            continuation_token = None
+            remaining_keys = self.max_keys
+            while remaining_keys is None or remaining_keys > 0:
+                if skip_keys > 0:
+                    # Skip the chunks of the other shards by only reading their key counts, in one query
+                    limit = skip_keys if remaining_keys is None else min(skip_keys, remaining_keys)
+                    counts, continuation_token = get_counts_after(
+                        cursor, self.table_name, self.filter, limit, continuation_token)
+                    if remaining_keys is not None:
+                        remaining_keys -= limit
+                    if continuation_token is None or (remaining_keys is not None and remaining_keys <= 0):
+                        break
+
+                limit = self.keys_per_chunk if remaining_keys is None else min(self.keys_per_chunk, remaining_keys)
+                data, continuation_token = fetch_data_batches_after(
+                    cursor, self.table_name, self.filter, limit, continuation_token, self.data_features)
+                if len(data) > 0:
+                    dataset = create_windowed_dataset_from_database_rows(
+                        data, self.H, self.T, label_indices=label_indices, ragged=self.ragged)
+                    if len(dataset) > 0:
+                        yield dataset.to_arrays(feature_indices)
+
+                if remaining_keys is not None:
+                    remaining_keys -= limit
+                if len(data) == 0 or continuation_token is None:
+                    break
+                skip_keys = (shard_count - 1) * self.keys_per_chunk
+        finally:
+            conn.close()
+
+    def _iter_batches(self, chunks, rng):
+        # The chunks are concatenated once per flush of the buffer, not once per chunk
+        X_chunks, y_chunks = [], []
+        buffered_count = 0
+        for X, y in chunks:
+            X_chunks.append(X)
+            y_chunks.append(y)
+            buffered_count += len(X)
+            if buffered_count < max(self.shuffle_buffer_size, self.batch_size):
+                continue
+
+            # Emit full batches of shuffled windows, keeping half of the buffer to mix with the next chunks
+            X_buffer, y_buffer = np.concatenate(X_chunks), np.concatenate(y_chunks)
+            if self.shuffle_buffer_size > 0:
+                permutation = rng.permutation(len(X_buffer))
+                X_buffer, y_buffer = X_buffer[permutation], y_buffer[permutation]
+            emit_count = (len(X_buffer) - self.shuffle_buffer_size // 2) // self.batch_size * self.batch_size
+            for batch_start in range(0, emit_count, self.batch_size):
+                yield X_buffer[batch_start:batch_start + self.batch_size], y_buffer[batch_start:batch_start + self.batch_size]
+            X_chunks, y_chunks = [X_buffer[emit_count:]], [y_buffer[emit_count:]]
+            buffered_count = len(X_buffer) - emit_count
+
+        if buffered_count > 0:
+            X_buffer, y_buffer = np.concatenate(X_chunks), np.concatenate(y_chunks)
+            if self.shuffle_buffer_size > 0:
+                permutation = rng.permutation(len(X_buffer))
+                X_buffer, y_buffer = X_buffer[permutation], y_buffer[permutation]
+            for batch_start in range(0, len(X_buffer), self.batch_size):
+                yield X_buffer[batch_start:batch_start + self.batch_size], y_buffer[batch_start:batch_start + self.batch_size]
+
+    def __iter__(self):
+        shard_index, shard_count = self._get_worker_shard()
+        seed = None if self.seed is None else (self.seed, self.epoch, shard_index)
+        # Counts the epochs of a dataset that is iterated in this process, or in a persistent worker
+        self.epoch += 1
+        rng = np.random.default_rng(seed)
+
+        if self.trajectory_store_folder is not None:
+            chunks = self._iter_store_chunks(shard_index, shard_count)
+        else:
+            chunks = self._iter_database_chunks(shard_index, shard_count)
+
+        with PrefetchIterator(chunks, self.prefetch_chunks) as prefetched_chunks:
+            for X, y in self._iter_batches(prefetched_chunks, rng):
+                yield torch.from_numpy(np.ascontiguousarray(X)), torch.from_numpy(np.ascontiguousarray(y))
@@ -0,0 +1,208 @@
+import os
+import copy
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from constants import DEFAULT_DATA_FEATURES
+from utils.batched_inference import predict_in_batches
+from utils.compare_models import shape_input_for_model
+from utils.trajectory_predictor import train_epoch
+
+SWEEP_STATE_FILE_NAME = "sweep_state.json"
+
+
+def get_rung_epochs(min_epochs, max_epochs, reduction_factor):
+    """
+    Epoch budgets of the rungs: min_epochs, multiplied by reduction_factor every rung, up to max_epochs.
+    """
+    rung_epochs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rung_epochs.append(epochs)
+        epochs *= reduction_factor
+    return rung_epochs + [max_epochs]
+
+
+class SweepTrial:
+    """
+    One configuration of a sweep: a model with its own optimizer, trained a few epochs at a time.
+
+    The validation loss is computed after every epoch, and the weights of the best epoch are kept. Training stops
+    early once the validation loss has not improved for patience epochs.
+
+    The training data can be given as float32 tensors on the device of the model, which are used without a copy,
+    so trials with the same features share them.
+    """
+
+    def __init__(self, name, model, X_train, y_train, X_validation, y_validation):
+        self.name = name
+        self.model = model
+        self.model.to(model.device)
+        self.optimizer = optim.Adam(model.parameters(), lr=model.learning_rate)
+        self.X_train = torch.as_tensor(X_train, dtype=torch.float32, device=model.device)
+        self.y_train = torch.as_tensor(y_train, dtype=torch.float32, device=model.device)
+        self.X_validation = X_validation
+        self.y_validation = y_validation
+        self.epochs = 0
+        self.validation_losses = []
+        self.best_state = None
+        self.stopped = False
+
+    @property
+    def best_validation_loss(self):
+        return min(self.validation_losses, default=math.inf)
+
+    def get_validation_loss(self):
+        # One thread per trial, the trials already run concurrently
+        y_pred = predict_in_batches(self.model, self.X_validation, workers=1)
+        # Only use the first two feature dimensions, like the training loss
+        return float(np.mean((y_pred[:, :2] - self.y_validation[:, :2]) ** 2))
+
+    def train_to(self, epochs, patience=None):
+        """
+        Train until the trial has been trained for the given amount of epochs, or stops early.
+        """
+        train_loader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(self.X_train, self.y_train), batch_size=self.model.batch_size, shuffle=True)
+        criterion = nn.MSELoss()
+        while self.epochs < epochs and not self.stopped:
+            train_epoch(self.model, train_loader, self.optimizer, criterion, f'{self.name} epoch {self.epochs + 1}/{epochs}')
+            self.epochs += 1
+            validation_loss = self.get_validation_loss()
+            if validation_loss < self.best_validation_loss:
+                self.best_state = copy.deepcopy(self.model.state_dict())
+            self.validation_losses.append(validation_loss)
+
+            epochs_since_best = len(self.validation_losses) - 1 - int(np.argmin(self.validation_losses))
+            if patience is not None and epochs_since_best >= patience:
+                print(f'{self.name}: validation loss has not improved for {patience} epochs. Stopping early.')
+                self.stopped = True
+        return self
+
+    def get_best_model(self):
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+        return self.model
+
+    def get_checkpoint_file(self, checkpoint_folder):
+        return os.path.join(checkpoint_folder, f"{self.name}.pt")
+
+    def save(self, checkpoint_folder):
+        torch.save({
+            "model": self.model.state_dict(),
+            "best_model": self.best_state,
+            "optimizer": self.optimizer.state_dict(),
+            "epochs": self.epochs,
+            "validation_losses": self.validation_losses,
+            "stopped": self.stopped,
+        }, self.get_checkpoint_file(checkpoint_folder))
+
+    def load(self, checkpoint_folder):
+        """
+        Continue from the checkpoint of the trial, if there is one.
+        """
+        checkpoint_file = self.get_checkpoint_file(checkpoint_folder)
+        if not os.path.exists(checkpoint_file):
+            return False
+        checkpoint = torch.load(checkpoint_file, map_location=torch.device(self.model.device))
+        self.model.load_state_dict(checkpoint["model"])
+        self.best_state = checkpoint["best_model"]
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.epochs = checkpoint["epochs"]
+        self.validation_losses = checkpoint["validation_losses"]
+        self.stopped = checkpoint["stopped"]
+        return True
+
+
+def successive_halving(model_getters, H, T, X_train, y_train, X_validation, y_validation, data_features=DEFAULT_DATA_FEATURES, min_epochs=1, max_epochs=10, reduction_factor=3, patience=2, max_concurrent_trials=1, checkpoint_folder=None):
+    """
+    Find the best configuration of a set of torch models (e.g. the LSTM getters of train_model.ipynb) for one (H, T)
+    with successive halving.
+
+    All configurations are trained for min_epochs epochs, and only the best 1 / reduction_factor of them by
+    validation loss are trained further, for reduction_factor times more epochs, until max_epochs. Trials also
+    stop early when their validation loss has not improved for patience epochs.
+
+    With a checkpoint folder the trials and the progress of the sweep are saved after every trial and rung,
+    and an interrupted sweep continues from its checkpoints when it is run again.
+
+    Args:
+        model_getters (dict): Name to a model getter (H, T) -> (model, features, input_shape), the models must have
+            device, batch_size and learning_rate attributes like TrajectoryPredictor
+        X_train (np.ndarray): Training sequences, with all data features
+        y_train (np.ndarray): Training labels
+        X_validation (np.ndarray): Validation sequences, with all data features
+        y_validation (np.ndarray): Validation labels
+        data_features (list): Features of the sequences
+        max_concurrent_trials (int): Trials trained at the same time on a thread pool
+        checkpoint_folder (str): Folder of the checkpoints, None to not save checkpoints
+
+    Returns:
+        tuple: (best_name, best_model, results) where best_model has the weights of its best epoch and results
+            maps every name to its trained epochs and validation losses
+    """
+    rung_epochs = get_rung_epochs(min_epochs, max_epochs, reduction_factor)
+    trials = {}
+    # The sequences are shaped and copied to the device once per (features, input_shape, device), not once per trial
+    shaped_data = {}
+    for name, model_getter in model_getters.items():
+        model, features, input_shape = model_getter(H, T)
+        data_key = (tuple(features), tuple(input_shape), str(model.device))
+        if data_key not in shaped_data:
+            shaped_data[data_key] = (
+                torch.as_tensor(shape_input_for_model(X_train, data_features, features, input_shape), dtype=torch.float32, device=model.device),
+                torch.as_tensor(y_train, dtype=torch.float32, device=model.device),
+                shape_input_for_model(X_validation, data_features, features, input_shape))
+        X_train_shaped, y_train_shaped, X_validation_shaped = shaped_data[data_key]
+        trials[name] = SweepTrial(name, model, X_train_shaped, y_train_shaped, X_validation_shaped, y_validation)
+
+    survivors = list(trials)
+    first_rung = 0
+    if checkpoint_folder is not None:
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        state_file = os.path.join(checkpoint_folder, SWEEP_STATE_FILE_NAME)
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                state = json.load(f)
+            if state["rung_epochs"] == rung_epochs and set(state["survivors"]).issubset(trials):
+                survivors, first_rung = state["survivors"], state["rung"]
+                loaded = [name for name in trials if trials[name].load(checkpoint_folder)]
+                print(f"Resuming sweep from rung {first_rung} with {len(loaded)} trial checkpoints")
+
+    def train_trial(name, epochs):
+        trials[name].train_to(epochs, patience)
+        if checkpoint_folder is not None:
+            trials[name].save(checkpoint_folder)
+
+    # Share the intra-op threads between the concurrent trials
+    torch_threads = torch.get_num_threads()
+    torch.set_num_threads(max(torch_threads // max_concurrent_trials, 1))
+    try:
+        for rung in range(first_rung, len(rung_epochs)):
+            epochs = rung_epochs[rung]
+            print(f"Rung {rung + 1}/{len(rung_epochs)}: training {len(survivors)} trials to {epochs} epochs")
+            with ThreadPoolExecutor(max_workers=max_concurrent_trials) as executor:
+                list(executor.map(lambda name: train_trial(name, epochs), survivors))
+
+            if rung < len(rung_epochs) - 1:
+                survivors = sorted(survivors, key=lambda name: trials[name].best_validation_loss)
+                survivors = survivors[:max(len(survivors) // reduction_factor, 1)]
+            if checkpoint_folder is not None:
+                with open(state_file, "w") as f:
+                    json.dump({"rung_epochs": rung_epochs, "rung": rung + 1, "survivors": survivors}, f)
+    finally:
+        torch.set_num_threads(torch_threads)
+
+    best_name = min(trials, key=lambda name: trials[name].best_validation_loss)
+    results = {name: {"epochs": trial.epochs, "validation_losses": trial.validation_losses,
+                      "best_validation_loss": trial.best_validation_loss, "stopped": trial.stopped}
+               for name, trial in trials.items()}
+    total_epochs = sum(trial.epochs for trial in trials.values())
+    print(f"Best configuration {best_name} with validation loss {trials[best_name].best_validation_loss}, "
+          f"trained {total_epochs} epochs instead of {len(trials) * max_epochs}")
+    return best_name, trials[best_name].get_best_model(), results
@@ -0,0 +1,151 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from tqdm.auto import tqdm
+
+from utils.batched_inference import predict_in_batches
+
+
+def train_epoch(model, train_loader, optimizer, criterion, description='Epoch'):
+    """
+    Train a model for one epoch over the batches of a loader.
+
+    Returns:
+        float: Loss of the last batch, None when the loader yielded no batches
+    """
+    device = model.device
+    model.train()
+    loss = None
+    pbar = tqdm(train_loader, desc=description, leave=False)
+    for X_batch, y_batch in pbar:
+        X_batch = X_batch.to(device, non_blocking=True)
+        y_batch = y_batch.to(device, non_blocking=True)
+        optimizer.zero_grad()
+        output = model(X_batch)
+        # Only use the first two feature dimensions for loss calculation
+        loss = criterion(output[:, :2], y_batch[:, :2])
+        loss.backward()
+        optimizer.step()
+        pbar.set_postfix({'Loss': loss.item()})
+    pbar.close()
+    return loss.item() if loss is not None else None
+
+
+def train_model(model, X_train, y_train, epochs=50, batch_size=64, learning_rate=0.001, cutoff_loss=None):
+    device = model.device
+    model.to(device)
+    criterion = nn.MSELoss()
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+
+    X_train_tensor = torch.tensor(X_train, dtype=torch.float32).to(device)
+    y_train_tensor = torch.tensor(y_train, dtype=torch.float32).to(device)
+
+    dataset = torch.utils.data.TensorDataset(X_train_tensor, y_train_tensor)
+    train_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=True)
+
+    for epoch in range(epochs):
+        current_loss = train_epoch(
+            model, train_loader, optimizer, criterion, f'Epoch {epoch+1}/{epochs}')
+        if cutoff_loss is not None and current_loss < cutoff_loss:
+            print(
+                f'Loss is below cutoff value of {cutoff_loss}. Stopping training.')
+            break
+
+
+def train_model_streaming(model, dataset, epochs=50, learning_rate=0.001, cutoff_loss=None, num_workers=0):
+    """
+    Train a model on a dataset that yields (X, y) batches, e.g. a StreamingSequenceDataset.
+    Only the current batches are held in memory, so the training set can be larger than the RAM.
+
+    Args:
+        dataset (torch.utils.data.IterableDataset): Yields batches of (X, y) tensors
+        num_workers (int): DataLoader worker processes, each reading its own shard of the keys
+    """
+    device = model.device
+    model.to(device)
+    criterion = nn.MSELoss()
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+
+    # The dataset batches the windows itself
+    train_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=None, num_workers=num_workers, pin_memory=device != 'cpu')
+
+    for epoch in range(epochs):
+        # The DataLoader workers get a new copy of the dataset every epoch, so the epoch is set on the original
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(epoch)
+        current_loss = train_epoch(
+            model, train_loader, optimizer, criterion, f'Epoch {epoch+1}/{epochs}')
+        if current_loss is None:
+            print('The dataset yielded no batches. Stopping training.')
+            break
+        if cutoff_loss is not None and current_loss < cutoff_loss:
+            print(
+                f'Loss is below cutoff value of {cutoff_loss}. Stopping training.')
+            break
+
+
+# Function to predict with the PyTorch model
+
+
+def predict_model(model, X, batch_size=64, no_progress=True):
+    device = model.device
+    model.to(device)
+    model.eval()
+    X_tensor = torch.tensor(X, dtype=torch.float32).to(device)
+    dataset = torch.utils.data.TensorDataset(X_tensor)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    predictions = []
+    pbar = tqdm(loader, desc='Predicting') if not no_progress else loader
+    with torch.no_grad():
+        for X_batch, in pbar:
+            output = model(X_batch)
+            predictions.append(output.cpu().numpy())
+    return np.vstack(predictions)
+
+
+class TrajectoryPredictor(nn.Module):
+    def __init__(self, input_shape, output_shape, lstm_units=128, device='cpu', parameters=None):
+        super(TrajectoryPredictor, self).__init__()
+        if parameters is not None:
+            self.epochs = parameters['epochs']
+            self.batch_size = parameters['batch_size']
+            self.learning_rate = parameters['learning_rate']
+            self.dropout_rate = parameters['dropout_rate']
+        else:
+            self.epochs = 10
+            self.batch_size = 640
+            self.learning_rate = 0.001
+            self.dropout_rate = 0.2
+
+        self.lstm1 = nn.LSTM(input_shape[-1], lstm_units, batch_first=True)
+        self.dropout1 = nn.Dropout(self.dropout_rate)
+        self.lstm2 = nn.LSTM(lstm_units, lstm_units, batch_first=True)
+        self.dropout2 = nn.Dropout(self.dropout_rate)
+        self.fc = nn.Linear(lstm_units, output_shape)
+        self.device = device
+
+    def forward(self, x):
+        x, _ = self.lstm1(x)
+        x = self.dropout1(x)
+        x, _ = self.lstm2(x)
+        x = self.dropout2(x)
+        x = self.fc(x[:, -1, :])  # taking the output of the last time step
+        return x
+
+    def fit(self, X, y, cutoff_loss=None):
+        train_model(self, X, y, self.epochs,
+                    self.batch_size, self.learning_rate, cutoff_loss)
+
+    def fit_streaming(self, dataset, cutoff_loss=None, num_workers=0):
+        """
+        Train on a dataset yielding (X, y) batches, see train_model_streaming.
+        The batch size is set by the dataset.
+        """
+        train_model_streaming(self, dataset, self.epochs,
+                              self.learning_rate, cutoff_loss, num_workers)
+
+    def predict(self, X):
+        return predict_in_batches(self, X)
@@ -0,0 +1,206 @@
+import json
+import os
+import sqlite3
+import datetime
+import numpy as np
+from tqdm import tqdm
+
+from constants import DB_columns, DEFAULT_DATA_FEATURES
+
+VALUES_FILE_NAME = "values.npy"
+OFFSETS_FILE_NAME = "offsets.npy"
+KEYS_FILE_NAME = "keys.npy"
+METADATA_FILE_NAME = "metadata.json"
+
+
+def _rows_to_float32(rows):
+    # NULL values come back as None, store them as NaN
+    values = np.array(rows, dtype=object)
+    return np.where(values == None, np.nan, values).astype(np.float32)  # noqa: E711
+
+
+def export_trajectory_store(database_file, table_name, store_folder, filter="1=1", data_features=DEFAULT_DATA_FEATURES, fetch_size=100000):
+    """
+    Export the trajectory of every compound key in a table into a memory-mapped trajectory store.
+
+    The store is a folder containing:
+        - values.npy: float32 array of shape (rows, features) with the rows of every key stored contiguously, ordered by compound key
+        - offsets.npy: int64 array of length keys + 1, the rows of key i are values[offsets[i]:offsets[i+1]]
+        - keys.npy: the compound keys in the same order as the offsets
+        - metadata.json: the features, table, filter and sizes of the export
+
+    The table is read in a single ordered pass, so the export costs one scan of the compound key index.
+
+    Args:
+        database_file (str): Path to the SQLite database
+        table_name (str): The table to export, e.g. champs_cleaned
+        store_folder (str): The folder to write the store to
+        filter (str): SQL condition selecting the rows to export
+        data_features (list): The columns to export, in order
+        fetch_size (int): Amount of rows fetched from SQLite at a time
+
+    Returns:
+        str: The store folder
+    """
+    os.makedirs(store_folder, exist_ok=True)
+
+    conn = sqlite3.connect(database_file)
+    cursor = conn.cursor()
+
+    total_rows = cursor.execute(
+        f"SELECT COUNT(*) FROM {table_name} WHERE {filter}").fetchone()[0]
+
+    values = np.lib.format.open_memmap(
+        os.path.join(store_folder, VALUES_FILE_NAME), mode="w+", dtype=np.float32, shape=(total_rows, len(data_features)))
+
+    cursor.execute(f"""
+        SELECT {DB_columns.COMPOUND_KEY.value}, {','.join(data_features)}
+        FROM {table_name}
+        WHERE {filter}
+        ORDER BY {DB_columns.COMPOUND_KEY.value}
+    """)
+
+    keys = []
+    offsets = []
+    row_position = 0
+    previous_key = None
+
+    pbar = tqdm(total=total_rows, desc="Exporting trajectories", unit="rows")
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+
+        chunk_keys = np.array([row[0] for row in rows], dtype=object)
+        values[row_position:row_position + len(rows)] = _rows_to_float32([row[1:] for row in rows])
+
+        # Find the rows where a new key starts
+        key_starts = np.flatnonzero(chunk_keys[1:] != chunk_keys[:-1]) + 1
+        if chunk_keys[0] != previous_key:
+            key_starts = np.concatenate(([0], key_starts))
+        for start in key_starts:
+            keys.append(chunk_keys[start])
+            offsets.append(row_position + start)
+
+        previous_key = chunk_keys[-1]
+        row_position += len(rows)
+        pbar.update(len(rows))
+    pbar.close()
+
+    conn.close()
+
+    offsets.append(row_position)
+    values.flush()
+    del values
+
+    np.save(os.path.join(store_folder, OFFSETS_FILE_NAME), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(store_folder, KEYS_FILE_NAME), np.array(keys))
+
+    metadata = {
+        "database_file": os.path.abspath(database_file),
+        "table_name": table_name,
+        "filter": filter,
+        "data_features": list(data_features),
+        "row_count": row_position,
+        "key_count": len(keys),
+        "export_date": datetime.datetime.now().isoformat(),
+    }
+    with open(os.path.join(store_folder, METADATA_FILE_NAME), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    print(f"Exported {len(keys)} keys and {row_position} rows to {store_folder}")
+    return store_folder
+
+
+def save_trajectory_store(store_folder, values, offsets, keys, metadata):
+    """
+    Write arrays that are already in memory as a trajectory store, in the format of export_trajectory_store.
+
+    Returns:
+        str: The store folder
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    np.save(os.path.join(store_folder, VALUES_FILE_NAME), np.asarray(values, dtype=np.float32))
+    np.save(os.path.join(store_folder, OFFSETS_FILE_NAME), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(store_folder, KEYS_FILE_NAME), np.asarray(keys))
+
+    metadata = {
+        **metadata,
+        "row_count": int(len(values)),
+        "key_count": int(len(keys)),
+        "export_date": datetime.datetime.now().isoformat(),
+    }
+    # Written last, so a store with metadata is complete
+    with open(os.path.join(store_folder, METADATA_FILE_NAME), "w") as f:
+        json.dump(metadata, f, indent=4)
+    return store_folder
+
+
+class TrajectoryStore:
+    """
+    Read-only view of a trajectory store written by export_trajectory_store.
+
+    The values are memory-mapped, so slices returned from the store are views into the file and cost no copies.
+    """
+
+    def __init__(self, store_folder):
+        with open(os.path.join(store_folder, METADATA_FILE_NAME), "r") as f:
+            self.metadata = json.load(f)
+        self.store_folder = store_folder
+        self.data_features = self.metadata["data_features"]
+        self.values = np.load(os.path.join(store_folder, VALUES_FILE_NAME), mmap_mode="r")
+        self.offsets = np.load(os.path.join(store_folder, OFFSETS_FILE_NAME))
+        self.keys = np.load(os.path.join(store_folder, KEYS_FILE_NAME))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_trajectory(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_rows(self, offset, limit):
+        """
+        Get the rows of a range of keys as one contiguous block.
+
+        Returns:
+            tuple: (values, offsets) where values is a view of the rows and offsets are relative to the start of values
+        """
+        # Offsets past the last key give an empty block, like fetch_data_batches_from_store
+        start = min(offset, len(self))
+        end = min(offset + limit, len(self))
+        offsets = self.offsets[start:end + 1]
+        return self.values[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+    def feature_indices(self, data_features):
+        missing_features = [feature for feature in data_features if feature not in self.data_features]
+        if missing_features:
+            raise ValueError(
+                f"Features {missing_features} not found in the trajectory store {self.store_folder}")
+        return [self.data_features.index(feature) for feature in data_features]
+
+
+def load_trajectory_store(store_folder):
+    return TrajectoryStore(store_folder)
+
+
+def fetch_data_batches_from_store(store, offset, limit, data_features=None):
+    """
+    Fetch the trajectories of a range of keys from a trajectory store.
+
+    Mirrors utils.get_data.fetch_data_batches: returns an object array with one (rows, features) array per key.
+    When data_features is None or equal to the exported features, the arrays are zero-copy views of the store.
+    """
+    start = min(offset, len(store))
+    end = min(offset + limit, len(store))
+
+    column_indices = None
+    if data_features is not None and list(data_features) != store.data_features:
+        column_indices = store.feature_indices(data_features)
+
+    data = np.empty(end - start, dtype=object)
+    for i in range(start, end):
+        trajectory = store.get_trajectory(i)
+        data[i - start] = trajectory if column_indices is None else trajectory[:, column_indices]
+
+    print(f"Fetched {len(data)} keys for offset: {offset}, limit: {limit}")
+    return data
@@ -0,0 +1,207 @@
+import itertools
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+
+class WindowedSequenceDataset:
+    """
+    Lazy view of the (X, y) sequences of a set of trajectories.
+
+    The rows of the trajectories are stored once in a flat (rows, features) array, and every sequence is
+    identified by the row it starts from. Sequence i is
+        X = values[starts[i] + x_offset : starts[i] + x_offset + H]
+        y = values[starts[i] + x_offset + H + T - 1, label_indices]
+    so memory scales with the size of the trajectories instead of H times the amount of sequences.
+
+    Indexing with an int returns a single (X, y) pair, indexing with a slice or an array of indices returns
+    a batch, which is the only time windows are copied.
+    """
+
+    def __init__(self, values, starts, H, T, label_indices=[0, 1], x_offset=0):
+        self.values = values
+        self.starts = starts
+        self.H = H
+        self.T = T
+        self.label_indices = list(label_indices)
+        self.x_offset = x_offset
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            X, y = self.get_batch([index])
+            return X[0], y[0]
+        return self.get_batch(index)
+
+    @property
+    def feature_count(self):
+        return self.values.shape[1]
+
+    def get_batch(self, indices, feature_indices=None):
+        """
+        Get the sequences at the given indices.
+
+        Args:
+            indices: Slice or array of sequence indices
+            feature_indices (list): Features of X to return, all features by default
+
+        Returns:
+            tuple: (X, y) with shapes (sequences, H, features) and (sequences, labels)
+        """
+        window_starts = self.starts[indices] + self.x_offset
+        X_rows = window_starts[:, None] + np.arange(self.H)
+        if feature_indices is None:
+            X = self.values[X_rows]
+        else:
+            X = self.values[X_rows[:, :, None], np.asarray(feature_indices)]
+        y = self.values[window_starts + self.H + self.T - 1][:, self.label_indices]
+        return X, y
+
+    def get_labels(self, indices=slice(None)):
+        return self.values[self.starts[indices] + self.x_offset + self.H + self.T - 1][:, self.label_indices]
+
+    def iter_batches(self, batch_size=1024, feature_indices=None, shuffle=False, random_state=None):
+        """
+        Iterate over the sequences in (X, y) batches of at most batch_size sequences.
+        """
+        indices = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(random_state).shuffle(indices)
+        for batch_start in range(0, len(self), batch_size):
+            yield self.get_batch(indices[batch_start:batch_start + batch_size], feature_indices)
+
+    def to_arrays(self, feature_indices=None):
+        """
+        Materialize every sequence, in the format of create_sequences_from_database_rows.
+        """
+        return self.get_batch(slice(None), feature_indices)
+
+    def subset(self, indices):
+        """
+        A dataset of the sequences at the given indices, sharing the values of this dataset.
+        """
+        return WindowedSequenceDataset(self.values, self.starts[indices], self.H, self.T, self.label_indices, self.x_offset)
+
+    def with_horizon(self, H, T):
+        """
+        A dataset of the same sequences with another history length H and prediction offset T, sharing the values.
+        The last row of the history stays in place, so sequences of every (H, T) are from the same points in time.
+        """
+        x_offset = self.x_offset + self.H - H
+        if x_offset < 0:
+            raise ValueError(f"H={H} is longer than the history available to this dataset ({self.x_offset + self.H})")
+        return WindowedSequenceDataset(self.values, self.starts, H, T, self.label_indices, x_offset)
+
+    def split(self, test_size=0.2, shuffle=True, random_state=None):
+        """
+        Split the sequences into a training and a test dataset. No windows are copied.
+
+        Returns:
+            tuple: (train_dataset, test_dataset)
+        """
+        train_indices, test_indices = train_test_split(
+            np.arange(len(self)), test_size=test_size, shuffle=shuffle, random_state=random_state)
+        return self.subset(train_indices), self.subset(test_indices)
+
+
+def get_valid_window_starts(offsets, window_length, times=None, time_step=None, time_tolerance=0.5):
+    """
+    Get the first rows of all windows of window_length rows that fit inside a trajectory, in one vectorized pass.
+
+    Args:
+        offsets (np.ndarray): Row offsets of the trajectories, trajectory i is rows offsets[i]:offsets[i+1]
+        window_length (int): Amount of rows in a window
+        times (np.ndarray): Time of every row. When given, only windows of consecutive samples are kept,
+            so the rows of a window are time_step apart and row offsets can be read as time offsets
+        time_step (float): Time between samples, the median time between rows by default
+        time_tolerance (float): Allowed deviation from time_step, as a fraction of time_step
+
+    Returns:
+        np.ndarray: The first row of every window
+    """
+    lengths = np.diff(offsets)
+    counts = np.maximum(lengths - window_length + 1, 0)
+    total = int(counts.sum())
+
+    # Position of every window inside its trajectory
+    window_offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(offsets[:-1], counts) + window_offsets
+
+    if times is not None and len(starts) > 0 and window_length > 1:
+        time_differences = np.diff(times)
+        if time_step is None:
+            time_step = float(np.median(time_differences))
+        # Cumulative count of gaps, a window is kept when it contains no gaps
+        gaps = np.abs(time_differences - time_step) > time_tolerance * time_step
+        gap_counts = np.concatenate(([0], np.cumsum(gaps)))
+        starts = starts[gap_counts[starts + window_length - 1] == gap_counts[starts]]
+
+    return starts
+
+
+def create_ragged_windowed_dataset(values, offsets, H, T, max_H=None, max_T=None, label_indices=[0, 1], time_column_index=None, time_step=None):
+    """
+    Create a dataset of every valid window of trajectories of different lengths.
+
+    Unlike create_windowed_dataset_from_database_rows, trajectories are not cut to the length of the shortest one:
+    every trajectory gives all of its windows of max_H + max_T rows.
+
+    Args:
+        values (np.ndarray): The rows of all trajectories, stored contiguously
+        offsets (np.ndarray): Row offsets of the trajectories, e.g. from TrajectoryStore.get_rows
+        time_column_index (int): Feature index of the time column, to keep only windows of consecutive samples
+        time_step (float): Time between samples, see get_valid_window_starts
+
+    Returns:
+        WindowedSequenceDataset: The sequences of the trajectories
+    """
+    max_H = max_H or H
+    max_T = max_T or T
+
+    values = np.asarray(values, dtype=np.float32)
+    times = values[:, time_column_index] if time_column_index is not None else None
+    starts = get_valid_window_starts(np.asarray(offsets, dtype=np.int64), max_H + max_T, times, time_step)
+    return WindowedSequenceDataset(values, starts, H, T, label_indices, max_H - H)
+
+
+def create_windowed_dataset_from_database_rows(data, H, T, max_H=None, max_T=None, label_indices=[0, 1], ragged=False, time_column_index=None, time_step=None):
+    """
+    Lazy version of create_sequences_from_database_rows, with the same sequences in the same order.
+
+    Every trajectory is cut to the length of the shortest trajectory, and every trajectory gives the
+    sequences ending at the same points in time for all H <= max_H and T <= max_T.
+
+    Args:
+        ragged (bool): Keep every trajectory whole and use all of its windows, see create_ragged_windowed_dataset
+        time_column_index (int): Feature index of the time column, to keep only windows of consecutive samples.
+            Only used with ragged
+        time_step (float): Time between samples, see get_valid_window_starts
+
+    Returns:
+        WindowedSequenceDataset: The sequences of the trajectories
+    """
+    max_H = max_H or H
+    max_T = max_T or T
+    if time_column_index is not None and not ragged:
+        raise ValueError("time_column_index is only used with ragged, trajectories cut to the shortest one are not checked for gaps")
+
+    if len(data) == 0:
+        return WindowedSequenceDataset(np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64), H, T, label_indices, max_H - H)
+
+    if ragged:
+        lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        values = np.array(list(itertools.chain.from_iterable(data)), dtype=np.float32)
+        return create_ragged_windowed_dataset(
+            values, offsets, H, T, max_H, max_T, label_indices, time_column_index, time_step)
+
+    max_row_amount = min([len(rows) for rows in data])
+    sequences_per_key = max(max_row_amount - max_H - max_T, 0)
+    if sequences_per_key == 0:
+        return WindowedSequenceDataset(np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64), H, T, label_indices, max_H - H)
+
+    # Only the rows used by the sequences are kept
+    values = np.concatenate([np.asarray(rows[:max_row_amount], dtype=np.float32) for rows in data])
+    starts = (np.arange(len(data)) * max_row_amount)[:, None] + np.arange(sequences_per_key)
+    return WindowedSequenceDataset(values, starts.reshape(-1), H, T, label_indices, max_H - H)